@@ -0,0 +1,348 @@
+"""
+Benchmarks for parsing MWS and Product Advertising responses.
+
+Each case parses a recorded response (ListFinancialEvents.xml and events_by_group.xml) or a synthetic one built
+from a single-record template, at several scales. Actors that declare stream_records are measured with both the
+full-document parser and the streaming parser. Runs entirely offline.
+
+Usage (from the web directory):
+
+    python -m benchmarks.parse_xml
+    python -m benchmarks.parse_xml --scales 1,10,50 --save baseline.json
+    python -m benchmarks.parse_xml --compare baseline.json
+"""
+
+import io
+import os
+import copy
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+import collections
+import multiprocessing as mp
+
+from lxml import etree
+
+from tasks.broker import setup_dramatiq
+setup_dramatiq()
+
+from ext.amazon.tasks import mws, pa
+from ext.amazon.tasks.common import remove_namespaces, parse_stream
+
+
+########################################################################################################################
+
+
+WEB_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+Case = collections.namedtuple('Case', 'name actor fixture record_path')
+
+
+def recorded(filename):
+    """Returns a fixture that loads a recorded response and repeats the records in each list :scale: times."""
+
+    def fixture(actor, scale):
+        with open(os.path.join(WEB_DIR, filename), 'rb') as f:
+            data = f.read()
+
+        if scale == 1:
+            return data
+
+        root = etree.fromstring(data)
+        parents = {parent for parent, tag, schema in actor.stream_records.values()}
+
+        for container in root.iter():
+            if isinstance(container.tag, str) and etree.QName(container).localname in parents:
+                records = list(container)
+                for _ in range(scale - 1):
+                    container.extend(copy.deepcopy(record) for record in records)
+
+        return etree.tostring(root)
+
+    return fixture
+
+
+def synthetic(wrapper, record, count=20):
+    """Returns a fixture that builds a response from a wrapper and a record template. The record is repeated
+    :count: times at scale 1."""
+
+    def fixture(actor, scale):
+        records = ''.join(record.format(i=i) for i in range(count * scale))
+        return wrapper.format(records=records).encode('utf-8')
+
+    return fixture
+
+
+########################################################################################################################
+
+
+_ORDERS_NS = 'https://mws.amazonservices.com/Orders/2013-09-01'
+_INVENTORY_NS = 'http://mws.amazonaws.com/FulfillmentInventory/2010-10-01/'
+_INBOUND_NS = 'http://mws.amazonaws.com/FulfillmentInboundShipment/2010-10-01/'
+_FINANCES_NS = 'http://mws.amazonservices.com/Finances/2015-05-01'
+_PRODUCTS_NS = 'http://mws.amazonservices.com/schema/Products/2011-10-01'
+_PA_NS = 'http://webservices.amazon.com/AWSECommerceService/2011-08-01'
+
+_METADATA = '<ResponseMetadata><RequestId>benchmark</RequestId></ResponseMetadata>'
+
+
+CASES = [
+    Case('ListFinancialEvents', mws.ListFinancialEvents, recorded('ListFinancialEvents.xml'), None),
+    Case('ListFinancialEvents (by group)', mws.ListFinancialEvents, recorded('events_by_group.xml'), None),
+
+    Case('ListOrders', mws.ListOrders, synthetic(
+        f'<ListOrdersResponse xmlns="{_ORDERS_NS}"><ListOrdersResult><Orders>{{records}}</Orders>'
+        f'</ListOrdersResult>{_METADATA}</ListOrdersResponse>',
+        '<Order><AmazonOrderId>111-0000000-{i:07d}</AmazonOrderId><PurchaseDate>2018-05-01T12:00:00Z</PurchaseDate>'
+        '<OrderStatus>Shipped</OrderStatus><FulfillmentChannel>AFN</FulfillmentChannel><IsPrime>false</IsPrime>'
+        '<IsBusinessOrder>false</IsBusinessOrder><IsReplacementOrder>false</IsReplacementOrder>'
+        '<BuyerName>Buyer {i}</BuyerName><BuyerEmail>buyer{i}@example.com</BuyerEmail><ShippingAddress>'
+        '<AddressLine1>1 Main St</AddressLine1><City>Springfield</City><StateOrRegion>IL</StateOrRegion>'
+        '<PostalCode>62701</PostalCode><CountryCode>US</CountryCode></ShippingAddress></Order>'
+    ), None),
+
+    Case('ListOrderItems', mws.ListOrderItems, synthetic(
+        f'<ListOrderItemsResponse xmlns="{_ORDERS_NS}"><ListOrderItemsResult><OrderItems>{{records}}</OrderItems>'
+        f'</ListOrderItemsResult>{_METADATA}</ListOrderItemsResponse>',
+        '<OrderItem><ASIN>B0{i:08d}</ASIN><SellerSKU>SKU-{i}</SellerSKU><OrderItemId>{i:014d}</OrderItemId>'
+        '<Title>Item {i}</Title><QuantityOrdered>1</QuantityOrdered><QuantityShipped>1</QuantityShipped>'
+        '<ItemPrice><CurrencyCode>USD</CurrencyCode><Amount>19.99</Amount></ItemPrice>'
+        '<ShippingPrice><CurrencyCode>USD</CurrencyCode><Amount>0.00</Amount></ShippingPrice></OrderItem>'
+    ), None),
+
+    Case('ListInventorySupply', mws.ListInventorySupply, synthetic(
+        f'<ListInventorySupplyResponse xmlns="{_INVENTORY_NS}"><ListInventorySupplyResult><InventorySupplyList>'
+        f'{{records}}</InventorySupplyList></ListInventorySupplyResult>{_METADATA}</ListInventorySupplyResponse>',
+        '<member><Condition>NewItem</Condition><SupplyDetail><member><Quantity>5</Quantity>'
+        '<SupplyType>InStock</SupplyType></member></SupplyDetail><TotalSupplyQuantity>5</TotalSupplyQuantity>'
+        '<FNSKU>X0{i:08d}</FNSKU><InStockSupplyQuantity>5</InStockSupplyQuantity><ASIN>B0{i:08d}</ASIN>'
+        '<SellerSKU>SKU-{i}</SellerSKU></member>'
+    ), None),
+
+    Case('ListInboundShipments', mws.ListInboundShipments, synthetic(
+        f'<ListInboundShipmentsResponse xmlns="{_INBOUND_NS}"><ListInboundShipmentsResult><ShipmentData>'
+        f'{{records}}</ShipmentData></ListInboundShipmentsResult>{_METADATA}</ListInboundShipmentsResponse>',
+        '<member><ShipmentId>FBA{i:08d}</ShipmentId><ShipmentName>Shipment {i}</ShipmentName>'
+        '<DestinationFulfillmentCenterId>ABE2</DestinationFulfillmentCenterId>'
+        '<LabelPrepType>SELLER_LABEL</LabelPrepType><ShipmentStatus>CLOSED</ShipmentStatus>'
+        '<AreCasesRequired>false</AreCasesRequired><BoxContentsSource>FEED</BoxContentsSource></member>'
+    ), None),
+
+    Case('ListInboundShipmentItems', mws.ListInboundShipmentItems, synthetic(
+        f'<ListInboundShipmentItemsResponse xmlns="{_INBOUND_NS}"><ListInboundShipmentItemsResult><ItemData>'
+        f'{{records}}</ItemData></ListInboundShipmentItemsResult>{_METADATA}</ListInboundShipmentItemsResponse>',
+        '<member><ShipmentId>FBA00000001</ShipmentId><SellerSKU>SKU-{i}</SellerSKU>'
+        '<FulfillmentNetworkSKU>X0{i:08d}</FulfillmentNetworkSKU><QuantityShipped>10</QuantityShipped>'
+        '<QuantityReceived>10</QuantityReceived><QuantityInCase>0</QuantityInCase><PrepDetailsList><PrepDetails>'
+        '<PrepInstruction>Labeling</PrepInstruction><PrepOwner>SELLER</PrepOwner></PrepDetails></PrepDetailsList>'
+        '</member>'
+    ), None),
+
+    Case('ListFinancialEventGroups', mws.ListFinancialEventGroups, synthetic(
+        f'<ListFinancialEventGroupsResponse xmlns="{_FINANCES_NS}"><ListFinancialEventGroupsResult>'
+        f'<FinancialEventGroupList>{{records}}</FinancialEventGroupList></ListFinancialEventGroupsResult>'
+        f'{_METADATA}</ListFinancialEventGroupsResponse>',
+        '<FinancialEventGroup><FinancialEventGroupId>group-{i}</FinancialEventGroupId>'
+        '<FinancialEventGroupStatus>Closed</FinancialEventGroupStatus><FundTransferStatus>Succeeded'
+        '</FundTransferStatus><OriginalTotal><CurrencyCode>USD</CurrencyCode><Amount>1000.00</Amount>'
+        '</OriginalTotal><FundTransferDate>2018-05-01T00:00:00Z</FundTransferDate><TraceId>trace-{i}</TraceId>'
+        '<AccountTail>123</AccountTail><BeginningBalance><CurrencyCode>USD</CurrencyCode><Amount>0.00</Amount>'
+        '</BeginningBalance><FinancialEventGroupStart>2018-04-17T00:00:00Z</FinancialEventGroupStart>'
+        '</FinancialEventGroup>'
+    ), None),
+
+    Case('ListMatchingProducts', mws.ListMatchingProducts, synthetic(
+        f'<ListMatchingProductsResponse xmlns="{_PRODUCTS_NS}"><ListMatchingProductsResult><Products>{{records}}'
+        f'</Products></ListMatchingProductsResult>{_METADATA}</ListMatchingProductsResponse>',
+        '<Product><Identifiers><MarketplaceASIN><MarketplaceId>ATVPDKIKX0DER</MarketplaceId>'
+        '<ASIN>B0{i:08d}</ASIN></MarketplaceASIN></Identifiers><AttributeSets><ItemAttributes><Brand>Brand</Brand>'
+        '<Model>M-{i}</Model><ListPrice><Amount>24.99</Amount><CurrencyCode>USD</CurrencyCode></ListPrice>'
+        '<NumberOfItems>1</NumberOfItems><PackageQuantity>1</PackageQuantity><Title>Product {i}</Title>'
+        '<Feature>Feature one</Feature><Feature>Feature two</Feature><SmallImage><URL>http://example.com/{i}.jpg'
+        '</URL></SmallImage></ItemAttributes></AttributeSets><SalesRankings><SalesRank>'
+        '<ProductCategoryId>toy_display_on_website</ProductCategoryId><Rank>{i}</Rank></SalesRank>'
+        '</SalesRankings></Product>',
+        count=10
+    ), '//*[local-name()="Product"]'),
+
+    Case('GetCompetitivePricingForASIN', mws.GetCompetitivePricingForASIN, synthetic(
+        f'<GetCompetitivePricingForASINResponse xmlns="{_PRODUCTS_NS}">{{records}}{_METADATA}'
+        f'</GetCompetitivePricingForASINResponse>',
+        '<GetCompetitivePricingForASINResult ASIN="B0{i:08d}" status="Success"><Product><CompetitivePricing>'
+        '<CompetitivePrices><CompetitivePrice belongsToRequester="false" condition="New" subcondition="New">'
+        '<CompetitivePriceId>1</CompetitivePriceId><Price><LandedPrice><CurrencyCode>USD</CurrencyCode>'
+        '<Amount>20.00</Amount></LandedPrice><ListingPrice><CurrencyCode>USD</CurrencyCode><Amount>20.00</Amount>'
+        '</ListingPrice><Shipping><CurrencyCode>USD</CurrencyCode><Amount>0.00</Amount></Shipping></Price>'
+        '</CompetitivePrice></CompetitivePrices><NumberOfOfferListings>'
+        '<OfferListingCount condition="New">3</OfferListingCount></NumberOfOfferListings></CompetitivePricing>'
+        '</Product></GetCompetitivePricingForASINResult>'
+    ), '//*[local-name()="GetCompetitivePricingForASINResult"]'),
+
+    Case('GetMyFeesEstimate', mws.GetMyFeesEstimate, synthetic(
+        f'<GetMyFeesEstimateResponse xmlns="{_PRODUCTS_NS}"><GetMyFeesEstimateResult><FeesEstimateResultList>'
+        f'{{records}}</FeesEstimateResultList></GetMyFeesEstimateResult>{_METADATA}</GetMyFeesEstimateResponse>',
+        '<FeesEstimateResult><FeesEstimateIdentifier><MarketplaceId>ATVPDKIKX0DER</MarketplaceId>'
+        '<IdType>ASIN</IdType><SellerInputIdentifier>request{i}</SellerInputIdentifier><IdValue>B0{i:08d}'
+        '</IdValue></FeesEstimateIdentifier><FeesEstimate><TotalFeesEstimate><CurrencyCode>USD</CurrencyCode>'
+        '<Amount>5.12</Amount></TotalFeesEstimate></FeesEstimate><Status>Success</Status></FeesEstimateResult>'
+    ), '//*[local-name()="FeesEstimateResult"]'),
+
+    Case('ItemLookup', pa.ItemLookup, synthetic(
+        f'<ItemLookupResponse xmlns="{_PA_NS}"><Items>{{records}}</Items></ItemLookupResponse>',
+        '<Item><ASIN>B0{i:08d}</ASIN><SalesRank>{i}</SalesRank><LargeImage><URL>http://example.com/{i}.jpg</URL>'
+        '</LargeImage><ItemAttributes><Brand>Brand</Brand><Model>M-{i}</Model><NumberOfItems>1</NumberOfItems>'
+        '<PackageQuantity>1</PackageQuantity><ProductGroup>Toy</ProductGroup><Title>Item {i}</Title>'
+        '<UPC>0000000{i:05d}</UPC><Feature>Feature one</Feature></ItemAttributes><Offers><Offer><Merchant>'
+        '<Name>Amazon.com</Name></Merchant><OfferListing><Price><Amount>1999</Amount></Price>'
+        '<IsEligibleForPrime>1</IsEligibleForPrime></OfferListing></Offer></Offers></Item>',
+        count=10
+    ), '//*[local-name()="Item"]'),
+]
+
+
+########################################################################################################################
+
+
+def count_records(case, data):
+    """Count the records in a response."""
+    root = etree.fromstring(data)
+
+    if case.record_path:
+        return int(root.xpath(f'count({case.record_path})'))
+
+    return sum(
+        int(root.xpath(f'count(//*[local-name()="{parent}"]/*[local-name()="{tag}"])'))
+        for parent, tag, schema in case.actor.stream_records.values()
+    )
+
+
+def parsers_for(case):
+    """Return the parsers that apply to a case, as (mode, function) pairs."""
+    actor = case.actor
+    parsers = [('full', lambda data: actor.ResponseSchema().load(remove_namespaces(data)))]
+
+    if actor.stream_records:
+        parsers.append(('stream', lambda data: parse_stream(io.BytesIO(data), actor.stream_records)))
+
+    return parsers
+
+
+def measure(case_idx, mode, scale, repeat):
+    """Run a single benchmark. This is called in a fresh process, so that peak RSS belongs to this case alone."""
+    case = CASES[case_idx]
+    parse = dict(parsers_for(case))[mode]
+    data = case.fixture(case.actor, scale)
+    records = count_records(case, data)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Peak memory allocated by Python code during a single parse, and the number of memory blocks still held
+    # afterwards (by the parsed result, and anything else the parse left behind)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = parse(data)
+    after = tracemalloc.take_snapshot()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'filename'))
+    del result
+
+    # Timing
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(data)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'case': case.name,
+        'mode': mode,
+        'scale': scale,
+        'bytes': len(data),
+        'records': records,
+        'seconds': best,
+        'records_per_sec': records / best if best else 0,
+        'peak_rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+        'traced_peak_kb': traced_peak // 1024,
+        'retained_blocks': retained_blocks
+    }
+
+
+def run(scales=(1, 10), repeat=5, only=None):
+    """Run all benchmarks, and return a list of results."""
+    results = []
+
+    for idx, case in enumerate(CASES):
+        if only and only.lower() not in case.name.lower():
+            continue
+
+        for mode, _ in parsers_for(case):
+            for scale in scales:
+                with mp.Pool(1, maxtasksperchild=1) as pool:
+                    results.append(pool.apply(measure, (idx, mode, scale, repeat)))
+
+    return results
+
+
+########################################################################################################################
+
+
+def _result_key(result):
+    return f'{result["case"]}/{result["mode"]}/x{result["scale"]}'
+
+
+def print_results(results, baseline=None):
+    baseline = {_result_key(r): r for r in baseline or []}
+    header = f'{"case":<48} {"records":>8} {"rec/sec":>12} {"peak RSS":>10} {"RSS +":>9} {"py peak":>9} {"retained":>9}'
+    if baseline:
+        header += f' {"rec/sec Δ":>10} {"RSS+ Δ":>9}'
+
+    print(header)
+    print('-' * len(header))
+
+    for result in results:
+        key = _result_key(result)
+        line = f'{key:<48} {result["records"]:>8} {result["records_per_sec"]:>12,.0f} ' \
+               f'{result["peak_rss_kb"]:>8}KB {result["rss_growth_kb"]:>7}KB {result["traced_peak_kb"]:>7}KB ' \
+               f'{result["retained_blocks"]:>9}'
+
+        base = baseline.get(key)
+        if base:
+            speed = (result['records_per_sec'] / base['records_per_sec'] - 1) * 100 if base['records_per_sec'] else 0
+            growth = result['rss_growth_kb'] - base['rss_growth_kb']
+            line += f' {speed:>+9.1f}% {growth:>+7}KB'
+
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MWS response parsing.')
+    parser.add_argument('--scales', default='1,10', help='Comma-separated list of fixture scales.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per benchmark.')
+    parser.add_argument('--only', default=None, help='Only run cases whose name contains this string.')
+    parser.add_argument('--save', default=None, help='Save the results to this JSON file.')
+    parser.add_argument('--compare', default=None, help='Compare the results to a previously saved JSON file.')
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    results = run(scales=scales, repeat=args.repeat, only=args.only)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
+import click
 from pprint import pprint
 from app import app, db, search
+from core import create_extra_indexes
 
 
 ########################################################################################################################
@@ -19,3 +21,38 @@ def make_shell_context():
         'search': search,
         **models
     }
+
+
+@app.cli.command('create-extra-indexes')
+def create_extra_indexes_command():
+    """Create the indexes for models' __extra_indexes__ keys in an existing database."""
+    created = create_extra_indexes(db.engine, db.metadata)
+    for name in created:
+        print(f'Created {name}')
+
+    if not created:
+        print('All extra indexes exist.')
+
+
+@app.cli.command('mws-stub-server')
+@click.option('--host', default='localhost', help='Address to listen on.')
+@click.option('--port', default=8089, help='Port to listen on.')
+@click.option('--latency', default=0.0, help='Seconds to wait before each response.')
+@click.option('--jitter', default=0.0, help='Up to this many more seconds are added to each wait, at random.')
+@click.option('--throttle-rate', default=0.0, help='Fraction of requests to throttle at random.')
+@click.option('--no-quotas', is_flag=True, help="Don't throttle requests beyond the documented quotas.")
+@click.option('--fallback', is_flag=True, help="Answer requests that weren't recorded with a response recorded for "
+                                                "the same action. Defaults to MWS_REPLAY_FALLBACK.")
+def mws_stub_server_command(host, port, latency, jitter, throttle_rate, no_quotas, fallback):
+    """Serve the recorded MWS responses in MWS_CASSETTE_DIR, for use with MWS_TRANSPORT=stub."""
+    from ext.amazon.tasks.transport import CassetteStore, StubServer
+
+    store = CassetteStore(app.config['MWS_CASSETTE_DIR'])
+    server = StubServer((host, port), store, latency=latency, jitter=jitter, throttle_rate=throttle_rate,
+                        enforce_quotas=not no_quotas, fallback=fallback or app.config['MWS_REPLAY_FALLBACK'])
+
+    print(f'Serving {store.path} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -12,6 +12,8 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI', 'postgresql://')
 
     REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+    REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 20))  # Seconds to wait for a free connection
 
     MWS_ACCESS_KEY = os.environ.get('MWS_ACCESS_KEY')
     MWS_SECRET_KEY = os.environ.get('MWS_SECRET_KEY')
@@ -20,6 +22,11 @@ class Config:
     PA_SECRET_KEY = os.environ.get('PA_SECRET_KEY')
     PA_ASSOCIATE_TAG = os.environ.get('PA_ASSOCIATE_TAG')
 
+    MWS_TRANSPORT = os.environ.get('MWS_TRANSPORT', 'live')  # live, record, replay or stub
+    MWS_CASSETTE_DIR = os.environ.get('MWS_CASSETTE_DIR', os.path.join(basedir, 'cassettes'))
+    MWS_STUB_URL = os.environ.get('MWS_STUB_URL', 'http://localhost:8089')
+    MWS_REPLAY_FALLBACK = os.environ.get('MWS_REPLAY_FALLBACK', '').lower() in ('1', 'true', 'yes')
+
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')
 
     RESTFUL_JSON = {'cls': ColanderJSONEncoder}
@@ -7,6 +7,8 @@ from .models import (
     quantize_decimal,
     to_snake_case,
     filter_with_json,
+    next_ids,
+    create_extra_indexes,
     Base,
     ColanderJSONEncoder,
     DateTimeField,
@@ -23,6 +25,8 @@ __all__ = (
     'quantize_decimal',
     'to_snake_case',
     'filter_with_json',
+    'next_ids',
+    'create_extra_indexes',
     'Base',
     'ColanderJSONEncoder',
     'all_subclasses'
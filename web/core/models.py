@@ -55,7 +55,8 @@ def to_snake_case(name):
 
 
 def filter_with_json(query, js, obj_type=None):
-    """Apply filters and joins to a query, according to the contents of a JSON document."""
+    """Apply filters and joins to a query, according to the contents of a JSON document. Keys listed in the
+    model's __extra_indexes__ can be used like columns; they are compared as text, so that their indexes are used."""
     obj_type = obj_type or query._primary_entity.type
     mapper = obj_type.__mapper__
     ops = {
@@ -65,25 +66,33 @@ def filter_with_json(query, js, obj_type=None):
         '_nin': lambda a, b: ~a.in_(b),
     }
 
-    def expr(attr, op, value):
-        return ops[op](getattr(obj_type, attr), value)
+    def expr(col, op, value, cast):
+        value = [cast(v) for v in value] if op in ('_in', '_nin') else cast(value)
+        return ops[op](col, value)
+
+    def exprs_for(col, filters, cast=lambda v: v):
+        if isinstance(filters, dict):
+            return [expr(col, op, value, cast) for op, value in filters.items()]
+        elif isinstance(filters, list):
+            return [expr(col, '_in', filters, cast)]
+        else:
+            return [expr(col, '_eq', filters, cast)]
+
+    def text(value):
+        return str(value) if value is not None else None
 
     for attr, filters in js.items():
         if attr in mapper.columns:
-            if isinstance(filters, dict):
-                exprs = [expr(attr, op, value) for op, value in filters.items()]
-            elif isinstance(filters, list):
-                exprs = [expr(attr, '_in', filters)]
-            else:
-                exprs = [expr(attr, '_eq', filters)]
-
-            query = query.filter(*exprs)
+            query = query.filter(*exprs_for(getattr(obj_type, attr), filters))
 
         elif attr in mapper.relationships:
             rel_type = mapper.relationships[attr].mapper.class_
             query = query.join(rel_type)
             query = filter_with_json(query, filters, rel_type)
 
+        elif attr in getattr(obj_type, '__extra_indexes__', ()):
+            query = query.filter(*exprs_for(obj_type.extra[attr].astext, filters, text))
+
     orderings = []
     for attr, direction in js.get('_sort', {}).items():
         if direction in ('asc', 'ascending', 'up', True):
@@ -101,6 +110,37 @@ def filter_with_json(query, js, obj_type=None):
     return query
 
 
+def next_ids(session, table, count):
+    """Reserve :count: values from the sequence behind a table's primary key. Used by set-based inserts into
+    joined-table hierarchies, where the rows in each table have to share an ID."""
+    if not count:
+        return []
+
+    sequence = sa.func.pg_get_serial_sequence(f'"{table.name}"', 'id')
+    rows = session.execute(
+        sa.select([sa.func.nextval(sequence)]).select_from(sa.func.generate_series(1, count))
+    )
+
+    return [id for id, in rows]
+
+
+def create_extra_indexes(engine, metadata):
+    """Create any indexes declared with __extra_indexes__ that don't exist in the database yet, and return their
+    names. Tables created with create_all() already have them; this is for databases that predate them."""
+    existing = {name for name, in engine.execute(
+        sa.text('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()')
+    )}
+
+    created = []
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if 'extra_key' in index.info and index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+
+    return created
+
+
 def all_subclasses(cls):
     return [cls] + list(itertools.chain(*(all_subclasses(s) for s in cls.__subclasses__())))
 
@@ -134,11 +174,27 @@ jb.FIELD_MAP[sa.DateTime] = DateTimeField
 
 
 class BaseMeta(jb.JsonMetaMixin, DefaultMeta):
-    """Metaclass for all models. Automatically generates a Schema and a __search_fields__ attribute for the class."""
+    """Metaclass for all models. Automatically generates a Schema and a __search_fields__ attribute for the class,
+    and an expression index for each key in __extra_indexes__."""
 
     def __init__(cls, name, bases, dict_):
         super().__init__(name, bases, dict_)
 
+        # Index lookups on keys in the extra column. Keys are inherited; an index is only created by the class
+        # that declares the key.
+        inherited = tuple(dict.fromkeys(key for base in bases for key in getattr(base, '__extra_indexes__', ())))
+        declared = tuple(key for key in dict_.get('__extra_indexes__', ()) if key not in inherited)
+        cls.__extra_indexes__ = inherited + declared
+
+        if declared:
+            table = cls.__mapper__.columns['extra'].table
+            index_names = {index.name for index in table.indexes}
+
+            for key in declared:
+                index_name = f'ix_{table.name}_{key}'
+                if index_name not in index_names:
+                    sa.Index(index_name, cls.extra[key].astext, info={'extra_key': key})
+
         search_fields = []
         for name, attr in dict_.items():
             if isinstance(attr, sa.Column):
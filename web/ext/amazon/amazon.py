@@ -1,21 +1,82 @@
 import datetime as dt
+import collections
+import dramatiq
 import dramatiq.composition as dqc
 import marshmallow as mm
 import marshmallow.fields as mmf
 
-from core import db, filter_with_json
+from core import db, filter_with_json, DateTimeField
 from ext.common import ExtActor
+from tasks.ops.common import TaskContext, DEFERRED
 from models import Vendor, Customer, Listing, ListingDetails, Inventory, Order, OrderItem, Shipment,\
-    FinancialAccount, FinancialEvent, OrderEvent, OrderItemEvent
+    FinancialAccount, FinancialEvent, OrderEvent, OrderItemEvent, SyncState
 
 from .tasks import mws, pa
-from .tasks.common import ISO_8601
+from .tasks.common import ISO_8601, paginate
 import tasks.ops as coreops
 
 
 ########################################################################################################################
 
 
+# Each import resumes from the cursor of its feed, moved back a little so that records updated while the last sync
+# was running are not missed.
+SYNC_OVERLAP = dt.timedelta(minutes=10)
+
+# Financial event groups stay open for up to two weeks, so groups that started this long before the cursor can
+# still have new events.
+FINANCIAL_GROUP_LOOKBACK = dt.timedelta(days=30)
+
+
+# How often AdvanceSync checks whether an import has finished, in seconds
+SYNC_POLL_INTERVAL = 30
+
+
+def _sync_window(vendor_id, feed):
+    """Return the time to resume a feed from (or None for a full import), and the time to record as the new cursor
+    once the import is finished. The time is taken before anything is fetched, so records that change during the
+    import are fetched again by the next one."""
+    return SyncState.cursor_for(vendor_id, feed, overlap=SYNC_OVERLAP), dt.datetime.utcnow()
+
+
+def _start_sync(context, vendor_id, feed, synced_at, *messages):
+    """Send :messages: in a new child context of :context:, and bind an AdvanceSync message for the feed to
+    :context:. It runs after the message that started the import, and waits for the child context to finish."""
+    imports = context.child(*messages, data={'vendor_id': vendor_id})
+    context.bind(AdvanceSync.message(vendor_id=vendor_id, feed=feed, synced_at=synced_at.isoformat(),
+                                     import_id=imports.id))
+    imports.send()
+
+
+class AdvanceSync(ExtActor):
+    """Move a feed's cursor forward once every message in an import's context tree has completed. If any of them
+    failed, the cursor is left alone, so the next import covers the same window again."""
+
+    class Schema(mm.Schema):
+        vendor_id = mmf.Int(required=True, title='Vendor ID')
+        feed = mmf.String(required=True, title='Feed name')
+        synced_at = DateTimeField(required=True, title='Sync time')
+        import_id = mmf.String(required=True, title='Import context ID')
+
+    def perform(self, vendor_id=None, feed=None, synced_at=None, import_id=None):
+        tree = TaskContext(id=import_id).fetch('tree')['tree']
+
+        # An empty tree means the context has expired, so there is no way to tell whether the import succeeded
+        if tree.get('errors') or not tree.get('total'):
+            return
+
+        if tree.get('completed', 0) < tree['total']:
+            msg, = self.context.get_messages(self.message_id)
+            dramatiq.get_broker().enqueue(msg, delay=SYNC_POLL_INTERVAL * 1000)
+            return DEFERRED
+
+        SyncState.advance(vendor_id, feed, synced_at)
+        db.session.commit()
+
+
+########################################################################################################################
+
+
 class ImportListing(ExtActor):
     """Import a listing specified in a JSON document. Only looks at the document's 'sku' field."""
     public = True
@@ -166,11 +227,14 @@ class ImportInventory(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
 
     def perform(self, vendor_id=None):
-        """Import any ASINs that have had inventory activity in the last 90 days."""
-        dqc.pipeline([
-            mws.ListInventorySupply.message(vendor_id=vendor_id),
-            ProcessInventory.message(vendor_id=vendor_id)
-        ]).run()
+        """Import any ASINs that have had inventory activity since the last sync, or in the last 90 days."""
+        cursor, synced_at = _sync_window(vendor_id, 'inventory')
+
+        _start_sync(
+            self.context, vendor_id, 'inventory', synced_at,
+            paginate(mws.ListInventorySupply, ProcessInventory.message(), 'docs',
+                     start=cursor.isoformat() if cursor else None)
+        )
 
 
 class ProcessInventory(ExtActor):
@@ -270,10 +334,13 @@ class ImportInboundOrders(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
 
     def perform(self, vendor_id):
-        dqc.pipeline([
-            mws.ListInboundShipments.message(vendor_id=vendor_id),
-            ProcessInboundOrders.message(vendor_id=vendor_id)
-        ]).run()
+        cursor, synced_at = _sync_window(vendor_id, 'inbound_orders')
+        window = {'updated_after': cursor.isoformat()} if cursor else {}
+
+        _start_sync(
+            self.context, vendor_id, 'inbound_orders', synced_at,
+            paginate(mws.ListInboundShipments, ProcessInboundOrders.message(), 'docs', **window)
+        )
 
 
 class ProcessInboundOrders(ExtActor):
@@ -284,14 +351,28 @@ class ProcessInboundOrders(ExtActor):
         docs = mmf.List(mmf.Dict(), required=True, title='Inbound order documents')
 
     def perform(self, vendor_id=None, docs=None):
-        for doc in docs:
-            order_id = ImportInboundOrder(doc, vendor_id=vendor_id)
-            dqc.pipeline([
-                mws.ListInboundShipmentItems.message(doc, vendor_id=vendor_id),
-                ProcessInboundOrderItems.message(vendor_id=vendor_id),
-                mws.GetTransportContent.message(doc),
-                ProcessInboundShipments.message(order_id=order_id)
-            ]).run()
+        amazon_id, = db.session.query(Vendor.id).filter_by(name='Amazon').one()
+
+        order_ids = Order.upsert_many(vendor_id, [
+            {
+                'order_number': doc['order_number'],
+                'dest_id': amazon_id,
+                'extra': {k: v for k, v in doc.items() if k != 'order_number'}
+            }
+            for doc in docs
+        ])
+        db.session.commit()
+
+        # Import the items and the transport details of each shipment in its own context
+        for order_number, order_id in order_ids.items():
+            self.context.child(
+                paginate(mws.ListInboundShipmentItems, ProcessInboundOrderItems.message(), 'docs',
+                         order_number=order_number),
+                mws.GetTransportContent.message(order_number=order_number),
+                ProcessInboundShipments.message(order_id=order_id),
+
+                data={'vendor_id': vendor_id}
+            ).send()
 
 
 class ProcessInboundOrderItems(ExtActor):
@@ -302,43 +383,70 @@ class ProcessInboundOrderItems(ExtActor):
         docs = mmf.List(mmf.Dict(), required=True, title='Order item documents')
 
     def perform(self, vendor_id=None, docs=None):
-        amazon = Vendor.query.filter_by(name='Amazon').one()
-
+        amazon_id, = db.session.query(Vendor.id).filter_by(name='Amazon').one()
+
+        # Resolve all of the vendor SKUs and Amazon FNSKUs in one query each
+        listing_ids = dict(db.session.query(Listing.sku, Listing.id).filter(
+            Listing.vendor_id == vendor_id,
+            Listing.sku.in_({doc['msku'] for doc in docs})
+        ))
+        amz_listing_ids = dict(db.session.query(Listing.extra['fnsku'].astext, Listing.id).filter(
+            Listing.vendor_id == amazon_id,
+            Listing.extra['fnsku'].astext.in_({doc['fnsku'] for doc in docs})
+        ))
+
+        resolved, missing = [], []
         for doc in docs:
-            order_number = doc.pop('order_number')
-            vendor_sku = doc.pop('msku')
-            fnsku = doc.pop('fnsku')
-
-            # Get the order
-            order = Order.query.filter_by(source_id=vendor_id, dest_id=amazon.id, order_number=order_number).first() \
-                    or Order(source_id=vendor_id, dest_id=amazon.id, order_number=order_number)
-
-            db.session.add(order)
-
-            # Get the listings
-            listing = Listing.query.filter_by(vendor_id=order.source_id, sku=vendor_sku).one()
-            amz_listing = Listing.query.filter(Listing.vendor_id == amazon.id,
-                                               Listing.extra['fnsku'].astext == fnsku).one()
-
-            # Get the inventories
-            src_inv = listing.inventory
-            dest_inv = Inventory.query.filter_by(listing_id=amz_listing.id, owner_id=listing.vendor.id).first() \
-                       or Inventory(listing=amz_listing, owner=listing.vendor)
-
-            db.session.add(dest_inv)
+            found = doc['msku'] in listing_ids and doc['fnsku'] in amz_listing_ids
+            (resolved if found else missing).append(doc)
+
+        docs = resolved
+
+        # Create any missing inventories. Items move from the vendor's listing to the vendor's inventory of the
+        # Amazon listing.
+        inventory_ids = Inventory.ensure_many(
+            pair
+            for doc in docs
+            for pair in ((vendor_id, listing_ids[doc['msku']]), (vendor_id, amz_listing_ids[doc['fnsku']]))
+        )
+
+        # Upsert the items, one statement per shipment
+        order_ids = Order.upsert_many(vendor_id, [
+            {'order_number': order_number, 'dest_id': amazon_id}
+            for order_number in {doc['order_number'] for doc in docs}
+        ])
+
+        sent = collections.defaultdict(int)
+        for order_number, order_id in order_ids.items():
+            item_docs = [
+                {
+                    'source_id': inventory_ids[(vendor_id, listing_ids[doc['msku']])],
+                    'dest_id': inventory_ids[(vendor_id, amz_listing_ids[doc['fnsku']])],
+                    'quantity': doc.get('quantity'),
+                    'received': doc.get('received'),
+                    'extra': {k: v for k, v in doc.items() if k not in ('order_number', 'msku', 'fnsku', 'quantity',
+                                                                        'received')}
+                }
+                for doc in docs if doc['order_number'] == order_number
+            ]
+            _, new = OrderItem.upsert_many(order_id, item_docs, key=('source_id', 'dest_id'))
 
-            # Get the order item
-            item = OrderItem.query.filter_by(order_id=order.id, source_id=src_inv.id, dest_id=dest_inv.id).first() \
-                   or OrderItem(order=order, source=src_inv, destination=dest_inv)
+            # New items send their inventory
+            for item_doc in item_docs:
+                if (item_doc['source_id'], item_doc['dest_id']) in new:
+                    sent[item_doc['source_id']] -= item_doc['quantity'] if item_doc['quantity'] is not None else 1
 
-            item.update(doc)
+        Inventory.adjust_fulfillable(sent)
 
-            # If this is a new order item, send_inventory()
-            if item.id is None:
-                item.send_inventory()
+        # The transport details are imported alongside the item pages, and may have been processed first. The order
+        # rows are locked by the upsert above, so ProcessInboundShipments either already committed its shipments or
+        # will see these items.
+        Shipment.assign_items(order_ids.values())
+        db.session.commit()
 
-            db.session.add(item)
-            db.session.commit()
+        if missing:
+            skus = ', '.join(f"{doc['msku']} ({doc['fnsku']})" for doc in missing)
+            raise ValueError(f'Listings not found for: {skus}')
 
 
 class ProcessInboundShipments(ExtActor):
@@ -355,7 +463,9 @@ class ProcessInboundShipments(ExtActor):
 
     def perform(self, order_id=None, docs=None):
         order_doc, shipment_docs = docs['order'], docs['shipments']
-        order = Order.query.filter_by(id=order_id).one()
+
+        # Lock the order until the shipments are committed, so that ProcessInboundOrderItems can't miss them
+        order = Order.query.filter_by(id=order_id).with_for_update().one()
         order.update(order_doc)
 
         for doc in shipment_docs:
@@ -363,14 +473,11 @@ class ProcessInboundShipments(ExtActor):
                        or Shipment(order_id=order_id)
 
             shipment.update(doc)
-
             db.session.add(shipment)
-            db.session.commit()
-
-        if len(shipment_docs) == 1:
-            for item in order.items:
-                item.shipment_id = shipment.id
 
+        # Items that haven't been imported yet are assigned by ProcessInboundOrderItems
+        db.session.flush()
+        Shipment.assign_items([order_id])
         db.session.commit()
 
 
@@ -385,10 +492,13 @@ class ImportOrders(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
 
     def perform(self, vendor_id=None):
-        dqc.pipeline([
-            mws.ListOrders.message(vendor_id=vendor_id),
-            ProcessOrders.message(vendor_id=vendor_id)
-        ]).run()
+        cursor, synced_at = _sync_window(vendor_id, 'orders')
+
+        _start_sync(
+            self.context, vendor_id, 'orders', synced_at,
+            paginate(mws.ListOrders, ProcessOrders.message(), 'orders',
+                     updated_after=cursor.strftime(ISO_8601) if cursor else None)
+        )
 
 
 class ProcessOrders(ExtActor):
@@ -398,32 +508,35 @@ class ProcessOrders(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
         orders = mmf.List(mmf.Dict(), required=True, title='Order documents')
 
-    def perform(self, vendor_id, orders):
-        amazon = Vendor.query.filter_by(name='Amazon').one()
+    def perform(self, vendor_id=None, orders=None):
+        amazon_id, = db.session.query(Vendor.id).filter_by(name='Amazon').one()
 
-        for cust_doc, order_doc in orders:
-            if 'name' in cust_doc:
-                customer = Customer.query.filter_by(name=cust_doc['name']).first() or Customer()
-                customer.update(cust_doc)
-                db.session.add(customer)
-            else:
-                customer = None
-
-            order = Order.query.filter_by(source_id=amazon.id, order_number=order_doc['order_number']).first() \
-                    or Order()
+        # Upsert the customers and orders for the whole page
+        customer_ids = Customer.upsert_many(
+            _customer_doc(doc['customer']) for doc in orders if (doc.get('customer') or {}).get('name')
+        )
 
-            order.update(order_doc)
-            order.source = amazon
-            order.destination = customer
-            order.date = dt.datetime.strptime(order_doc['date'].replace('Z', ''), ISO_8601)
+        order_ids = Order.upsert_many(amazon_id, [
+            {
+                'order_number': doc['order_number'],
+                'date': dt.datetime.strptime(doc['date'].replace('Z', ''), ISO_8601) if doc.get('date') else None,
+                'dest_id': customer_ids.get((doc.get('customer') or {}).get('name')),
+                'extra': {k: v for k, v in doc.items() if k not in ('order_number', 'date', 'customer')}
+            }
+            for doc in orders
+        ])
 
-            db.session.add(order)
-            db.session.commit()
+        db.session.commit()
 
-            dqc.pipeline([
-                mws.ListOrderItems.message(order.order_number),
-                ProcessOrderItems.message(vendor_id, order.id),
-            ]).run()
+        # Fetch the items for all of the orders in one child context. The context sends one ListOrderItems call at a
+        # time, so the calls are paced by the throttle instead of competing for the quota.
+        if order_ids:
+            self.context.child(
+                *(paginate(mws.ListOrderItems, ProcessOrderItems.message(order_id=order_id), 'items',
+                           order_number=order_number)
+                  for order_number, order_id in order_ids.items()),
+                data={'vendor_id': vendor_id}
+            ).send()
 
 
 class ProcessOrderItems(ExtActor):
@@ -435,28 +548,38 @@ class ProcessOrderItems(ExtActor):
         items = mmf.List(mmf.Dict(), required=True, title='Order item documents')
 
     def perform(self, vendor_id=None, order_id=None, items=None):
-        amazon = Vendor.query.filter_by(name='Amazon').one()
-        vendor = Vendor.query.filter_by(id=vendor_id).one()
+        amazon_id, = db.session.query(Vendor.id).filter_by(name='Amazon').one()
+
+        # Make sure the listings and the vendor's inventories exist, then upsert the items
+        listing_ids = Listing.ensure_skus(amazon_id, (doc['sku'] for doc in items))
+        inventory_ids = Inventory.ensure_many((vendor_id, listing_id) for listing_id in listing_ids.values())
+
+        OrderItem.upsert_many(order_id, [
+            {
+                'quantity': doc.get('qty_shipped') or 0,
+                'received': doc.get('qty_shipped') or 0,
+                'source_id': inventory_ids[(vendor_id, listing_ids[doc['sku']])],
+                'extra': {k: v for k, v in doc.items() if k != 'qty_shipped'}
+            }
+            for doc in items if doc.get('order_item_id')
+        ], key='order_item_id')
 
-        for item_doc in items:
-            sku = item_doc['sku']
-            amz_listing = Listing.query.filter_by(vendor_id=amazon.id, sku=sku).first() \
-                          or Listing(vendor=amazon, sku=sku)
+        db.session.commit()
 
-            item = OrderItem.query.filter(
-                OrderItem.order_id == order_id,
-                OrderItem.extra['order_item_id'].astext == item_doc['order_item_id']
-            ).first() or OrderItem(order_id=order_id)
 
-            item.quantity = item_doc.pop('qty_shipped')
-            item.received = item.quantity
-            item.source = Inventory.query.filter_by(owner_id=vendor.id, listing_id=amz_listing.id).first() \
-                          or Inventory(owner=vendor, listing=amz_listing)
-            item.destination = None
-            item.update(item_doc)
+def _customer_doc(doc):
+    """Convert a customer document from ListOrders into the format used by Customer.upsert_many()."""
+    address = doc.get('address') or {}
+    state, postal_code = address.get('state'), address.get('postal_code')
 
-            db.session.add(item)
-            db.session.commit()
+    return {
+        'name': doc['name'],
+        'email': doc.get('email'),
+        'city': address.get('city'),
+        'state': state if state and len(state) <= 2 else None,
+        'zip': postal_code[:10] if postal_code else None,
+        'extra': {'address': address} if address else {}
+    }
 
 
 ########################################################################################################################
@@ -470,10 +593,14 @@ class ImportFinancials(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
 
     def perform(self, vendor_id=None):
-        dqc.pipeline([
-            mws.ListFinancialEventGroups.message(vendor_id=vendor_id),
-            ProcessFinancialEventGroups.message(vendor_id)
-        ]).run()
+        cursor, synced_at = _sync_window(vendor_id, 'financials')
+        started_after = (cursor - FINANCIAL_GROUP_LOOKBACK).strftime(ISO_8601) if cursor else None
+
+        _start_sync(
+            self.context, vendor_id, 'financials', synced_at,
+            paginate(mws.ListFinancialEventGroups, ProcessFinancialEventGroups.message(), 'groups',
+                     started_after=started_after)
+        )
 
 
 class ProcessFinancialEventGroups(ExtActor):
@@ -483,12 +610,14 @@ class ProcessFinancialEventGroups(ExtActor):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
         groups = mmf.List(mmf.Dict(), required=True, title='Event group documents')
 
-    def perform(self, vendor_id=None, docs=None):
-        for group_doc in docs:
-            dqc.pipeline([
-                mws.ListFinancialEvents.message(group_id=group_doc['group_id'], vendor_id=vendor_id),
-                ProcessFinancialEvents.message(vendor_id, group_doc)
-            ]).run()
+    def perform(self, vendor_id=None, groups=None):
+        # Events can't be filtered by both group and posted date, so the cursor only limits which groups are listed
+        for group_doc in groups:
+            self.context.child(
+                paginate(mws.ListFinancialEvents, ProcessFinancialEvents.message(group=group_doc), 'events',
+                         group_id=group_doc['group_id']),
+                data={'vendor_id': vendor_id}
+            ).send()
 
 
 class ProcessFinancialEvents(ExtActor):
@@ -497,7 +626,7 @@ class ProcessFinancialEvents(ExtActor):
     class Schema(mm.Schema):
         vendor_id = mmf.Int(required=True, title='Vendor ID')
         group = mmf.Dict(required=True, title='Event group document')
-        events = mmf.List(mmf.Dict(), required=True, title='Financial event documents')
+        events = mmf.Dict(required=True, title='Financial event documents, by event type')
 
     def perform(self, vendor_id, group, events):
         amazon = Vendor.query.filter_by(name='Amazon').one()
@@ -520,10 +649,22 @@ class ProcessFinancialEvents(ExtActor):
         # Add to the DB
         db.session.add(event_group)
 
-        # Process ServiceFeeEvents
-        for event_doc in events['service_fee_event_list']:
-            event_desc = ', '.join(event_doc['fee_list'].keys())
-            event_net = sum(event_doc['fee_list'].values())
+        db.session.flush()
+
+        # Process ServiceFeeEvents. Load all of the group's fee events at once, instead of querying for each one.
+        existing = {
+            (type(e), _money_key(e.net), e.description): e
+            for e in FinancialEvent.query.filter_by(
+                account_id=account.id,
+                originator_id=amazon.id,
+                date=event_group.date
+            )
+        }
+
+        for event_doc in events.get('service_fee_events', []):
+            fees = event_doc.get('fees') or {}
+            event_desc = ', '.join(fees.keys())
+            event_net = sum(fees.values())
 
             # Try to guess the appropriate event type
             event_type = {
@@ -531,13 +672,8 @@ class ProcessFinancialEvents(ExtActor):
             }.get(event_desc, FinancialEvent)
 
             # Get or create the event
-            fee_event = event_type.query.filter_by(
-                account_id=account.id,
-                originator_id=amazon.id,
-                date=event_group.date,
-                net=event_net,
-                description=event_desc
-            ).first() or event_type(
+            key = (event_type, _money_key(event_net), event_desc)
+            fee_event = existing.get(key) or event_type(
                 account=account,
                 originator=amazon,
                 date=event_group.date,
@@ -562,71 +698,61 @@ class ProcessFinancialEvents(ExtActor):
                 fee_event.order = order
 
             db.session.add(fee_event)
+            existing[key] = fee_event
+
+        # Collect the item events from ShipmentEvents and RefundEvents, and upsert them all at once
+        item_docs = []
+        for event_doc in events.get('shipment_events', []):
+            posted_date = dt.datetime.strptime(event_doc['posted_date'].replace('Z', ''), ISO_8601)
+
+            for item_doc in event_doc.get('items') or []:
+                if item_doc.get('order_item_id') is None:
+                    continue
+
+                item_docs.append({
+                    'match_key': 'order_item_id',
+                    'date': posted_date,
+                    'net': _event_total(item_doc, ('charges', 'fees'), 'promotions'),
+                    'description': item_doc.get('msku'),
+                    'extra': {**item_doc, 'amazon_order_id': event_doc.get('amazon_order_id')}
+                })
+
+        for event_doc in events.get('refund_events', []):
+            posted_date = dt.datetime.strptime(event_doc['posted_date'].replace('Z', ''), ISO_8601)
+
+            for item_doc in event_doc.get('item_adjustments') or []:
+                if item_doc.get('order_adj_id') is None:
+                    continue
+
+                item_docs.append({
+                    'match_key': 'adjustment_id',
+                    'date': posted_date,
+                    'net': _event_total(item_doc, ('charge_adjustments', 'fee_adjustments'), 'promo_adjustments'),
+                    'description': f"Refund - {item_doc.get('msku')}",
+                    'extra': {
+                        **item_doc,
+                        'adjustment_id': item_doc['order_adj_id'],
+                        'amazon_order_id': event_doc.get('amazon_order_id')
+                    }
+                })
+
+        OrderItemEvent.upsert_many(item_docs, account_id=account.id, originator_id=amazon.id)
 
-        # Process ShipmentEvents
-        for event_doc in events['shipment_event_list']:
-            posted_date = dt.datetime.strptime(event_doc.pop('posted_date').replace('Z', ''), ISO_8601)
-
-            # Process ShipmentItem events
-            for item_doc in event_doc.pop('shipment_item_list', []):
-                # Get or create the event
-                item_event = OrderItemEvent.query.filter(
-                    OrderItemEvent.extra['order_item_id'].astext == item_doc['order_item_id']
-                ).first() or OrderItemEvent(
-                    account=account,
-                    originator=amazon,
-                    date=posted_date,
-                )
-
-                # Update the event
-                item_event.update(item_doc)
-                item_event.description = item_doc['msku']
-                item_event.net = sum(item_doc.get('charges', {}).values()) \
-                                 + sum(item_doc.get('fees', {}).values()) \
-                                 + sum(promo['amount'] for promo in item_doc.get('promotions', []))
-
-                # Try to attach to an OrderItem
-                item = OrderItem.query.filter(
-                    OrderItem.extra['order_item_id'].astext == item_doc['order_item_id']
-                ).first()
-
-                item_event.item = item
-
-                # Add to the DB
-                db.session.add(item_event)
-
-        # Process RefundEventList
-        for event_doc in events['refund_event_list']:
-            posted_date = dt.datetime.strptime(event_doc.get('posted_date').replace('Z', ''), ISO_8601)
+        # Commit
+        db.session.commit()
 
-            for item_doc in event_doc.pop('shipment_item_adjustment_list', []):
-                msku = item_doc['msku']
-                item_doc['amazon_order_id'] = event_doc['amazon_order_id']
 
-                # Try to get the OrderItem this event corresponds to
-                item = OrderItem.query.filter(
-                    OrderItem.order_id == Order.id,
-                    OrderItem.extra['msku'].astext == item_doc['msku']
-                ).join(Order).filter(
-                    Order.order_number == event_doc['amazon_order_id']
-                ).one_or_none()
+def _money_key(amount):
+    """Return a hashable, comparable version of a currency amount."""
+    return round(float(amount), 4) if amount is not None else None
 
-                # Get or create the event
-                item_event = OrderItemEvent.query.filter(
-                    OrderItemEvent.extra['adjustment_id'].astext == item_doc['adjustment_id']
-                ).one_or_none() or OrderItemEvent(account=account, originator=amazon)
 
-                # Update the event
-                item_event.item = item
-                item_event.update(item_doc)
-                item_event.date = posted_date
-                item_event.description = f'Refund - {msku}'
-                item_event.net = sum(item_doc.get('charge_adjustments', {}).values()) \
-                                 + sum(item_doc.get('fee_adjustments', {}).values()) \
-                                 + sum(promo['amount'] for promo in item_doc.get('promotion_adjustments', {}).values())
+def _event_total(doc, components, promotions):
+    """Return the sum of the component lists :components: and the promotions in :promotions:."""
+    total = sum(sum((doc.get(key) or {}).values()) for key in components)
 
-                # Add to the db
-                db.session.add(item_event)
+    promos = doc.get(promotions) or []
+    if isinstance(promos, dict):
+        promos = [promos]
 
-        # Commit
-        db.session.commit()
+    return total + sum(promo.get('amount') or 0 for promo in promos)
@@ -1,16 +1,23 @@
-import re
+import io
+import json
 import time
-import redis
-import requests
+import uuid
+import threading
+import dramatiq
 import amazonmws
 import attrdict
 import xmallow as xm
+import marshmallow as mm
+import marshmallow.fields as mmf
 from lxml import etree
 
 from core import app, db, search
+from tasks.broker import redis_client
+from tasks.ops.common import TaskContext, DEFERRED
 from ext.common import ExtActor
 from models import Vendor
-from config import Config
+from .throttle import QuotaEngine, RateController, limits_for
+from .transport import get_transport
 
 
 ########################################################################################################################
@@ -24,16 +31,89 @@ xm.Schema.dict_type = attrdict.AttrDict
 ########################################################################################################################
 
 
+_xml_tools = threading.local()
+
+
+def _get_parser():
+    """Returns the XML parser for the current thread. lxml parsers shouldn't be shared between threads, so each
+    thread creates its own, once."""
+    parser = getattr(_xml_tools, 'parser', None)
+    if parser is None:
+        parser = _xml_tools.parser = etree.XMLParser(remove_blank_text=True, huge_tree=True)
+
+    return parser
+
+
 def remove_namespaces(xml):
-    """Remove all traces of namespaces from the given XML string."""
-    re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
-    re_ns_open = re.compile(r'<\w+:')
-    re_ns_close = re.compile(r'/\w+:')
-    #
-    response = re_ns_decl.sub('', xml)  # Remove namespace declarations
-    response = re_ns_open.sub('<', response)  # Remove namespaces in opening tags
-    response = re_ns_close.sub('/', response)  # Remove namespaces in closing tags
-    return response
+    """Parse an XML document (bytes or str) and return its root element, with all traces of namespaces removed.
+    Tags are renamed in place, so the document is never copied or rewritten as text."""
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+
+    root = etree.fromstring(xml, parser=_get_parser())
+    strip_namespaces(root)
+    etree.cleanup_namespaces(root)
+    return root
+
+
+def local_name(tag):
+    """Return a tag name without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def strip_namespaces(element):
+    """Remove namespaces from the tags and attributes of an element and all of its descendants, in place."""
+    for el in element.iter():
+        if isinstance(el.tag, str) and el.tag.startswith('{'):
+            el.tag = local_name(el.tag)
+
+        for name in [name for name in el.attrib if name.startswith('{')]:
+            el.attrib[local_name(name)] = el.attrib.pop(name)
+
+    return element
+
+
+def parse_stream(source, records):
+    """Parse an MWS response incrementally. :records: maps result keys to (parent tag, record tag, schema) tuples;
+    each matching element is loaded with its schema as soon as it has been read, and then discarded. Tags are
+    matched without regard to namespaces, and a parent tag of None matches any parent. Returns an AttrDict with a
+    list for each key in :records:, plus the request_id, errors and next_token of the response."""
+    record_tags = {}
+    for key, (parent, tag, schema) in records.items():
+        record_tags.setdefault(tag, []).append((parent, key, schema))
+
+    results = attrdict.AttrDict({key: [] for key in records})
+    results.update(request_id=None, errors=[], next_token=None)
+    error_schema = MWSResponseSchema.Error()
+
+    tags = set(record_tags) | {'RequestId', 'Error', 'NextToken'}
+    for _, element in etree.iterparse(source, events=('end',), tag=['{*}' + tag for tag in tags]):
+        name = local_name(element.tag)
+
+        if name == 'RequestId':
+            results['request_id'] = element.text
+        elif name == 'NextToken':
+            results['next_token'] = element.text
+        elif name == 'Error':
+            results['errors'].append(error_schema.load(strip_namespaces(element)))
+        else:
+            parent = element.getparent()
+            parent_name = local_name(parent.tag) if parent is not None else None
+
+            for want_parent, key, schema in record_tags[name]:
+                if want_parent is None or want_parent == parent_name:
+                    results[key].append(schema.load(strip_namespaces(element)))
+                    break
+            else:
+                # Not a record we're interested in (a nested element with the same tag, for example)
+                continue
+
+        # Free the element, and any siblings we've already handled
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    return results
 
 
 ########################################################################################################################
@@ -97,6 +177,13 @@ class QuotaExceeded(AmazonMWSError):
     pass
 
 
+class ThrottleDelay(Exception):
+    """Raised when an API call can't be made until :delay: seconds from now."""
+    def __init__(self, delay):
+        super().__init__(delay)
+        self.delay = delay
+
+
 ########################################################################################################################
 
 
@@ -115,21 +202,18 @@ class MWSActor(ExtActor):
             return retries_so_far < 10 and isinstance(exception, (
                 RequestThrottled,
                 InternalError,
-                QuotaExceeded
+                QuotaExceeded,
+                ThrottleDelay
             ))
 
     api_name = NotImplemented
     ResponseSchema = RawXMLSchema
+    stream_records = None  # Set to a dict of (parent tag, record tag, schema) tuples to parse responses incrementally
     apis = {}
-    redis = redis.from_url(Config.REDIS_URL)
-    pending_expires = 200  # TTL for pending keys in redis. They are deliberately cleared unless something bad happens
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        # Redis script evaluator objects
-        self._usage_loader = None
-        self._usage_saver = None
+    transport = None
+    redis = redis_client
+    quota = QuotaEngine(redis_client)
+    rate = RateController(redis_client)
 
     def get_api(self, vendor_id, api_name):
         """Returns an API object for a specific vendor."""
@@ -155,18 +239,42 @@ class MWSActor(ExtActor):
             mws_keys, pa_keys = MWSActor.apis[vendor_id]['_keys']
             api_type = getattr(amazonmws, api_name)
             api_keys = pa_keys if api_name == 'ProductAdvertising' else mws_keys
-            MWSActor.apis[vendor_id][api_name] = api_type(**api_keys, make_request=requests.request)
+            MWSActor.apis[vendor_id][api_name] = api_type(**api_keys, make_request=self.get_transport())
 
         return MWSActor.apis[vendor_id][api_name]
 
+    def get_transport(self):
+        """Returns the function used to send HTTP requests, as selected by the MWS_TRANSPORT setting."""
+        if MWSActor.transport is None:
+            MWSActor.transport = get_transport(app.config)
+
+        return MWSActor.transport
+
     def build_params(self, *args, **kwargs):
         """Return a dictionary of parameters to send to the API call."""
         return dict()
 
     def perform(self, *args, **kwargs):
-        params = self.build_params(*args, **kwargs)
-        response = self.make_api_call(type(self).__name__, **params)
-        return self.process_response(args, kwargs, response)
+        try:
+            params = self.build_params(*args, **kwargs)
+            response = self.make_api_call(type(self).__name__, **params)
+            return self.process_response(args, kwargs, response)
+        except ThrottleDelay as e:
+            return self.defer(e)
+
+    def defer(self, delay):
+        """Re-enqueue this actor's message to run after a delay, instead of blocking the worker. :delay: is a number
+        of seconds, or a ThrottleDelay exception. Messages that don't belong to a context can't be re-enqueued; for
+        those a ThrottleDelay is raised, and the message is retried by dramatiq."""
+        if not isinstance(delay, ThrottleDelay):
+            delay = ThrottleDelay(delay)
+
+        if not self.bound:
+            raise delay
+
+        msg, = self.context.get_messages(self.message_id)
+        dramatiq.get_broker().enqueue(msg, delay=int(delay.delay * 1000))
+        return DEFERRED
 
     def make_api_call(self, action, throttle_action=None, **params):
         """Make an API call and return an AmzXmlResponse object."""
@@ -174,45 +282,26 @@ class MWSActor(ExtActor):
         api_name = self.api_name
         vendor_id = self.context['vendor_id']
 
-        # Load the throttle limits for this API call
-        default_limits = {'quota_max': 1, 'restore_rate': 1}
-        limits = amazonmws.DEFAULT_LIMITS.get(throttle_action, default_limits)
-
-        # Load the current usage for this action
-        usage = self.load_usage(vendor_id, throttle_action, limits)
-
-        # Sleep for the appropriate amount of time
-        time.sleep(self.calculate_wait(usage, limits))
+        # If the quota isn't available, let the caller reschedule. The quota is restored at the rate
+        # set by the rate controller.
+        limits = limits_for(throttle_action)
+        wait = self.quota.acquire(vendor_id, throttle_action, limits)
+        if wait > 0:
+            raise ThrottleDelay(wait)
 
-        # Load the elastic delay
-        stretch = self.redis.get(f'{throttle_action}_{vendor_id}_stretch')
-        stretch = float(stretch) if stretch else 0
-        time.sleep(stretch)
-
-        # Make the API call
+        # Make the API call and parse the response
         api = self.get_api(vendor_id, api_name)
-        xml = getattr(api, action)(**params).text
-
-        # Save usage
-        self.save_usage(vendor_id, throttle_action, limits)
-
-        # Parse the response
-        xml = remove_namespaces(xml)
-        response = self.ResponseSchema().load(xml)
+        response = self.parse_response(getattr(api, action)(**params))
 
         # Raise an exception if needed
         if response.errors:
             error = response.errors[0]
 
             if error.code == 'RequestThrottled':
-                sleep = stretch + limits['restore_rate']
-                expires = int(sleep * 10 * 1000)
-                self.redis.set(
-                    f'{throttle_action}_{vendor_id}_stretch',
-                    sleep,
-                    px=expires
-                )
-                raise RequestThrottled(**error)
+                # Slow down, and try again once the quota allows it
+                self.rate.throttled(vendor_id, throttle_action)
+                wait = self.quota.predict_wait(vendor_id, throttle_action, limits)
+                raise ThrottleDelay(wait or limits['restore_rate'] / self.rate.factor(vendor_id, throttle_action))
 
             elif error.code == 'QuotaExceeded':
                 raise QuotaExceeded(**error)
@@ -220,99 +309,356 @@ class MWSActor(ExtActor):
             elif error.code == 'InternalError':
                 InternalError(**error)
 
+        self.rate.succeeded(vendor_id, throttle_action)
         return response
 
-    def load_usage(self, vendor_id, action, limits):
-        """Load usage for this operation type, and increment the pending counter for this operation."""
-        usage_key = f'{action}_{vendor_id}_usage'
-        now = time.monotonic()
-        restore_rate = limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        if self._usage_loader is None:
-            script = f"""
-            local usage = redis.call('HMGET', KEYS[1], 'quota_level', 'pending', 'last_request')
-            local quota_level = true and tonumber(usage[1]) or 0
-            local pending = true and tonumber(usage[2]) or 0
-            local last_request = true and tonumber(usage[3]) or 0
-            local restored = 0
-
-            if last_request > 0 then
-                restored = (tonumber(ARGV[1]) - last_request) / tonumber(ARGV[2])
-                quota_level = math.max(quota_level - restored, 0)
-                redis.call('HSET', KEYS[1], 'quota_level', quota_level)
-            end
-
-            redis.call('HINCRBY', KEYS[1], 'pending', 1)
-            redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
-
-            return {{tostring(quota_level), pending, tostring(last_request), tostring(restored)}}
-            """
-
-            # KEYS = {usage_key}
-            # ARGV = {now, restore_rate, pending_expires}
-
-            self._usage_loader = self.redis.register_script(script)
-
-        values = self._usage_loader(
-            keys=(usage_key,),
-            args=[str(arg) for arg in (now, restore_rate, self.pending_expires)]
-        )
-
-        return {
-            'quota_level': float(values[0]),
-            'pending': int(values[1]),
-            'last_request': float(values[2])
-        }
-
-    def save_usage(self, vendor_id, action, limits):
-        """Update the usage stats in the cache."""
-        usage_key = f'{action}_{vendor_id}_usage'
-        now = time.monotonic()
-        restore_rate = limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        if self._usage_saver is None:
-            script = f"""
-                    local usage = redis.call('HMGET', KEYS[1], 'quota_level', 'last_request')
-                    local quota_level = true and tonumber(usage[1]) or 0
-                    local last_request = true and tonumber(usage[2]) or 0
-                    local restored = 0
-
-                    if last_request > 0 then
-                        local restored = (tonumber(ARGV[1]) - last_request) / tonumber(ARGV[2])
-                        quota_level = math.max(quota_level - restored, 0)
-                        redis.call('HSET', KEYS[1], 'quota_level', quota_level + 1)
-                    end
-
-                    redis.call('HINCRBY', KEYS[1], 'pending', -1)
-                    redis.call('HSET', KEYS[1], 'last_request', tonumber(ARGV[1]))
-
-                    return {{tostring(restored), tostring(last_request)}}
-                    """
-
-            # KEYS = {usage_key}
-            # ARGS = {now, restore_rate}
-
-            self._usage_saver = self.redis.register_script(script)
-
-        self._usage_saver(
-            keys=(usage_key,),
-            args=[str(arg) for arg in (now, restore_rate)]
-        )
+    def parse_response(self, http_response):
+        """Parse the HTTP response from an API call. If the actor declares stream_records, the response body is
+        parsed incrementally as it is downloaded."""
+        if self.stream_records:
+            if http_response.raw is None or getattr(http_response, '_content_consumed', False):
+                source = io.BytesIO(http_response.content)
+            else:
+                source = http_response.raw
+                source.decode_content = True
 
-    def calculate_wait(self, usage, limits):
-        """Calculate how long to sleep() before making the API call."""
-        quota_max = limits['quota_max']
-        restore_rate = limits['restore_rate']
-        quota_level = usage['quota_level']
-        pending = usage['pending']
+            return parse_stream(source, self.stream_records)
 
-        return max((quota_level + pending + 1 - quota_max), 0) * restore_rate
+        root = remove_namespaces(http_response.content)
+        return self.ResponseSchema().load(root)
 
     def process_response(self, args, kwargs, response):
         """Return the parsed version of the response."""
         return response
 
+
+
+########################################################################################################################
+
+
+def paginate(actor, then, then_key, **kwargs):
+    """Return a message for a PagedMWSActor that sends each page of results to :then:, in a new child context with
+    the page stored under :then_key:."""
+    return actor.message(then=dict(then.asdict()), then_key=then_key, **kwargs)
+
+
+class PagedMWSActor(MWSActor):
+    """Base class for MWS list calls that return their results in pages. When the message includes a :then: message
+    and is sent from a context, each page is handed downstream as soon as it has been parsed: :then: is sent in a
+    new child context, with the page's records stored under :then_key:. If there is another page, a message to fetch
+    it is bound to the context, so the next page is fetched while the previous one is being processed. Otherwise,
+    every page is fetched and the combined results are returned."""
+
+    class Meta(MWSActor.Meta):
+        abstract = True
+
+    class Schema(mm.Schema):
+        """Paging parameters, shared by all paged actors."""
+        then = mmf.Dict(missing=None, title='Message to send each page to')
+        then_key = mmf.String(missing=None, title='Context key for each page')
+        next_token = mmf.String(missing=None, title='Next token')
+
+    page_key = 'items'
+
+    def page_records(self, response):
+        """Return the records in one page of the response."""
+        return response[self.page_key]
+
+    def merge_pages(self, pages):
+        """Combine the records from several pages."""
+        return [record for page in pages for record in page]
+
+    def fetch_page(self, next_token=None, **kwargs):
+        """Fetch the first page of results, or the page for :next_token:."""
+        action = type(self).__name__
+
+        if next_token:
+            return self.make_api_call(f'{action}ByNextToken', throttle_action=action, NextToken=next_token)
+
+        return self.make_api_call(action, **self.build_params(**kwargs))
+
+    def perform(self, then=None, then_key=None, next_token=None, **kwargs):
+        try:
+            response = self.fetch_page(next_token, **kwargs)
+
+            if then is None or not self.bound:
+                return self.process_response((), kwargs, self.collect_pages(response))
+
+            self.send_page(then, then_key, response)
+            return None
+        except ThrottleDelay as e:
+            return self.defer(e)
+
+    def collect_pages(self, response):
+        """Fetch every remaining page, and return the combined records."""
+        pages = [self.page_records(response)]
+
+        while response.next_token:
+            response = self.fetch_page(response.next_token)
+            pages.append(self.page_records(response))
+
+        return self.merge_pages(pages)
+
+    def send_page(self, then, then_key, response):
+        """Send :then: with one page of records, and bind a message for the next page to our context."""
+        page_msg = dramatiq.Message(**then).copy(
+            message_id=str(uuid.uuid4()),
+            message_timestamp=int(time.time() * 1000)
+        )
+        data = {then_key: self.page_records(response), 'vendor_id': self.context['vendor_id']}
+        self.context.child(page_msg, data=data).send()
+
+        if response.next_token:
+            msg, = self.context.get_messages(self.message_id)
+            next_msg = msg.copy(
+                message_id=str(uuid.uuid4()),
+                message_timestamp=int(time.time() * 1000),
+                kwargs={'then': then, 'then_key': then_key, 'next_token': response.next_token}
+            )
+            self.context.bind(next_msg)
+
+
+########################################################################################################################
+
+
+# Each batch key has four Redis keys: the queue of waiting requests, the ID of the leader's message, the requests
+# the leader is currently processing, and the set of message IDs that have a request queued or in process. Requests
+# stay in the processing list until the leader acknowledges them, so a batch drained by a leader that died can be
+# put back on the queue by the next leader.
+_BATCH_RESTORE = """
+local function restore(queue, processing)
+    local stale = redis.call('LRANGE', processing, 0, -1)
+    for i = #stale, 1, -1 do
+        redis.call('LPUSH', queue, stale[i])
+    end
+    redis.call('DEL', processing)
+end
+"""
+
+# Returns 2 if the caller already leads the batch, 1 if it just became the leader, or 0 if another worker leads it.
+# A message's request is only queued once, even if the message is delivered again.
+# KEYS = {queue, leader, processing, members}
+# ARGV = {request, message ID, leader expiration (ms)}
+_BATCH_ENQUEUE_SCRIPT = _BATCH_RESTORE + """
+if redis.call('GET', KEYS[2]) == ARGV[2] then
+    restore(KEYS[1], KEYS[3])
+    return 2
+end
+
+if redis.call('SADD', KEYS[4], ARGV[2]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+
+if redis.call('SET', KEYS[2], ARGV[2], 'NX', 'PX', ARGV[3]) then
+    restore(KEYS[1], KEYS[3])
+    return 1
+end
+return 0
+"""
+
+# KEYS = {queue, processing}
+# ARGV = {batch size}
+_BATCH_DRAIN_SCRIPT = """
+local size = tonumber(ARGV[1])
+local batch = redis.call('LRANGE', KEYS[1], 0, size - 1)
+redis.call('LTRIM', KEYS[1], size, -1)
+if #batch > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(batch))
+end
+return batch
+"""
+
+# KEYS = {processing, members}
+# ARGV = {message IDs of the processed requests...}
+_BATCH_ACK_SCRIPT = """
+redis.call('DEL', KEYS[1])
+if #ARGV > 0 then
+    redis.call('SREM', KEYS[2], unpack(ARGV))
+end
+"""
+
+# Called when processing a batch fails. Everyone else's requests are put back at the front of the queue. If the
+# leader will retry soon (ARGV[3] == '1'), it keeps its request and the leadership. Otherwise its request is
+# dropped, and leadership passes to the first request in the queue, whose encoded request is returned so that its
+# message can be sent again.
+# KEYS = {queue, leader, processing, members}
+# ARGV = {leader message ID, leader expiration (ms), keep leadership}
+_BATCH_FAIL_SCRIPT = _BATCH_RESTORE + """
+if ARGV[3] == '1' then
+    restore(KEYS[1], KEYS[3])
+    redis.call('PEXPIRE', KEYS[2], ARGV[2])
+    return false
+end
+
+local batch = redis.call('LRANGE', KEYS[3], 0, -1)
+redis.call('DEL', KEYS[3])
+for i = #batch, 1, -1 do
+    if cjson.decode(batch[i])['msg_id'] ~= ARGV[1] then
+        redis.call('LPUSH', KEYS[1], batch[i])
+    end
+end
+redis.call('SREM', KEYS[4], ARGV[1])
+
+local head = redis.call('LINDEX', KEYS[1], 0)
+if not head then
+    redis.call('DEL', KEYS[2])
+    return false
+end
+
+redis.call('SET', KEYS[2], cjson.decode(head)['msg_id'], 'PX', ARGV[2])
+return head
+"""
+
+# KEYS = {queue, leader}
+# ARGV = {leader expiration (ms)}
+_BATCH_RELEASE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('PEXPIRE', KEYS[2], ARGV[1])
+    return 1
+end
+redis.call('DEL', KEYS[2])
+return 0
+"""
+
+
+class BatchMWSActor(MWSActor):
+    """Base class for MWS calls that accept several items per request. When called from a context, requests are
+    queued in Redis. The first worker to queue a request becomes the leader: it re-enqueues its message to run after
+    the batch window, then makes one API call for up to batch_size requests, and completes each request's message
+    in its own context. Other workers return immediately.
+
+    If the leader is throttled, it puts the batch back and tries again later. If it fails for any other reason,
+    leadership is handed to the next queued request, whose message is sent again. If the leader dies, its message is
+    delivered again by the broker, and it (or the next leader, once the leadership expires) puts the unfinished batch
+    back on the queue."""
+
+    class Meta(MWSActor.Meta):
+        abstract = True
+
+    batch_size = 20
+    batch_window = 1  # Seconds to wait for other requests before making the call
+    leader_expires = 60  # Maximum time a leader can hold the batch, in seconds
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._batch_scripts = {}
+
+    def _run_batch_script(self, name, keys=(), args=()):
+        """Run one of the batching scripts."""
+        if name not in self._batch_scripts:
+            source = {
+                'enqueue': _BATCH_ENQUEUE_SCRIPT,
+                'drain': _BATCH_DRAIN_SCRIPT,
+                'ack': _BATCH_ACK_SCRIPT,
+                'fail': _BATCH_FAIL_SCRIPT,
+                'release': _BATCH_RELEASE_SCRIPT
+            }[name]
+            self._batch_scripts[name] = self.redis.register_script(source)
+
+        return self._batch_scripts[name](keys=keys, args=args)
+
+    def batch_key(self, **kwargs):
+        """Return the key for the batch this request belongs to. Requests in the same batch must be able to share
+        a single API call."""
+        return f'{type(self).__name__}_{self.context["vendor_id"]}_{kwargs.get("market_id")}_batch'
+
+    def build_batch_params(self, requests):
+        """Return the parameters for an API call covering all of :requests:, a list of keyword argument dicts."""
+        raise NotImplementedError
+
+    def split_response(self, requests, response):
+        """Return a list with the part of :response: that belongs to each of :requests:, in the same order. Items
+        missing from the response should be None."""
+        raise NotImplementedError
+
+    def perform(self, **kwargs):
+        try:
+            if not self.bound:
+                response = self.call_batch([kwargs])
+                return self.process_response((), kwargs, response[0])
+
+            return self.perform_batch(**kwargs)
+        except ThrottleDelay as e:
+            return self.defer(e)
+
+    def perform_batch(self, **kwargs):
+        """Queue this request. If we lead the batch, wait for the batch window by re-enqueueing our own message,
+        then process everything in the queue."""
+        keys = self.batch_keys(**kwargs)
+        queue_key, leader_key, processing_key, members_key = keys
+        leader_ms = int(self.leader_expires * 1000)
+        request = json.dumps({'ctx': self.context.id, 'msg_id': self.message_id, 'kwargs': kwargs})
+
+        joined = self._run_batch_script('enqueue', keys=keys, args=(request, self.message_id, leader_ms))
+        if joined == 0:
+            # Another worker is collecting this batch, it will process our request, too
+            return DEFERRED
+        elif joined == 1:
+            return self.defer(self.batch_window)
+
+        while True:
+            batch = self._run_batch_script('drain', keys=(queue_key, processing_key), args=(self.batch_size,))
+
+            if batch:
+                items = [json.loads(item) for item in batch]
+
+                try:
+                    self.process_batch(items)
+                except ThrottleDelay:
+                    # Keep the batch and the leadership, and try again when the quota allows it
+                    self._run_batch_script('fail', keys=keys, args=(self.message_id, leader_ms, '1'))
+                    raise
+                except Exception:
+                    # Give the batch to the next request in line; ours is queued again if our message is retried
+                    self.hand_off(self._run_batch_script('fail', keys=keys, args=(self.message_id, leader_ms, '0')))
+                    raise
+
+                self._run_batch_script('ack', keys=(processing_key, members_key),
+                                       args=[item['msg_id'] for item in items])
+
+            if not self._run_batch_script('release', keys=(queue_key, leader_key), args=(leader_ms,)):
+                break
+
+        return DEFERRED
+
+    def batch_keys(self, **kwargs):
+        """Return the queue, leader, processing and members keys for the batch this request belongs to."""
+        key = self.batch_key(**kwargs)
+        return key + '_queue', key + '_leader', key + '_processing', key + '_members'
+
+    def hand_off(self, request):
+        """Send the message for a queued request again, after the batch window, so that it can lead the batch."""
+        if request is None:
+            return
+
+        item = json.loads(request)
+        messages = TaskContext(id=item['ctx']).get_messages(item['msg_id'])
+
+        for msg in messages:
+            dramatiq.get_broker().enqueue(msg, delay=int(self.batch_window * 1000))
+
+    def call_batch(self, requests):
+        """Make a single API call for :requests:, and return a list of the responses for each request."""
+        params = self.build_batch_params(requests)
+        response = self.make_api_call(type(self).__name__, **params)
+        return self.split_response(requests, response)
+
+    def process_batch(self, batch):
+        """Make an API call for a batch of queued requests, and complete each request in its context."""
+        own_context = self.context
+        responses = self.call_batch([item['kwargs'] for item in batch])
+
+        try:
+            for item, response in zip(batch, responses):
+                context = own_context if item['ctx'] == own_context.id else TaskContext(id=item['ctx'])
+                self.context = context
+
+                try:
+                    self.process_response((), item['kwargs'], response)
+                except Exception as e:
+                    context.log_error(item['msg_id'], str(e))
+                else:
+                    context.complete(item['msg_id'])
+                    context.send()
+        finally:
+            self.context = own_context
@@ -6,7 +6,7 @@ import marshmallow.fields as mmf
 import core
 import xmallow as xm
 import amazonmws as mws
-from .common import ISO_8601, MWSActor, MWSResponseSchema, RawXMLSchema
+from .common import ISO_8601, MWSActor, BatchMWSActor, PagedMWSActor, MWSResponseSchema, RawXMLSchema
 
 
 ########################################################################################################################
@@ -81,8 +81,9 @@ class ListMatchingProducts(MWSActor):
 ########################################################################################################################
 
 
-class GetMyFeesEstimate(MWSActor):
-    """Fetch estimated fulfillment fees for a given product."""
+class GetMyFeesEstimate(BatchMWSActor):
+    """Fetch estimated fulfillment fees for a given product. Requests from different contexts are combined into
+    calls of up to 20 estimates."""
     api_name = 'Products'
 
     class Schema(mm.Schema):
@@ -103,35 +104,48 @@ class GetMyFeesEstimate(MWSActor):
 
     class ResponseSchema(MWSResponseSchema):
         """Response schema for GetMyFeesEstimate."""
-        status = xm.String('.//Status')
-        selling_fees = xm.Float('.//TotalFeesEstimate/Amount', default=None)
-
-    def build_params(self, listing=None, market_id=None):
-        try:
-            price = str(listing['price'])
-        except (KeyError, ValueError, TypeError):
-            price = '0'
-
-        # Allow two-letter marketplace abbreviations
-        return mws.structured_list(
-            'FeesEstimateRequestList', 'FeesEstimateRequest',
-            [
-                {
-                    'MarketplaceId': market_id if len(market_id) > 2 else mws.MARKETID[market_id],
-                    'IdType': 'ASIN',
-                    'IdValue': listing['sku'],
-                    'IsAmazonFulfilled': 'true',
-                    'Identifier': 'request1',
-                    'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
-                    'PriceToEstimateFees.ListingPrice.Amount': price
-                }
-            ]
-        )
+
+        class FeesEstimateSchema(xm.Schema):
+            ignore_missing = True
+
+            identifier = xm.String('.//SellerInputIdentifier')
+            status = xm.String('./Status')
+            selling_fees = xm.Float('.//TotalFeesEstimate/Amount', default=None)
+
+        results = xm.Field('//FeesEstimateResult', FeesEstimateSchema(), many=True, default=list)
+
+    def build_batch_params(self, requests):
+        estimates = []
+
+        for idx, request in enumerate(requests):
+            listing, market_id = request['listing'], request['market_id']
+
+            try:
+                price = str(listing['price'])
+            except (KeyError, ValueError, TypeError):
+                price = '0'
+
+            # Allow two-letter marketplace abbreviations
+            estimates.append({
+                'MarketplaceId': market_id if len(market_id) > 2 else mws.MARKETID[market_id],
+                'IdType': 'ASIN',
+                'IdValue': listing['sku'],
+                'IsAmazonFulfilled': 'true',
+                'Identifier': f'request{idx + 1}',
+                'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
+                'PriceToEstimateFees.ListingPrice.Amount': price
+            })
+
+        return mws.structured_list('FeesEstimateRequestList', 'FeesEstimateRequest', estimates)
+
+    def split_response(self, requests, response):
+        results = {result.identifier: result for result in response.results}
+        return [results.get(f'request{idx + 1}') for idx in range(len(requests))]
 
     def process_response(self, args, kwargs, response):
         doc = kwargs['listing']
 
-        if response['status'] == 'Success':
+        if response is not None and response['status'] == 'Success':
             doc['selling_fees'] = response['selling_fees']
 
         self.context['listing'] = doc
@@ -141,8 +155,9 @@ class GetMyFeesEstimate(MWSActor):
 ########################################################################################################################
 
 
-class GetCompetitivePricingForASIN(MWSActor):
-    """Get pricing information for a given listing."""
+class GetCompetitivePricingForASIN(BatchMWSActor):
+    """Get pricing information for a given listing. Requests from different contexts are combined into calls of
+    up to 20 ASINs."""
     api_name = 'Products'
 
     class Schema(mm.Schema):
@@ -162,26 +177,40 @@ class GetCompetitivePricingForASIN(MWSActor):
 
     class ResponseSchema(MWSResponseSchema):
         """Response schema for GetCompetitivePricingForASIN."""
-        success = xm.Attribute('//GetCompetitivePricingForASINResult', attr='status')
-        listing_price = xm.Float('.//ListingPrice/Amount', default=0)
-        shipping = xm.Float('.//Shipping/Amount', default=0)
-        landed_price = xm.Float('.//LandedPrice/Amount', default=0)
-        offers = xm.Int('.//OfferListingCount[@condition="New"]', default=0)
 
-        def post_load(self, data):
-            data.success = data.success == 'Success'
-            return data
+        class PricingSchema(xm.Schema):
+            ignore_missing = True
+
+            sku = xm.Attribute('.', attr='ASIN')
+            success = xm.Attribute('.', attr='status')
+            listing_price = xm.Float('.//ListingPrice/Amount', default=0)
+            shipping = xm.Float('.//Shipping/Amount', default=0)
+            landed_price = xm.Float('.//LandedPrice/Amount', default=0)
+            offers = xm.Int('.//OfferListingCount[@condition="New"]', default=0)
+
+            def post_load(self, data):
+                data.success = data.success == 'Success'
+                return data
+
+        results = xm.Field('//GetCompetitivePricingForASINResult', PricingSchema(), many=True, default=list)
+
+    def build_batch_params(self, requests):
+        market_id = requests[0]['market_id']
+        skus = list(dict.fromkeys(request['listing']['sku'] for request in requests))
 
-    def build_params(self, listing=None, market_id=None):
         return {
             'MarketplaceId': market_id if len(market_id) > 2 else mws.MARKETID[market_id],
-            **mws.structured_list('ASINList', 'ASIN', [listing['sku']]),
+            **mws.structured_list('ASINList', 'ASIN', skus),
         }
 
+    def split_response(self, requests, response):
+        results = {result.sku: result for result in response.results}
+        return [results.get(request['listing']['sku']) for request in requests]
+
     def process_response(self, args, kwargs, response):
         listing = kwargs['listing']
 
-        if response.success:
+        if response is not None and response.success:
             listing['offers'] = response.offers
             price = response.landed_price or (response.listing_price + response.shipping)
             if price:
@@ -195,10 +224,10 @@ class GetCompetitivePricingForASIN(MWSActor):
 ########################################################################################################################
 
 
-class ListInventorySupply(MWSActor):
+class ListInventorySupply(PagedMWSActor):
     api_name = 'FulfillmentInventory'
 
-    class Schema(mm.Schema):
+    class Schema(PagedMWSActor.Schema):
         """Parameter schema for ListInventorySupply."""
         seller_skus = mmf.List(mmf.String(), missing=None, title='Seller SKUs')
         start = core.DateTimeField(missing=None, title='Start date')
@@ -219,9 +248,15 @@ class ListInventorySupply(MWSActor):
         items = xm.Field('.//member', SupplySchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
+    stream_records = {
+        'items': ('InventorySupplyList', 'member', ResponseSchema.SupplySchema())
+    }
+
     def build_params(self, *, seller_skus=None, start=None, market_id='US'):
         if seller_skus is None and start is None:
             start = datetime.utcnow() - timedelta(days=90)
+
+        if isinstance(start, datetime):
             start = start.strftime(ISO_8601)
 
         if seller_skus and start:
@@ -237,28 +272,15 @@ class ListInventorySupply(MWSActor):
 
         return params
 
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-            results.extend(response['items'])
-
-            response = self.make_api_call(
-                'ListInventorySupplyByNextToken',
-                throttle_action='ListInventorySupply',
-                NextToken=response.next_token
-            ) if response.next_token else None
-
-        return results
-
 
 ########################################################################################################################
 
 
-class ListInboundShipments(MWSActor):
+class ListInboundShipments(PagedMWSActor):
     """Fetch data on shipment from a vendor into FBA inventory."""
     api_name = 'FulfillmentInboundShipment'
 
-    class Schema(mm.Schema):
+    class Schema(PagedMWSActor.Schema):
         """Parameter schema for ListInboundShipments."""
         status = mmf.List(mmf.String(), title='List of statuses.', missing=('WORKING', 'SHIPPED', 'IN_TRANSIT',
                                                                             'DELIVERED', 'CHECKED_IN', 'RECEIVING',
@@ -291,11 +313,15 @@ class ListInboundShipments(MWSActor):
         items = xm.Field('.//member', ShipmentSchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
-    def build_params(self, *, status=None, shipment_id=None, updated_after=None, updated_before=None):
+    stream_records = {
+        'items': ('ShipmentData', 'member', ResponseSchema.ShipmentSchema())
+    }
+
+    def build_params(self, *, status=None, shipment_ids=None, updated_after=None, updated_before=None):
         status_list = mws.structured_list('ShipmentStatusList', 'member', status)
 
-        shipment_id = [shipment_id] if isinstance(shipment_id, str) else shipment_id
-        shipment_id_list = mws.structured_list('ShipmentIdList', 'member', shipment_id) if shipment_id else {}
+        shipment_ids = [shipment_ids] if isinstance(shipment_ids, str) else shipment_ids
+        shipment_id_list = mws.structured_list('ShipmentIdList', 'member', shipment_ids) if shipment_ids else {}
 
         return {k: v for k, v in {
             'LastUpdatedAfter': updated_after.strftime(ISO_8601),
@@ -304,25 +330,16 @@ class ListInboundShipments(MWSActor):
             **shipment_id_list
         }.items() if v is not None}
 
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-            results.extend(response['items'])
-
-            next_token = response.next_token
-            response = self.make_api_call(
-                'ListInboundShipmentsByNextToken',
-                throttle_action='ListInboundShipments',
-                NextToken=next_token
-            ) if next_token else None
-
-        return results
-
 
 ########################################################################################################################
 
 
-class ListInboundShipmentItems(MWSActor):
+class ListInboundShipmentItems(PagedMWSActor):
+    api_name = 'FulfillmentInboundShipment'
+
+    class Schema(PagedMWSActor.Schema):
+        """Parameter schema for ListInboundShipmentItems."""
+        order_number = mmf.String(missing=None, title='Shipment ID')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -343,32 +360,23 @@ class ListInboundShipmentItems(MWSActor):
         items = xm.Field('.//member', ShipmentSchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
-    def api_name(self):
-        return 'FulfillmentInboundShipment'
+    stream_records = {
+        'items': ('ItemData', 'member', ResponseSchema.ShipmentSchema())
+    }
 
-    def build_params(self, *args, **kwargs):
-        doc = args[0] if args else kwargs['doc']
-        return {'ShipmentId': doc['order_number']}
-
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-            results.extend(response['items'])
-
-            next_token = response.next_token
-            response = self.make_api_call(
-                'ListInboundShipmentItemsByNextToken',
-                throttle_action='ListInboundShipmentItems',
-                NextToken=next_token
-            ) if next_token else None
-
-        return results
+    def build_params(self, order_number=None):
+        return {'ShipmentId': order_number}
 
 
 ########################################################################################################################
 
 
 class GetTransportContent(MWSActor):
+    api_name = 'FulfillmentInboundShipment'
+
+    class Schema(mm.Schema):
+        """Parameter schema for GetTransportContent."""
+        order_number = mmf.String(required=True, title='Shipment ID')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -391,12 +399,8 @@ class GetTransportContent(MWSActor):
         transport_status = xm.String('.//TransportStatus', required=True)
         packages = xm.Field('//member', PackageSchema(), many=True, default=list)
 
-    def api_name(self):
-        return 'FulfillmentInboundShipment'
-
-    def build_params(self, *args, **kwargs):
-        doc = args[0] if args else kwargs.pop('doc')
-        return {'ShipmentId': doc['order_number']}
+    def build_params(self, order_number=None):
+        return {'ShipmentId': order_number}
 
     def process_response(self, args, kwargs, response):
         order_doc = {
@@ -405,16 +409,28 @@ class GetTransportContent(MWSActor):
         }
         results = response.packages
 
-        return {
+        docs = {
             'order': order_doc,
             'shipments': results
         }
+        self.context['docs'] = docs
+        return docs
 
 
 ########################################################################################################################
 
 
-class ListOrders(MWSActor):
+class ListOrders(PagedMWSActor):
+    api_name = 'Orders'
+
+    class Schema(PagedMWSActor.Schema):
+        """Parameter schema for ListOrders."""
+        created_after = mmf.String(missing=None, title='Created after')
+        created_before = mmf.String(missing=None, title='Created before')
+        updated_after = mmf.String(missing=None, title='Updated after')
+        updated_before = mmf.String(missing=None, title='Updated before')
+        order_status = mmf.List(mmf.String(), missing=None, title='Order statuses')
+        market_id = mmf.List(mmf.String(), missing=['US'], title='Market IDs')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -446,11 +462,15 @@ class ListOrders(MWSActor):
                 email = xm.String('.//BuyerEmail')
                 address = xm.Field('.//ShippingAddress', AddressSchema())
 
+            customer = xm.Field('.', CustomerSchema())
+
         orders = xm.Field('.//Order', OrderSchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
-    def api_name(self):
-        return 'Orders'
+    stream_records = {
+        'orders': ('Orders', 'Order', ResponseSchema.OrderSchema())
+    }
+    page_key = 'orders'
 
     def build_params(self, *, created_after=None, created_before=None, updated_after=None, updated_before=None,
                      order_status=None, market_id=('US',), **kwargs):
@@ -473,30 +493,12 @@ class ListOrders(MWSActor):
 
         return params
 
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-
-            # TODO: Update users of this actor to accept the new response format
-            results.extend(response.orders)
-
-            token = response.next_token
-            response = self.make_api_call(
-                'ListOrdersByNextToken',
-                throttle_action='ListOrders',
-                NextToken=token
-            ) if token else None
-
-        return results
-
 
 ########################################################################################################################
 
 
 class GetOrder(MWSActor):
-
-    def api_name(self):
-        return 'Orders'
+    api_name = 'Orders'
 
     def build_params(self, amz_order_ids):
         return {
@@ -507,7 +509,12 @@ class GetOrder(MWSActor):
 ########################################################################################################################
 
 
-class ListOrderItems(MWSActor):
+class ListOrderItems(PagedMWSActor):
+    api_name = 'Orders'
+
+    class Schema(PagedMWSActor.Schema):
+        """Parameter schema for ListOrderItems."""
+        order_number = mmf.String(missing=None, title='Amazon order ID')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -527,31 +534,24 @@ class ListOrderItems(MWSActor):
         items = xm.Field('.//OrderItem', OrderItemSchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
-    def api_name(self):
-        return 'Orders'
+    stream_records = {
+        'items': ('OrderItems', 'OrderItem', ResponseSchema.OrderItemSchema())
+    }
 
-    def build_params(self, order_number):
+    def build_params(self, order_number=None):
         return {'AmazonOrderId': order_number}
 
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-            results.extend(response['items'])
-
-            token = response.next_token
-            response = self.make_api_call(
-                'ListOrderItemsByNextToken',
-                throttle_action='ListOrderItems',
-                NextToken=token
-            ) if token else None
-
-        return results
-
 
 ########################################################################################################################
 
 
-class ListFinancialEventGroups(MWSActor):
+class ListFinancialEventGroups(PagedMWSActor):
+    api_name = 'Finances'
+
+    class Schema(PagedMWSActor.Schema):
+        """Parameter schema for ListFinancialEventGroups."""
+        started_after = mmf.String(missing=None, title='Started after')
+        started_before = mmf.String(missing=None, title='Started before')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -573,8 +573,10 @@ class ListFinancialEventGroups(MWSActor):
         groups = xm.Field('.//FinancialEventGroup', EventGroupSchema(), many=True, default=list)
         next_token = xm.String('.//NextToken', default=None)
 
-    def api_name(self):
-        return 'Finances'
+    stream_records = {
+        'groups': ('FinancialEventGroupList', 'FinancialEventGroup', ResponseSchema.EventGroupSchema())
+    }
+    page_key = 'groups'
 
     def build_params(self, *, started_after=None, started_before=None):
         if started_after is None and started_before is None:
@@ -585,20 +587,6 @@ class ListFinancialEventGroups(MWSActor):
             'FinancialEventgroupStartedBefore': started_before
         }.items() if v is not None}
 
-    def process_response(self, args, kwargs, response):
-        results = []
-        while response:
-            results.extend(response.groups)
-
-            token = response.next_token
-            response = self.make_api_call(
-                'ListFinancialEventGroupsByNextToken',
-                throttle_action='ListFinancialEventGroups',
-                NextToken=token
-            ) if token else None
-
-        return results
-
 
 ########################################################################################################################
 
@@ -630,7 +618,15 @@ class Promotion(xm.Schema):
     amount = xm.Float('.//PromotionAmount/CurrencyAmount', default=0)
 
 
-class ListFinancialEvents(MWSActor):
+class ListFinancialEvents(PagedMWSActor):
+    api_name = 'Finances'
+
+    class Schema(PagedMWSActor.Schema):
+        """Parameter schema for ListFinancialEvents."""
+        order_number = mmf.String(missing=None, title='Amazon order ID')
+        group_id = mmf.String(missing=None, title='Financial event group ID')
+        posted_after = mmf.String(missing=None, title='Posted after')
+        posted_before = mmf.String(missing=None, title='Posted before')
 
     class ResponseSchema(MWSResponseSchema):
 
@@ -715,10 +711,17 @@ class ListFinancialEvents(MWSActor):
         adjustment_events = xm.List('.//AdjustmentEventList/AdjustmentEvent', AdjustmentEvent())
         next_token = xm.String('.//NextToken', default=None)
 
-    def api_name(self):
-        return 'Finances'
-
-    def build_params(self, *args, order_number=None, group_id=None, posted_after=None, posted_before=None):
+    stream_records = {
+        'shipment_events': ('ShipmentEventList', 'ShipmentEvent', ResponseSchema.ShipmentEvent()),
+        'refund_events': ('RefundEventList', 'ShipmentEvent', ResponseSchema.ShipmentEvent()),
+        'guarantee_events': ('GuaranteeClaimEventList', 'ShipmentEvent', ResponseSchema.ShipmentEvent()),
+        'chargeback_events': ('ChargebackEventList', 'ShipmentEvent', ResponseSchema.ShipmentEvent()),
+        'retrocharge_events': ('RetrochargeEventList', 'RetrochargeEvent', ResponseSchema.RetroChargeEvent()),
+        'service_fee_events': ('ServiceFeeEventList', 'ServiceFeeEvent', ResponseSchema.ServiceFeeEvent()),
+        'adjustment_events': ('AdjustmentEventList', 'AdjustmentEvent', ResponseSchema.AdjustmentEvent()),
+    }
+
+    def build_params(self, *, order_number=None, group_id=None, posted_after=None, posted_before=None):
         return {k: v for k, v in {
             'AmazonOrderId': order_number,
             'FinancialEventGroupId': group_id,
@@ -726,30 +729,9 @@ class ListFinancialEvents(MWSActor):
             'PostedBefore': posted_before
         }.items() if v is not None}
 
-    def process_response(self, args, kwargs, response):
-        results = {
-            'shipment_events': [],
-            'refund_events': [],
-            'guarantee_events': [],
-            'chargeback_events': [],
-            'retrocharge_events': [],
-            'service_fee_events': [],
-            'adjustment_events': [],
-        }
-        while response:
-            results['shipment_events'].extend(response.get('shipment_events', []))
-            results['refund_events'].extend(response.get('refund_events', []))
-            results['guarantee_events'].extend(response.get('guarantee_events', []))
-            results['chargeback_events'].extend(response.get('chargeback_events', []))
-            results['retrocharge_events'].extend(response.get('retrocharge_events', []))
-            results['service_fee_events'].extend(response.get('service_fee_events', []))
-            results['adjustment_events'].extend(response.get('adjustment_events', []))
-
-            token = response.next_token
-            response = self.make_api_call(
-                'ListFinancialEventGroupsByNextToken',
-                throttle_action='ListFinancialEventGroups',
-                NextToken=token
-            ) if token else None
-
-        return results
+    def page_records(self, response):
+        return {key: response.get(key, []) for key in self.stream_records}
+
+    def merge_pages(self, pages):
+        return {key: [event for page in pages for event in page[key]] for key in self.stream_records}
+
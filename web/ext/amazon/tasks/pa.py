@@ -3,16 +3,17 @@ import marshmallow.fields as mmf
 
 import xmallow as xm
 
-from .common import MWSActor, MWSResponseSchema
+from .common import BatchMWSActor, MWSResponseSchema
 
 
 ########################################################################################################################
 
 
-class ItemLookup(MWSActor):
+class ItemLookup(BatchMWSActor):
     """Performs an ItemLookup operation. Accepts a dictionary with a 'sku' key, and updates and returns that dictionary
-    with the results of the lookup."""
+    with the results of the lookup. Lookups from different contexts are combined into requests of up to 10 ItemIds."""
     api_name = 'ProductAdvertising'
+    batch_size = 10
 
     class Schema(mm.Schema):
         """Parameter schema for ItemLookup."""
@@ -59,20 +60,37 @@ class ItemLookup(MWSActor):
 
         products = xm.Field('//Item', ProductSchema(), many=True, default=list)
 
-    def build_params(self, listing=None):
+    def batch_key(self, **kwargs):
+        return f'{type(self).__name__}_{self.context["vendor_id"]}_batch'
+
+    def build_batch_params(self, requests):
+        skus = dict.fromkeys(request['listing']['sku'] for request in requests)
         return {
-        'ResponseGroup': 'Images,ItemAttributes,OfferFull,SalesRank,EditorialReview',
-        'ItemId': listing['sku'],
-    }
+            'ResponseGroup': 'Images,ItemAttributes,OfferFull,SalesRank,EditorialReview',
+            'ItemId': ','.join(skus),
+        }
+
+    def split_response(self, requests, response):
+        products = {product.sku: product for product in response.products}
+        results = []
+
+        for request in requests:
+            product = products.get(request['listing']['sku'])
+            results.append({
+                'product': product,
+                'errors': response.errors if product is None else []
+            })
+
+        return results
 
     def process_response(self, args, kwargs, response):
         doc = kwargs['listing']
 
-        if response.products:
-            doc.update(response.products[0])
+        if response['product']:
+            doc.update(response['product'])
 
-        if response.errors:
-            doc['errors'] = doc.get('errors', []).extend(response.errors)
+        if response['errors']:
+            doc['errors'] = doc.get('errors', []) + list(response['errors'])
 
         self.context['listing'] = doc
         return doc
@@ -0,0 +1,171 @@
+import amazonmws
+
+
+########################################################################################################################
+
+
+DEFAULT_LIMITS = {'quota_max': 1, 'restore_rate': 1}
+
+
+def limits_for(action):
+    """Return the throttling limits for an API action."""
+    return amazonmws.DEFAULT_LIMITS.get(action, DEFAULT_LIMITS)
+
+
+def rate_key(seller_id, action):
+    """Return the key of the hash holding the adaptive rate for an action."""
+    return f'{action}_{seller_id}_rate'
+
+
+########################################################################################################################
+
+
+# Generic cell rate algorithm. Each (seller, action) key holds the theoretical arrival time (TAT) of the next request,
+# in Redis server time. A request is allowed if it arrives no earlier than TAT - burst, where burst is the time
+# needed to restore the whole quota less one request. Using the server's clock means workers on different hosts
+# agree on the time. The restore interval is divided by the rate factor kept by RateController.
+_GCRA = """
+redis.replicate_commands()
+
+local function now()
+    local time = redis.call('TIME')
+    return tonumber(time[1]) + tonumber(time[2]) / 1000000
+end
+
+local function gcra(key, rate_key, interval, quota_max, reserve)
+    local time = now()
+    local factor = tonumber(redis.call('HGET', rate_key, 'factor')) or 1
+    interval = interval / factor
+    local burst = interval * (quota_max - 1)
+    local tat = tonumber(redis.call('GET', key)) or time
+    tat = math.max(tat, time)
+
+    local allowed_at = tat - burst
+    if time < allowed_at then
+        return tostring(allowed_at - time)
+    end
+
+    if reserve then
+        local new_tat = tat + interval
+        redis.call('SET', key, tostring(new_tat), 'PX', math.ceil((new_tat - time) * 1000) + 1000)
+    end
+
+    return '0'
+end
+"""
+
+# KEYS = {gcra key, rate key}
+# ARGV = {interval, quota max}
+_ACQUIRE_SCRIPT = _GCRA + """
+return gcra(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]), true)
+"""
+
+# KEYS = {gcra key, rate key}
+# ARGV = {interval, quota max}
+_PREDICT_SCRIPT = _GCRA + """
+return gcra(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]), false)
+"""
+
+
+class QuotaEngine:
+    """Distributed quota accounting for throttled API calls. Quotas are tracked per (seller, action) with the generic
+    cell rate algorithm, using Redis server time so that any number of workers can share them."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._acquire = redis.register_script(_ACQUIRE_SCRIPT)
+        self._predict = redis.register_script(_PREDICT_SCRIPT)
+
+    def _key_for(self, seller_id, action):
+        return f'{action}_{seller_id}_gcra'
+
+    def _args(self, limits):
+        return limits['restore_rate'], limits['quota_max']
+
+    def acquire(self, seller_id, action, limits=None):
+        """Try to use one request from the quota. Returns 0 if the request may be made now, otherwise the number
+        of seconds until it can be made. Nothing is used from the quota unless 0 is returned."""
+        limits = limits or limits_for(action)
+        keys = (self._key_for(seller_id, action), rate_key(seller_id, action))
+        wait = self._acquire(keys=keys, args=self._args(limits))
+        return float(wait)
+
+    def predict_wait(self, seller_id, action, limits=None):
+        """Returns the number of seconds until a request could be made, without using the quota."""
+        limits = limits or limits_for(action)
+        keys = (self._key_for(seller_id, action), rate_key(seller_id, action))
+        wait = self._predict(keys=keys, args=self._args(limits))
+        return float(wait)
+
+    def reset(self, seller_id, action):
+        """Forget all usage for an action."""
+        self.redis.delete(self._key_for(seller_id, action))
+
+
+########################################################################################################################
+
+
+# KEYS = {rate key, published rates}
+# ARGV = {name, restore rate, throttled ('1' or '0'), successes before increase, increase, decrease, min factor}
+_FEEDBACK_SCRIPT = """
+local factor = tonumber(redis.call('HGET', KEYS[1], 'factor')) or 1
+
+if ARGV[3] == '1' then
+    factor = math.max(factor * tonumber(ARGV[6]), tonumber(ARGV[7]))
+    redis.call('HSET', KEYS[1], 'successes', 0)
+else
+    local successes = redis.call('HINCRBY', KEYS[1], 'successes', 1)
+    if successes < tonumber(ARGV[4]) then
+        return tostring(factor)
+    end
+
+    factor = math.min(factor + tonumber(ARGV[5]), 1)
+    redis.call('HSET', KEYS[1], 'successes', 0)
+end
+
+redis.call('HSET', KEYS[1], 'factor', tostring(factor))
+redis.call('HSET', KEYS[2], ARGV[1], tostring(factor / tonumber(ARGV[2])))
+return tostring(factor)
+"""
+
+
+class RateController:
+    """Additive-increase, multiplicative-decrease control of the request rate for each (seller, action), shared by
+    all workers. The rate is a factor of the documented restore rate: it is cut after every throttled request, and
+    raised a little after each run of successful requests. The current rate of each action, in requests per
+    second, is published to the 'mws_throttle_rates' hash."""
+    rates_key = 'mws_throttle_rates'
+
+    def __init__(self, redis, successes=10, increase=0.05, decrease=0.5, min_factor=0.05):
+        self.redis = redis
+        self.successes = successes
+        self.increase = increase
+        self.decrease = decrease
+        self.min_factor = min_factor
+        self._feedback = redis.register_script(_FEEDBACK_SCRIPT)
+
+    def _record(self, seller_id, action, throttled):
+        limits = limits_for(action)
+        factor = self._feedback(
+            keys=(rate_key(seller_id, action), self.rates_key),
+            args=(f'{action}_{seller_id}', limits['restore_rate'], '1' if throttled else '0', self.successes,
+                  self.increase, self.decrease, self.min_factor)
+        )
+        return float(factor)
+
+    def succeeded(self, seller_id, action):
+        """Record a successful request. Returns the new rate factor."""
+        return self._record(seller_id, action, False)
+
+    def throttled(self, seller_id, action):
+        """Record a throttled request. Returns the new rate factor."""
+        return self._record(seller_id, action, True)
+
+    def factor(self, seller_id, action):
+        """Returns the current rate factor."""
+        factor = self.redis.hget(rate_key(seller_id, action), 'factor')
+        return float(factor) if factor else 1.0
+
+    def rates(self):
+        """Returns the published rates of all actions, in requests per second."""
+        return {k.decode(): float(v) for k, v in self.redis.hgetall(self.rates_key).items()}
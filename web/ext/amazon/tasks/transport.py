@@ -0,0 +1,337 @@
+"""
+Pluggable HTTP transports for the MWS and Product Advertising APIs.
+
+amazonmws API objects send their requests through a make_request function with the same signature as
+requests.request(). The transports here can be used in its place:
+
+    LiveTransport       Sends requests to Amazon.
+    RecordTransport     Sends requests to Amazon, and saves each response to a cassette store.
+    ReplayTransport     Answers requests from a cassette store, without using the network.
+    StubTransport       Sends requests to a StubServer, which replays a cassette store over HTTP with configurable
+                        latency and throttling errors.
+
+Cassettes are keyed by the API path, the action and the request parameters, excluding the parameters that change
+with every request or depend on the credentials (signature, timestamp, access keys). The transport is chosen by
+the MWS_TRANSPORT setting ('live', 'record', 'replay' or 'stub'). Cassettes are kept in MWS_CASSETTE_DIR, and the
+stub server's address is MWS_STUB_URL. Requests that weren't recorded are errors, unless MWS_REPLAY_FALLBACK is set;
+then they are answered with another response recorded for the same action.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import urllib.parse
+import socketserver
+import http.server
+import requests
+
+from .throttle import limits_for
+
+
+########################################################################################################################
+
+
+# Parameters that are left out of cassette keys
+VOLATILE_PARAMS = frozenset((
+    'Signature', 'SignatureMethod', 'SignatureVersion', 'Timestamp', 'AWSAccessKeyId', 'MWSAuthToken', 'SellerId',
+    'Merchant', 'AssociateTag'
+))
+
+
+def request_params(url, params=None, data=None):
+    """Return a dictionary of all the parameters of a request, from the query string and the form body."""
+    collected = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+
+    for extra in (params, data):
+        if isinstance(extra, bytes):
+            extra = extra.decode(errors='replace')
+
+        if isinstance(extra, str):
+            collected.update(urllib.parse.parse_qsl(extra))
+        elif extra:
+            collected.update(extra)
+
+    return collected
+
+
+def action_for(params):
+    """Return the name of the action being called. Product Advertising calls it the Operation."""
+    return params.get('Action') or params.get('Operation') or 'Unknown'
+
+
+def cassette_key(url, params):
+    """Return the cassette key for a request: the action, and a hash of the API path and the stable parameters."""
+    path = urllib.parse.urlsplit(url).path.rstrip('/')
+    stable = sorted((k, str(v)) for k, v in params.items() if k not in VOLATILE_PARAMS)
+    digest = hashlib.sha1(json.dumps([path, stable]).encode()).hexdigest()[:16]
+    return f'{action_for(params)}/{digest}'
+
+
+def make_response(url, status, body, content_type='text/xml'):
+    """Build a requests.Response from a recorded body. The body is exposed through response.raw, so that it can be
+    parsed incrementally just like a live streamed response."""
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers['Content-Type'] = content_type
+    response.encoding = 'utf-8'
+    response.raw = io.BytesIO(body)
+    return response
+
+
+########################################################################################################################
+
+
+class CassetteNotFound(LookupError):
+    """Raised when a request has no recorded response."""
+
+
+class CassetteStore:
+    """A directory of recorded responses. Each cassette is an XML file holding the response body, next to a JSON
+    file with the status code and the parameters that were sent."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _paths(self, key):
+        base = os.path.join(self.path, *key.split('/'))
+        return base + '.json', base + '.xml'
+
+    def save(self, key, params, status, body):
+        """Save a response."""
+        meta_path, body_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+
+        with open(body_path, 'wb') as f:
+            f.write(body)
+
+        with open(meta_path, 'w') as f:
+            stable = {k: v for k, v in params.items() if k not in VOLATILE_PARAMS}
+            json.dump({'status': status, 'params': stable}, f, indent=2, sort_keys=True)
+
+    def load(self, key):
+        """Return the (status, body) of a recorded response, or raise CassetteNotFound."""
+        meta_path, body_path = self._paths(key)
+
+        try:
+            with open(meta_path) as f:
+                status = json.load(f)['status']
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise CassetteNotFound(key)
+
+        return status, body
+
+    def keys_for(self, action):
+        """Return the keys of all the responses recorded for an action."""
+        directory = os.path.join(self.path, action)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(f'{action}/{name[:-5]}' for name in os.listdir(directory) if name.endswith('.json'))
+
+    def find(self, key, any_for_action=False):
+        """Return the (status, body) recorded for :key:. If there isn't one and :any_for_action: is set, return a
+        response recorded for the same action with different parameters instead. The response is picked by a hash
+        of :key:, so a request always gets the same one. NextTokens are removed from those, so that paged calls
+        finish instead of following tokens that belong to other requests."""
+        try:
+            return self.load(key)
+        except CassetteNotFound:
+            if not any_for_action:
+                raise
+
+        action = key.split('/')[0]
+        candidates = self.keys_for(action) or self.keys_for(re.sub('ByNextToken$', '', action))
+        if not candidates:
+            raise CassetteNotFound(key)
+
+        index = int(hashlib.sha1(key.encode()).hexdigest(), 16) % len(candidates)
+        status, body = self.load(candidates[index])
+        return status, re.sub(rb'<NextToken>.*?</NextToken>', b'', body, flags=re.DOTALL)
+
+
+########################################################################################################################
+
+
+class LiveTransport:
+    """Sends requests to Amazon. Responses are streamed, so that they can be parsed while they download."""
+
+    def __call__(self, method, url, **kwargs):
+        kwargs.setdefault('stream', True)
+        return requests.request(method, url, **kwargs)
+
+
+class RecordTransport(LiveTransport):
+    """Sends requests to Amazon, and saves each response to a CassetteStore. Throttling errors aren't saved, so that
+    they don't replace a good recording."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __call__(self, method, url, **kwargs):
+        response = super().__call__(method, url, **kwargs)
+        if response.status_code == 503:
+            return response
+
+        params = request_params(url, kwargs.get('params'), kwargs.get('data'))
+        self.store.save(cassette_key(url, params), params, response.status_code, response.content)
+        return response
+
+
+class ReplayTransport:
+    """Answers requests from a CassetteStore. Raises CassetteNotFound for requests that weren't recorded, unless
+    :any_for_action: is set (see CassetteStore.find)."""
+
+    def __init__(self, store, any_for_action=False):
+        self.store = store
+        self.any_for_action = any_for_action
+
+    def __call__(self, method, url, **kwargs):
+        params = request_params(url, kwargs.get('params'), kwargs.get('data'))
+        status, body = self.store.find(cassette_key(url, params), any_for_action=self.any_for_action)
+        return make_response(url, status, body)
+
+
+class StubTransport(LiveTransport):
+    """Sends requests to a StubServer at :base_url: instead of Amazon. Only the scheme and host are replaced, so the
+    server sees the same path and parameters that Amazon would."""
+
+    def __init__(self, base_url):
+        self.base_url = urllib.parse.urlsplit(base_url)
+
+    def __call__(self, method, url, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        url = urllib.parse.urlunsplit((self.base_url.scheme, self.base_url.netloc) + parts[2:])
+        return super().__call__(method, url, **kwargs)
+
+
+def get_transport(config):
+    """Return the transport selected by the MWS_TRANSPORT setting in :config:."""
+    mode = config.get('MWS_TRANSPORT') or 'live'
+
+    if mode == 'live':
+        return LiveTransport()
+    elif mode == 'record':
+        return RecordTransport(CassetteStore(config['MWS_CASSETTE_DIR']))
+    elif mode == 'replay':
+        return ReplayTransport(CassetteStore(config['MWS_CASSETTE_DIR']),
+                               any_for_action=bool(config.get('MWS_REPLAY_FALLBACK')))
+    elif mode == 'stub':
+        return StubTransport(config['MWS_STUB_URL'])
+
+    raise ValueError(f'Unknown MWS transport: {mode}')
+
+
+########################################################################################################################
+
+
+THROTTLED_BODY = b"""<?xml version="1.0"?>
+<ErrorResponse xmlns="https://mws.amazonservices.com/">
+  <Error>
+    <Type>Sender</Type>
+    <Code>RequestThrottled</Code>
+    <Message>Request is throttled</Message>
+  </Error>
+  <RequestID>stub</RequestID>
+</ErrorResponse>"""
+
+NOT_FOUND_BODY = b"""<?xml version="1.0"?>
+<ErrorResponse xmlns="https://mws.amazonservices.com/">
+  <Error>
+    <Type>Sender</Type>
+    <Code>InvalidParameterValue</Code>
+    <Message>No recorded response</Message>
+  </Error>
+  <RequestID>stub</RequestID>
+</ErrorResponse>"""
+
+
+class StubQuotas:
+    """Throttles requests like Amazon does: each action has a bucket holding up to quota_max requests, which is
+    refilled by one request every restore_rate seconds. ByNextToken actions share their action's bucket."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, action):
+        """Use one request from the action's bucket. Returns False if the request should be throttled."""
+        action = re.sub('ByNextToken$', '', action)
+        limits = limits_for(action)
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, updated = self.buckets.get(action, (limits['quota_max'], now))
+            tokens = min(limits['quota_max'], tokens + (now - updated) / limits['restore_rate'])
+
+            if tokens < 1:
+                self.buckets[action] = (tokens, now)
+                return False
+
+            self.buckets[action] = (tokens - 1, now)
+            return True
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server that replays a CassetteStore in place of the Amazon endpoints.
+
+    :latency: and :jitter: are in seconds; each response is delayed by latency plus a random amount up to jitter.
+    If :enforce_quotas: is set, requests beyond the documented quotas get RequestThrottled errors, and a further
+    :throttle_rate: fraction of requests are throttled at random. Requests that weren't recorded get a 400 error,
+    unless :fallback: is set; then they are answered with a response recorded for the same action, if there is one."""
+    daemon_threads = True
+
+    def __init__(self, address, store, latency=0, jitter=0, throttle_rate=0, enforce_quotas=True, fallback=False):
+        super().__init__(address, StubRequestHandler)
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.quotas = StubQuotas() if enforce_quotas else None
+        self.fallback = fallback
+
+    def respond(self, url, params):
+        """Return the (status, body) of the response to a request."""
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        action = action_for(params)
+
+        if random.random() < self.throttle_rate or (self.quotas and not self.quotas.allow(action)):
+            return 503, THROTTLED_BODY
+
+        try:
+            return self.store.find(cassette_key(url, params), any_for_action=self.fallback)
+        except CassetteNotFound:
+            return 400, NOT_FOUND_BODY
+
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers MWS requests from the StubServer's cassettes."""
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, body=None):
+        status, content = self.server.respond(self.path, request_params(self.path, data=body))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        form = self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded')
+        self._respond(body if form else None)
+
+    def log_message(self, format, *args):
+        pass
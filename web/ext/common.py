@@ -8,11 +8,7 @@ from scrapy.settings import Settings
 from tasks.ops.common import ColanderActor, TaskContext
 from tasks.ops.listings import ImportListing
 
-import json
-import redis as _redis
-import time
 import dramatiq as dq
-import config as cfg
 
 
 ########################################################################################################################
@@ -46,9 +42,7 @@ def _launch_spider(module_name, urls, context_id=None, spider_message_id=None, s
         ).send()
 
     def spider_closed(spider, reason):
-        redis = _redis.from_url(cfg.Config.REDIS_URL)
-        completed_key = context._key_for('completed')
-        redis.execute_command('ZADD', completed_key, 'NX', time.time(), spider_message_id)
+        context.complete(spider_message_id)
 
     crawler = Crawler(spider, settings)
     crawler.signals.connect(import_func, signal=signals.item_scraped)
@@ -69,13 +63,7 @@ def launch_spider(module_name, urls, **kwargs):
         spider_message = dq.Message(queue_name='dummy', actor_name='dummy', args=tuple(), kwargs={}, options={})
 
         context = TaskContext(id=context_id)
-        messages_key = context._key_for('messages')
-        sent_key = context._key_for('sent')
-
-        pipe = _redis.from_url(cfg.Config.REDIS_URL).pipeline()
-        pipe.execute_command('ZADD', messages_key, 'NX', time.time(), json.dumps(spider_message.asdict()))
-        pipe.execute_command('ZADD', sent_key, 'NX', time.time(), spider_message.message_id)
-        pipe.execute()
+        context.track(spider_message)
 
         kwargs.update(spider_message_id=spider_message.message_id)
 
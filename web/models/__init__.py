@@ -1,17 +1,17 @@
 from .users import User
-from .extensions import Extension, Task, TaskContext, TaskInstance
+from .extensions import Extension, Task, TaskContext, TaskInstance, SyncState
 from .entities import Entity, Vendor, Customer
 from .finances import FinancialAccount, FinancialEvent, OrderEvent, OrderItemEvent, InventoryAdjustment
 from .listings import QuantityMap, ListingDetails, Listing
 from .orders import Order, OrderItem, Shipment, InventoryDetails, Inventory, InvConversionSource, InventoryConversion
-from .relationships import Relationship, RelationshipSource, Opportunity, OpportunitySource
+from .relationships import Relationship, RelationshipSource, Opportunity, OpportunityScore, OpportunitySource
 
 __all__ = [
     'User',
-    'Extension', 'Task', 'TaskContext', 'TaskInstance',
+    'Extension', 'Task', 'TaskContext', 'TaskInstance', 'SyncState',
     'Entity', 'Vendor', 'Customer',
     'FinancialAccount', 'FinancialEvent', 'OrderEvent', 'OrderItemEvent', 'InventoryAdjustment',
     'QuantityMap', 'Listing', 'ListingDetails',
     'Order', 'OrderItem', 'Shipment', 'InventoryDetails', 'Inventory', 'InvConversionSource', 'InventoryConversion',
-    'Relationship', 'RelationshipSource', 'Opportunity', 'OpportunitySource'
+    'Relationship', 'RelationshipSource', 'Opportunity', 'OpportunityScore', 'OpportunitySource'
 ]
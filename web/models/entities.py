@@ -1,8 +1,9 @@
 import marshmallow as mm
 import marshmallow.fields as mmf
 import sqlalchemy_jsonbase as jb
+from sqlalchemy.dialects.postgresql import JSONB as PG_JSONB
 
-from core import db, URL, JSONB
+from core import db, URL, JSONB, next_ids
 
 from .mixins import PolymorphicMixin, SearchMixin
 
@@ -69,6 +70,54 @@ class Customer(Entity):
     def __repr__(self):
         return f'<{type(self).__name__} {self.name or self.email}>)'
 
+    @classmethod
+    def upsert_many(cls, docs, session=None):
+        """Create or update customers by name, using a few set-based statements. Each doc has a name, and optionally
+        an email, city, state, zip and extra data. Names are unique across all entities, so a name that already
+        belongs to another kind of entity (a vendor, for example) is mapped to that entity, which is left unchanged.
+        Returns a dict mapping names to entity IDs."""
+        session = session or db.session
+        docs = {doc['name']: doc for doc in docs}
+        if not docs:
+            return {}
+
+        ids, customer_names = {}, set()
+        for name, entity_id, entity_type in session.query(Entity.name, Entity.id, Entity.type).filter(
+                Entity.name.in_(list(docs))):
+            ids[name] = entity_id
+            if entity_type == cls.__name__:
+                customer_names.add(name)
+
+        entities, customers = Entity.__table__, cls.__table__
+        columns = ('email', 'city', 'state', 'zip')
+        updates = [
+            {'_id': ids[name], '_extra': doc.get('extra', {}), **{'_' + col: doc.get(col) for col in columns}}
+            for name, doc in docs.items() if name in customer_names
+        ]
+        if updates:
+            session.execute(entities.update().where(entities.c.id == db.bindparam('_id')).values(
+                extra=entities.c.extra.concat(db.bindparam('_extra', type_=PG_JSONB))
+            ), updates)
+            session.execute(customers.update().where(customers.c.id == db.bindparam('_id')).values(
+                **{col: db.func.coalesce(db.bindparam('_' + col), customers.c[col]) for col in columns}
+            ), updates)
+
+        new = [name for name in docs if name not in ids]
+        new_ids = next_ids(session, entities, len(new))
+        if new:
+            session.execute(entities.insert(), [
+                {'id': entity_id, 'type': cls.__name__, 'name': name, 'extra': docs[name].get('extra', {})}
+                for entity_id, name in zip(new_ids, new)
+            ])
+            session.execute(customers.insert(), [
+                {'id': entity_id, **{col: docs[name].get(col) for col in columns}}
+                for entity_id, name in zip(new_ids, new)
+            ])
+            ids.update(zip(new, new_ids))
+
+        cls.index_later((ids[name] for name in docs if name in customer_names or name in new), session=session)
+        return ids
+
 
 ########################################################################################################################
 
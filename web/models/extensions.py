@@ -6,6 +6,7 @@ import marshmallow as mm
 import marshmallow.fields as mmf
 import marshmallow_jsonschema as mmjs
 import sqlalchemy_jsonbase as jb
+from sqlalchemy.dialects.postgresql import insert
 
 from core import db, JSONB
 from tasks.broker import setup_dramatiq
@@ -223,8 +224,7 @@ class TaskInstance(db.Model, SearchMixin):
 
     @jb.property(label='Unsent messages', format='array', field=ListOf(mmf.String))
     def messages(self):
-        messages = self._context.messages
-        return [dict(msg.asdict()) for msg in messages]
+        return self._context.message_ids
 
     @jb.property(label='Sent messages', format='array', field=ListOf(mmf.String))
     def sent(self):
@@ -283,4 +283,47 @@ class TaskInstance(db.Model, SearchMixin):
     #     )
 
 
-TaskInstance.register_hooks()
\ No newline at end of file
+TaskInstance.register_hooks()
+
+
+########################################################################################################################
+
+
+class SyncState(db.Model):
+    """The high-water mark of an incremental import, for each (vendor, feed)."""
+    id = db.Column(db.Integer, primary_key=True)
+    vendor_id = db.Column(db.Integer, db.ForeignKey('entity.id', ondelete='CASCADE'), nullable=False)
+    feed = db.Column(db.String(64), nullable=False)
+    cursor = db.Column(db.DateTime)
+
+    __table_args__ = (sa.UniqueConstraint('vendor_id', 'feed'),)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.vendor_id} {self.feed} {self.cursor}>'
+
+    @classmethod
+    def cursor_for(cls, vendor_id, feed, overlap=None, session=None):
+        """Return the cursor for a feed, moved back by :overlap: (a timedelta), or None if the feed has never
+        been synced."""
+        session = session or db.session
+        cursor = session.query(cls.cursor).filter_by(vendor_id=vendor_id, feed=feed).scalar()
+
+        if cursor is not None and overlap:
+            cursor -= overlap
+
+        return cursor
+
+    @classmethod
+    def advance(cls, vendor_id, feed, cursor, session=None):
+        """Move a feed's cursor forward to :cursor:. The cursor never moves back, so imports that finish out of
+        order are safe. This doesn't commit; call it in the same transaction as the import it records."""
+        session = session or db.session
+        table = cls.__table__
+
+        stmt = insert(table).values(type=cls.__name__, extra={}, vendor_id=vendor_id, feed=feed, cursor=cursor)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.vendor_id, table.c.feed],
+            set_={'cursor': db.func.greatest(table.c.cursor, stmt.excluded.cursor)}
+        )
+
+        session.execute(stmt)
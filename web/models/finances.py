@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from sqlalchemy.dialects.postgresql import JSONB
+
 from core import db, CURRENCY
 
 from .mixins import PolymorphicMixin, SearchMixin
@@ -42,6 +44,8 @@ class FinancialEvent(db.Model, PolymorphicMixin, SearchMixin):
     account = db.relationship('FinancialAccount', back_populates='events')
     originator = db.relationship('Entity', back_populates='financials')
 
+    __extra_indexes__ = ('group_id',)
+
     def __repr__(self):
         return f'<{type(self).__name__} {self.net} {self.description}>'
 
@@ -69,12 +73,145 @@ class OrderItemEvent(FinancialEvent):
     item_id = db.Column(db.Integer, db.ForeignKey('order_item.id'))
     item = db.relationship('OrderItem', back_populates='financials')
 
+    __extra_indexes__ = ('order_item_id', 'adjustment_id')
+
     def __repr__(self):
         if self.item:
             return f'<{type(self).__name__} {self.id}: ${self.net} {self.item.quantity} x {self.item.source.listing.sku}>'
         else:
             return f'<{type(self).__name__} {self.id}: ${self.net}>'
 
+    @classmethod
+    def upsert_many(cls, docs, account_id, originator_id, session=None):
+        """Create or update item events from a list of dicts, using a handful of set-based statements. Each dict
+        holds the event's date, net, description and extra data, plus match_key ('order_item_id' or
+        'adjustment_id'), the key in extra that identifies an existing event. Events are attached to the OrderItem
+        with the same order_item_id or, failing that, to the item with the same msku in the order with the same
+        order_number. Returns the number of new events."""
+        from .orders import Order, OrderItem
+        session = session or db.session
+
+        # Keep the last document for each key
+        unique = {}
+        for doc in docs:
+            key = (doc['match_key'], doc['extra'][doc['match_key']])
+            unique[key] = doc
+
+        if not unique:
+            return 0
+
+        # Stage the documents
+        conn = session.connection()
+        conn.execute("""
+            DROP TABLE IF EXISTS item_event_staging;
+            CREATE TEMPORARY TABLE item_event_staging (
+                match_key text NOT NULL,
+                match_value text NOT NULL,
+                order_number text,
+                order_item_id text,
+                msku text,
+                date timestamp,
+                net numeric(19, 4),
+                description text,
+                extra jsonb NOT NULL,
+                event_id integer,
+                item_id integer,
+                new boolean NOT NULL DEFAULT false
+            ) ON COMMIT DROP
+        """)
+
+        staging = db.table(
+            'item_event_staging',
+            *(db.column(name) for name in ('match_key', 'match_value', 'order_number', 'order_item_id', 'msku',
+                                           'date', 'net', 'description', 'event_id', 'item_id', 'new')),
+            db.column('extra', JSONB)
+        )
+        conn.execute(staging.insert(), [
+            {
+                'match_key': key,
+                'match_value': value,
+                'order_number': doc['extra'].get('amazon_order_id'),
+                'order_item_id': doc['extra'].get('order_item_id'),
+                'msku': doc['extra'].get('msku'),
+                'date': doc['date'],
+                'net': doc['net'],
+                'description': doc['description'],
+                'extra': doc['extra'],
+            }
+            for (key, value), doc in unique.items()
+        ])
+
+        # Find existing events. One statement per key, so that each can use its expression index. Refunds carry the
+        # order_item_id of the item they refund, so they are left out when matching sales by order_item_id.
+        events = FinancialEvent.__table__
+        for key in ('order_item_id', 'adjustment_id'):
+            conditions = [
+                staging.c.match_key == key,
+                events.c.type == cls.__name__,
+                events.c.extra[key].astext == staging.c.match_value
+            ]
+            if key == 'order_item_id':
+                conditions.append(~events.c.extra.has_key('adjustment_id'))
+
+            conn.execute(staging.update().where(db.and_(*conditions)).values(event_id=events.c.id))
+
+        # Find the order items
+        items, orders = OrderItem.__table__, Order.__table__
+        conn.execute(staging.update().where(
+            items.c.extra['order_item_id'].astext == staging.c.order_item_id
+        ).values(item_id=items.c.id))
+        conn.execute(staging.update().where(
+            db.and_(
+                staging.c.item_id == None,
+                orders.c.order_number == staging.c.order_number,
+                items.c.order_id == orders.c.id,
+                items.c.extra['msku'].astext == staging.c.msku
+            )
+        ).values(item_id=items.c.id))
+
+        # Reserve IDs for the new events
+        sequence = db.func.pg_get_serial_sequence(events.name, 'id')
+        new_count = conn.execute(staging.update().where(
+            staging.c.event_id == None
+        ).values(event_id=db.func.nextval(sequence), new=True)).rowcount
+
+        # Insert the new events
+        new = db.select([staging]).where(staging.c.new == True).alias('new_events')
+        conn.execute(events.insert().from_select(
+            ['id', 'type', 'account_id', 'originator_id', 'date', 'net', 'description', 'extra'],
+            db.select([
+                new.c.event_id,
+                db.literal(cls.__name__),
+                db.literal(account_id),
+                db.literal(originator_id),
+                new.c.date,
+                new.c.net,
+                new.c.description,
+                new.c.extra
+            ])
+        ))
+        conn.execute(cls.__table__.insert().from_select(
+            ['id', 'item_id'],
+            db.select([new.c.event_id, new.c.item_id])
+        ))
+
+        # Update the existing events
+        conn.execute(events.update().where(
+            db.and_(events.c.id == staging.c.event_id, staging.c.new == False)
+        ).values(
+            date=staging.c.date,
+            net=staging.c.net,
+            description=staging.c.description,
+            extra=events.c.extra.concat(staging.c.extra)
+        ))
+        conn.execute(cls.__table__.update().where(
+            db.and_(cls.__table__.c.id == staging.c.event_id, staging.c.new == False)
+        ).values(item_id=staging.c.item_id))
+
+        # The events were written without the session, so they have to be indexed separately
+        cls.index_later((event_id for event_id, in conn.execute(db.select([staging.c.event_id]))), session=session)
+        return new_count
+
 
 ########################################################################################################################
 
@@ -12,7 +12,7 @@ from core import db, search, URL, CURRENCY, quantize_decimal
 
 from .mixins import SearchMixin
 from .entities import Vendor
-from .orders import Inventory, InventoryDetails
+from .orders import Inventory, InventoryDetails, InventoryConversion
 
 
 ########################################################################################################################
@@ -103,11 +103,18 @@ class QuantityMap(db.Model):
 
     def update_products(self):
         """Update all products affected by this quantity map."""
-        Listing.query.filter(
+        listing_ids = [id for id, in db.session.query(Listing.id).filter(
             db.or_(
                 Listing.quantity_desc.ilike(self.text),
                 Listing.title.op('~*')(f'[[:<:]]{self.text}[[:>:]]')
             )
+        )]
+
+        if not listing_ids:
+            return
+
+        Listing.query.filter(
+            Listing.id.in_(listing_ids)
         ).update(
             {
                 'quantity': self.quantity,
@@ -116,6 +123,9 @@ class QuantityMap(db.Model):
             synchronize_session=False
         )
 
+        # Bulk updates bypass the session, so conversions have to be told about the new quantities
+        InventoryConversion.refresh_batch_params(listing_ids)
+
 
 ########################################################################################################################
 
@@ -154,6 +164,7 @@ class Listing(db.Model, SearchMixin):
     last_modified = jb.Column(db.DateTime, default=lambda: str(datetime.utcnow()), onupdate=datetime.utcnow, label='Last modified')
 
     __table_args__ = (sa.UniqueConstraint('vendor_id', 'sku'),)
+    __extra_indexes__ = ('fnsku',)
 
     # Pass-through properties
     price = detail_property('price', field=mmf.Decimal, label='Price')
@@ -197,6 +208,35 @@ class Listing(db.Model, SearchMixin):
         vnd_name = self.vendor.name if self.vendor else None
         return f'<{type(self).__name__} {vnd_name} {self.sku}>'
 
+    @classmethod
+    def ensure_skus(cls, vendor_id, skus, session=None):
+        """Make sure a listing exists for each of a vendor's SKUs, along with the vendor's inventory for it. Existing
+        listings are found with a single query. New ones are created through the session, so that they get the same
+        quantity guessing and search indexing as any other listing. Returns a dict mapping SKUs to listing IDs."""
+        session = session or db.session
+        skus = set(skus)
+        if not skus:
+            return {}
+
+        def find_ids():
+            return dict(session.query(cls.sku, cls.id).filter(cls.vendor_id == vendor_id, cls.sku.in_(list(skus))))
+
+        ids = find_ids()
+        if len(ids) < len(skus):
+            try:
+                with session.begin_nested():
+                    session.add_all(cls(vendor_id=vendor_id, sku=sku) for sku in skus if sku not in ids)
+            except sa.exc.IntegrityError:
+                # Another import created some of the same listings first; create whichever are still missing
+                ids = find_ids()
+                session.add_all(cls(vendor_id=vendor_id, sku=sku) for sku in skus if sku not in ids)
+                session.flush()
+
+            ids = find_ids()
+
+        Inventory.ensure_many(((vendor_id, listing_id) for listing_id in ids.values()), session=session)
+        return ids
+
     @sa.orm.reconstructor
     def __init_on_load__(self):
         self.suppress_guessing = False
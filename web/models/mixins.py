@@ -28,6 +28,13 @@ class PolymorphicMixin:
 class SearchMixin:
     """A mixin that enables search indexing and a search function to work alongside SQLAlchemy."""
 
+    @classmethod
+    def index_later(cls, ids, session=None):
+        """Index the rows with the given IDs after the next commit. Rows written with Core statements never pass
+        through the session, so set-based writers call this for the rows they insert or update."""
+        session = session or db.session
+        session.info.setdefault('_index_ids', {}).setdefault(cls, set()).update(ids)
+
     @classmethod
     def before_commit(cls, session):
         """Hold on to any searchable instances so that we can index them after the commit."""
@@ -35,6 +42,15 @@ class SearchMixin:
                                 [obj for obj in session.dirty if isinstance(obj, cls)]
         session._remove_from_index = [obj for obj in session.deleted if isinstance(obj, cls)]
 
+        # Load the rows written by set-based statements
+        for model, ids in session.info.pop('_index_ids', {}).items():
+            session._add_to_index.extend(session.query(model).filter(model.id.in_(list(ids))))
+
+    @classmethod
+    def after_rollback(cls, session):
+        """Forget the rows that were waiting to be indexed."""
+        session.info.pop('_index_ids', None)
+
     @classmethod
     def after_commit(cls, session):
         """Add or remove objects from the search index."""
@@ -50,6 +66,7 @@ class SearchMixin:
     def register_hooks(cls):
         db.event.listen(SignallingSession, 'before_commit', cls.before_commit)
         db.event.listen(SignallingSession, 'after_commit', cls.after_commit)
+        db.event.listen(SignallingSession, 'after_rollback', cls.after_rollback)
 
     @classmethod
     def search(cls, expression, page=1, per_page=10):
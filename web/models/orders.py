@@ -1,12 +1,16 @@
 import decimal
 import itertools
 import functools
+import collections
+
+import flask_sqlalchemy
 
 from datetime import datetime
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert, JSONB
 
-from core import db, CURRENCY
+from core import db, CURRENCY, next_ids
 from .mixins import SearchMixin
 from .finances import OrderEvent, OrderItemEvent, InventoryAdjustment
 
@@ -68,11 +72,65 @@ class Order(db.Model, SearchMixin):
     shipments = db.relationship('Shipment', back_populates='order')
     financials = db.relationship('OrderEvent', back_populates='order')
 
+    __extra_indexes__ = ('shipping',)
+
     def __repr__(self):
         src_name = self.source.name if self.source else None
         dest_name = self.destination.name if self.destination else None
         return f'<{type(self).__name__} ({self.id}) {self.order_number} {src_name} -> {dest_name}>'
 
+    @classmethod
+    def upsert_many(cls, source_id, docs, session=None):
+        """Create or update orders from :source_id: using a few set-based statements. Each doc has an order_number,
+        and optionally a date, dest_id and extra data, which is merged into the existing extra data. Returns a dict
+        mapping order numbers to order IDs."""
+        session = session or db.session
+        docs = {doc['order_number']: doc for doc in docs}
+        if not docs:
+            return {}
+
+        ids = dict(session.query(cls.order_number, cls.id).filter(
+            cls.source_id == source_id,
+            cls.order_number.in_(list(docs))
+        ))
+
+        table = cls.__table__
+        updates = [
+            {
+                '_id': ids[number],
+                '_date': doc.get('date'),
+                '_dest_id': doc.get('dest_id'),
+                '_extra': doc.get('extra', {})
+            }
+            for number, doc in docs.items() if number in ids
+        ]
+        if updates:
+            session.execute(table.update().where(table.c.id == db.bindparam('_id')).values(
+                date=db.func.coalesce(db.bindparam('_date'), table.c.date),
+                dest_id=db.func.coalesce(db.bindparam('_dest_id'), table.c.dest_id),
+                extra=table.c.extra.concat(db.bindparam('_extra', type_=JSONB))
+            ), updates)
+
+        new = [number for number in docs if number not in ids]
+        new_ids = next_ids(session, table, len(new))
+        if new:
+            session.execute(table.insert(), [
+                {
+                    'id': order_id,
+                    'type': cls.__name__,
+                    'source_id': source_id,
+                    'dest_id': docs[number].get('dest_id'),
+                    'date': docs[number].get('date'),
+                    'order_number': number,
+                    'extra': docs[number].get('extra', {})
+                }
+                for order_id, number in zip(new_ids, new)
+            ])
+            ids.update(zip(new, new_ids))
+
+        cls.index_later(ids.values(), session=session)
+        return ids
+
     def send_inventory(self):
         for item in self.items:
             item.send_inventory()
@@ -130,6 +188,8 @@ class OrderItem(db.Model):
     )
     shipment = db.relationship('Shipment', back_populates='items')
 
+    __extra_indexes__ = ('order_item_id', 'msku')
+
     def __init__(self, *args, **kwargs):
         self.quantity = 1
         self.received = 0
@@ -140,6 +200,61 @@ class OrderItem(db.Model):
         dest_sku = self.destination.listing.sku if self.destination and self.destination.listing else None
         return f'<{type(self).__name__} ({self.id}) {self.quantity}x {source_sku}->{dest_sku}>'
 
+    @classmethod
+    def upsert_many(cls, order_id, docs, key, session=None):
+        """Create or update the items in an order using a few set-based statements. Each doc has values for any of
+        the quantity, received, source_id, dest_id and shipment_id columns, and extra data. Items are identified by
+        :key:, which is either the name of a key in their extra data, or a tuple of column names. Returns a dict
+        mapping keys to item IDs, and a list of the keys of the new items."""
+        session = session or db.session
+
+        if isinstance(key, str):
+            docs = {str(doc['extra'][key]): doc for doc in docs}
+            key_exprs = (cls.extra[key].astext,)
+        else:
+            docs = {tuple(doc.get(col) for col in key): doc for doc in docs}
+            key_exprs = tuple(getattr(cls, col) for col in key)
+
+        if not docs:
+            return {}, []
+
+        query = session.query(cls.id, *key_exprs).filter(
+            cls.order_id == order_id,
+            key_exprs[0].in_(list(docs)) if isinstance(key, str) else db.tuple_(*key_exprs).in_(list(docs))
+        )
+        ids = {(k[0] if isinstance(key, str) else tuple(k)): item_id for item_id, *k in query}
+
+        table = cls.__table__
+        columns = ('quantity', 'received', 'source_id', 'dest_id', 'shipment_id')
+        updates = [
+            {'_id': ids[k], '_extra': doc.get('extra', {}), **{'_' + col: doc.get(col) for col in columns}}
+            for k, doc in docs.items() if k in ids
+        ]
+        if updates:
+            session.execute(table.update().where(table.c.id == db.bindparam('_id')).values(
+                extra=table.c.extra.concat(db.bindparam('_extra', type_=JSONB)),
+                **{col: db.func.coalesce(db.bindparam('_' + col), table.c[col]) for col in columns}
+            ), updates)
+
+        new = [k for k in docs if k not in ids]
+        if new:
+            rows = session.execute(insert(table).values([
+                {
+                    'type': cls.__name__,
+                    'order_id': order_id,
+                    'quantity': docs[k]['quantity'] if docs[k].get('quantity') is not None else 1,
+                    'received': docs[k].get('received') or 0,
+                    'source_id': docs[k].get('source_id'),
+                    'dest_id': docs[k].get('dest_id'),
+                    'shipment_id': docs[k].get('shipment_id'),
+                    'extra': docs[k].get('extra', {})
+                }
+                for k in new
+            ]).returning(table.c.id))
+            ids.update(zip(new, (item_id for item_id, in rows)))
+
+        return ids, new
+
     def send_inventory(self, sent=None):
         """Modify the sender's inventory levels."""
         sent = sent or self.quantity
@@ -205,6 +320,29 @@ class Shipment(db.Model, SearchMixin):
     order = db.relationship('Order', back_populates='shipments')
     items = db.relationship('OrderItem', back_populates='shipment')
 
+    @classmethod
+    def assign_items(cls, order_ids, session=None):
+        """Assign the items of each order in :order_ids: that has exactly one shipment to that shipment. Orders with
+        several shipments are left alone, since there is no way to tell which items went in which shipment."""
+        session = session or db.session
+        order_ids = list(order_ids)
+        if not order_ids:
+            return
+
+        single = session.query(cls.order_id, db.func.min(cls.id)).filter(
+            cls.order_id.in_(order_ids)
+        ).group_by(
+            cls.order_id
+        ).having(
+            db.func.count(cls.id) == 1
+        ).all()
+
+        if single:
+            table = OrderItem.__table__
+            session.execute(table.update().where(table.c.order_id == db.bindparam('_order_id')).values(
+                shipment_id=db.bindparam('_shipment_id')
+            ), [{'_order_id': order_id, '_shipment_id': shipment_id} for order_id, shipment_id in single])
+
 
 ########################################################################################################################
 
@@ -274,6 +412,71 @@ class Inventory(db.Model):
         sku = self.listing.sku if self.listing else None
         return f'<{type(self).__name__} ({self.id}) {self.fulfillable}, {self.reserved}, {self.unsellable} {owner} {sku}>'
 
+    @classmethod
+    def adjust_fulfillable(cls, changes, session=None):
+        """Add the amounts in :changes:, a dict mapping inventory IDs to changes in the fulfillable quantity, using
+        two statements. Like setting the fulfillable property, this adds a new InventoryDetails row to each
+        inventory, carrying over the rest of the latest details."""
+        session = session or db.session
+        changes = {inv_id: change for inv_id, change in changes.items() if change}
+        if not changes:
+            return
+
+        latest = session.query(
+            InventoryDetails.inventory_id,
+            InventoryDetails.active,
+            InventoryDetails.fulfillable,
+            InventoryDetails.reserved,
+            InventoryDetails.unsellable,
+            InventoryDetails.price
+        ).filter(
+            InventoryDetails.inventory_id.in_(list(changes))
+        ).distinct(
+            InventoryDetails.inventory_id
+        ).order_by(
+            InventoryDetails.inventory_id,
+            InventoryDetails.timestamp.desc()
+        )
+        latest = {row.inventory_id: row for row in latest}
+
+        now = datetime.utcnow()
+        rows = []
+        for inv_id, change in changes.items():
+            details = latest.get(inv_id)
+            rows.append({
+                'type': InventoryDetails.__name__,
+                'extra': {},
+                'inventory_id': inv_id,
+                'active': details.active if details else True,
+                'fulfillable': (details.fulfillable if details else 0) + change,
+                'reserved': details.reserved if details else 0,
+                'unsellable': details.unsellable if details else 0,
+                'price': details.price if details else None,
+                'timestamp': now
+            })
+
+        session.execute(InventoryDetails.__table__.insert(), rows)
+
+    @classmethod
+    def ensure_many(cls, pairs, session=None):
+        """Make sure an inventory exists for each (owner ID, listing ID) pair, using two statements. Returns a
+        dict mapping the pairs to inventory IDs."""
+        session = session or db.session
+        pairs = set(pairs)
+        if not pairs:
+            return {}
+
+        table = cls.__table__
+        session.execute(insert(table).values([
+            {'type': cls.__name__, 'owner_id': owner_id, 'listing_id': listing_id, 'extra': {}}
+            for owner_id, listing_id in pairs
+        ]).on_conflict_do_nothing(index_elements=[table.c.listing_id, table.c.owner_id]))
+
+        rows = session.query(cls.owner_id, cls.listing_id, cls.id).filter(
+            db.tuple_(cls.owner_id, cls.listing_id).in_(list(pairs))
+        )
+        return {(owner_id, listing_id): inv_id for owner_id, listing_id, inv_id in rows}
+
     @classmethod
     def __declare_last__(cls):
         db.event.listen(cls, 'before_insert', cls._ensure_owner)
@@ -376,6 +579,38 @@ def lcm(*args):
 ########################################################################################################################
 
 
+ConversionBatch = collections.namedtuple(
+    'ConversionBatch',
+    'units_per_dest min_source_units total_units_per_batch source_units_per_batch batch_size'
+)
+
+ConversionPlan = collections.namedtuple(
+    'ConversionPlan',
+    'conversion_id batches max_batches feasible required produced'
+)
+
+
+def conversion_batch(units, quantities):
+    """Compute the batch parameters for a conversion, given the units used from each source and the listing
+    quantity of each source."""
+    units_per_dest = sum(units)
+    min_source_units = tuple(lcm(q or 1, u) for u, q in zip(units, quantities))
+    total_units_per_batch = lcm(units_per_dest, *min_source_units)
+    source_units_per_batch = tuple(total_units_per_batch * u // units_per_dest for u in units)
+    batch_size = total_units_per_batch // units_per_dest
+
+    return ConversionBatch(
+        units_per_dest,
+        min_source_units,
+        total_units_per_batch,
+        source_units_per_batch,
+        batch_size
+    )
+
+
+########################################################################################################################
+
+
 class InvConversionSource(db.Model):
     """A source inventory used by an InventoryConversion."""
     id = db.Column(db.Integer, primary_key=True)
@@ -383,6 +618,10 @@ class InvConversionSource(db.Model):
     inv_id = db.Column(db.Integer, db.ForeignKey('inventory.id', ondelete='CASCADE'), nullable=False)
     units = db.Column(db.Integer, nullable=False, default=1)
 
+    # Batch parameters, maintained by InventoryConversion.update_batch_params()
+    min_units = db.Column(db.Integer)
+    units_per_batch = db.Column(db.Integer)
+
     conversion = db.relationship('InventoryConversion', back_populates='sources')
     inventory = db.relationship('Inventory')
 
@@ -402,43 +641,226 @@ class InventoryConversion(db.Model):
     cost_ea = db.Column(CURRENCY)
     conversions_made = db.Column(db.Integer, nullable=False, default=0)
 
+    # Batch parameters, maintained by update_batch_params()
+    units_per_dest = db.Column(db.Integer)
+    total_units_per_batch = db.Column(db.Integer)
+    batch_size = db.Column(db.Integer)
+
     destination = db.relationship('Inventory', back_populates='conversions')
     sources = db.relationship('InvConversionSource', back_populates='conversion')
 
     def __repr__(self):
         return f'<{type(self).__name__} ({self.id})>'
 
-    @property
-    def units_per_dest(self):
-        """The total number of source units used in each conversion."""
-        return sum(s.units for s in self.sources)
+    @classmethod
+    def __declare_last__(cls):
+        db.event.listen(flask_sqlalchemy.SignallingSession, 'before_flush', cls._maybe_update_batch_params)
+
+    @staticmethod
+    def _maybe_update_batch_params(session, context, instances):
+        """Recompute batch parameters for conversions whose sources, or whose source listing quantities, have
+        changed."""
+        from .listings import Listing
+
+        def sources_changed(o):
+            return isinstance(o, InventoryConversion) and db.inspect(o).attrs['sources'].history.has_changes()
+
+        def source_changed(o):
+            if isinstance(o, InvConversionSource):
+                insp = db.inspect(o)
+                return insp.attrs['units'].history.has_changes() or insp.attrs['inv_id'].history.has_changes()
+            return False
+
+        def quantity_changed(o):
+            return isinstance(o, Listing) and db.inspect(o).attrs['quantity'].history.has_changes()
+
+        deleted = [o for o in session.deleted if isinstance(o, InvConversionSource)]
+        conversions = set(o for o in session.new if sources_changed(o)) \
+                      | set(o for o in session.dirty if sources_changed(o)) \
+                      | set(o.conversion for o in session.new if source_changed(o) and o.conversion) \
+                      | set(o.conversion for o in session.dirty if source_changed(o) and o.conversion) \
+                      | set(o.conversion for o in deleted if o.conversion)
+
+        listing_ids = [o.id for o in session.dirty if quantity_changed(o)]
+        if listing_ids:
+            conversions |= set(InventoryConversion._query_by_source_listings(listing_ids))
+
+        for conversion in conversions:
+            if conversion not in session.deleted:
+                conversion.update_batch_params(exclude=deleted)
+
+    @staticmethod
+    def _query_by_source_listings(listing_ids):
+        """Return a query for conversions that use any of the given listings as a source."""
+        return InventoryConversion.query.filter(
+            InventoryConversion.id.in_(
+                db.session.query(InvConversionSource.conv_id).join(
+                    Inventory, Inventory.id == InvConversionSource.inv_id
+                ).filter(
+                    Inventory.listing_id.in_(listing_ids)
+                )
+            )
+        )
+
+    @staticmethod
+    def _source_quantities(inv_ids):
+        """Return a mapping of inventory IDs to their listing quantities, using a single query. Quantities that have
+        been changed in the session but not flushed yet take precedence over the database. Unchanged quantities are
+        always read from the database, since a bulk update may have left the session's copy stale."""
+        from .listings import Listing
+
+        if not inv_ids:
+            return {}
+
+        rows = db.session.query(Inventory.id, Listing.id, Listing.quantity).join(
+            Listing, Listing.id == Inventory.listing_id
+        ).filter(
+            Inventory.id.in_(inv_ids)
+        )
+
+        mapper = db.inspect(Listing)
+        quantities = {}
+
+        for inv_id, listing_id, quantity in rows:
+            listing = db.session.identity_map.get(mapper.identity_key_from_primary_key((listing_id,)))
+            if listing is not None and db.inspect(listing).attrs['quantity'].history.has_changes():
+                quantity = listing.quantity
+
+            quantities[inv_id] = quantity
+
+        return quantities
+
+    def compute_batch(self, exclude=()):
+        """Compute the batch parameters from the current sources and listing quantities, without storing them.
+        Returns a tuple of (sources, ConversionBatch), or (sources, None) if there are no sources."""
+        sources = [s for s in self.sources if s not in exclude]
+
+        if not sources:
+            return sources, None
+
+        loaded = self._source_quantities([s.inv_id for s in sources if s.inv_id is not None])
+        units, quantities = [], []
+
+        for source in sources:
+            units.append(source.units if source.units is not None else 1)
+
+            if source.inv_id in loaded:
+                quantities.append(loaded[source.inv_id])
+            elif source.inventory is not None and source.inventory.listing is not None:
+                quantities.append(source.inventory.listing.quantity)
+            else:
+                quantities.append(None)
+
+        return sources, conversion_batch(units, quantities)
+
+    def update_batch_params(self, exclude=()):
+        """Compute and store the batch parameters. Called automatically when the sources change, or when the
+        quantity of a source listing changes."""
+        sources, batch = self.compute_batch(exclude=exclude)
+
+        if batch is None:
+            self.units_per_dest, self.total_units_per_batch, self.batch_size = None, None, None
+            return
+
+        for source, min_units, units_per_batch in zip(sources, batch.min_source_units, batch.source_units_per_batch):
+            source.min_units = min_units
+            source.units_per_batch = units_per_batch
+
+        self.units_per_dest = batch.units_per_dest
+        self.total_units_per_batch = batch.total_units_per_batch
+        self.batch_size = batch.batch_size
+
+    @classmethod
+    def refresh_batch_params(cls, listing_ids):
+        """Recompute batch parameters for all conversions that use the given listings as sources. Use this after
+        bulk updates that bypass the session, like QuantityMap.update_products()."""
+        for conversion in cls._query_by_source_listings(listing_ids):
+            conversion.update_batch_params()
+
+    def current_batch(self):
+        """Return the ConversionBatch for this conversion, or None if it has no sources. The stored parameters are
+        used if they are complete, otherwise they are computed without being stored."""
+        sources = self.sources
+        stored = (s.min_units for s in sources), (s.units_per_batch for s in sources)
+
+        if self.batch_size is not None and sources and None not in itertools.chain(*stored):
+            return ConversionBatch(
+                self.units_per_dest,
+                tuple(s.min_units for s in sources),
+                self.total_units_per_batch,
+                tuple(s.units_per_batch for s in sources),
+                self.batch_size
+            )
+
+        return self.compute_batch()[1]
 
     @property
     def min_source_units(self):
         """The minimum number of units required from each source, in a tuple."""
-        return tuple(lcm(s.inventory.listing.quantity or 1, s.units) for s in self.sources)
-
-    @property
-    def total_units_per_batch(self):
-        """The total number of source units used in each batch."""
-        return lcm(self.units_per_dest, *self.min_source_units)
+        batch = self.current_batch()
+        return batch.min_source_units if batch else ()
 
     @property
     def source_units_per_batch(self):
-        units_per_dest = self.units_per_dest
-        total_batch_units = self.total_units_per_batch
+        """The number of units used from each source in each batch, in a tuple."""
+        batch = self.current_batch()
+        return batch.source_units_per_batch if batch else ()
 
-        return tuple(total_batch_units * s.units // units_per_dest for s in self.sources)
+    @classmethod
+    def plan(cls, batches):
+        """Evaluate many conversions at once. :batches: is a mapping of conversion IDs to the number of batches
+        requested, or None to plan the maximum number of batches possible with the current inventory. Returns a
+        dictionary of conversion IDs to ConversionPlan tuples."""
+        if not batches:
+            return {}
+
+        rows = db.session.query(
+            InventoryConversion.id,
+            InventoryConversion.batch_size,
+            InvConversionSource.inv_id,
+            InvConversionSource.units_per_batch,
+            Inventory.fulfillable
+        ).join(
+            InvConversionSource, InvConversionSource.conv_id == InventoryConversion.id
+        ).join(
+            Inventory, Inventory.id == InvConversionSource.inv_id
+        ).filter(
+            InventoryConversion.id.in_(list(batches))
+        ).order_by(
+            InventoryConversion.id,
+            InvConversionSource.id
+        )
 
-    @property
-    def batch_size(self):
-        """The number of destination units produced in each batch."""
-        return self.total_units_per_batch / self.units_per_dest
+        plans = {}
+        for conv_id, conv_rows in itertools.groupby(rows, key=lambda r: r[0]):
+            conv_rows = list(conv_rows)
+            batch_size = conv_rows[0][1]
+
+            if batch_size is None or None in (r[3] for r in conv_rows):
+                continue
+
+            max_batches = min((r[4] or 0) // r[3] for r in conv_rows)
+            requested = batches[conv_id] if batches[conv_id] is not None else max_batches
+
+            plans[conv_id] = ConversionPlan(
+                conversion_id=conv_id,
+                batches=requested,
+                max_batches=max_batches,
+                feasible=requested <= max_batches,
+                required=tuple((r[2], r[3] * requested) for r in conv_rows),
+                produced=batch_size * requested
+            )
+
+        return plans
 
     def convert(self, batches=1):
         """Convert source inventory to destination inventory."""
-        required = tuple(units * batches for units in self.source_units_per_batch)
-        produced = self.batch_size * batches
+        batch = self.current_batch()
+        if batch is None:
+            raise Exception('Conversion has no sources.')
+
+        required = tuple(units * batches for units in batch.source_units_per_batch)
+        produced = batch.batch_size * batches
 
         # Check to make sure there is enough inventory to make the conversion
         sufficient_inventory = tuple(s.inventory.fulfillable >= r for s, r in zip(self.sources, required))
@@ -454,6 +876,6 @@ class InventoryConversion(db.Model):
 
     def calculate_cost(self):
         """Calculate the cost of all the converted inventory."""
-        required = tuple(units for units in self.source_units_per_batch)
+        required = self.source_units_per_batch
         cost_ea = sum(req * s.inventory.calculate_cost()[1] for req, s in zip(required, self.sources))
-        return cost_ea * self.conversions_made
\ No newline at end of file
+        return cost_ea * self.conversions_made
@@ -1,10 +1,14 @@
 import functools
+from datetime import datetime
 
+import flask_sqlalchemy
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import insert
 
-from core import db, CURRENCY
+from core import db, CURRENCY, next_ids
 from .mixins import PolymorphicMixin
+from .entities import Entity, Vendor
 from .listings import Listing, ListingDetails
 
 
@@ -64,6 +68,96 @@ class Opportunity(Relationship):
 
     # TODO: Add generated column for similarity
 
+    score = db.relationship('OpportunityScore', back_populates='opportunity', uselist=False, passive_deletes=True)
+
+    # Key of the transaction-level advisory lock held by add_candidates()
+    candidates_lock = 0x4f505053
+
+    @classmethod
+    def add_candidates(cls, candidates, session=None):
+        """Create opportunities from (market listing ID, source listing ID, similarity) tuples, using a handful of
+        set-based statements. If the source listing is already a source of any opportunity for the market listing,
+        that source's similarity is updated instead. Returns the IDs of the new opportunities.
+
+        A pair spans two tables, so it can't be protected by a unique constraint. Instead, concurrent calls are
+        serialized with an advisory lock that is held until the transaction ends, so that each call sees the
+        opportunities committed by the ones before it."""
+        session = session or db.session
+
+        # Remove duplicate pairs, keeping the best similarity for each
+        pairs = {}
+        for market_id, source_id, similarity in candidates:
+            key = (market_id, source_id)
+            if key not in pairs or (similarity or 0) > (pairs[key] or 0):
+                pairs[key] = similarity
+
+        if not pairs:
+            return []
+
+        session.execute(db.select([db.func.pg_advisory_xact_lock(cls.candidates_lock)]))
+
+        # Find the pairs that already exist
+        existing = session.query(
+            Relationship.listing_id,
+            RelationshipSource.listing_id,
+            RelationshipSource.id
+        ).join(
+            RelationshipSource, RelationshipSource.relationship_id == Relationship.id
+        ).filter(
+            Relationship.type == cls.__name__,
+            db.tuple_(Relationship.listing_id, RelationshipSource.listing_id).in_(list(pairs))
+        )
+
+        updates = []
+        for market_id, source_id, rs_id in existing:
+            similarity = pairs.pop((market_id, source_id), None)
+            if similarity is not None:
+                updates.append({'_id': rs_id, 'similarity': similarity})
+
+        if updates:
+            table = OpportunitySource.__table__
+            session.execute(
+                table.update().where(table.c.id == db.bindparam('_id')).values(similarity=db.bindparam('similarity')),
+                updates
+            )
+
+        if not pairs:
+            return []
+
+        # Insert the new opportunities and their sources
+        opp_ids = next_ids(session, Relationship.__table__, len(pairs))
+        src_ids = next_ids(session, RelationshipSource.__table__, len(pairs))
+        rows = [
+            (opp_id, src_id, market_id, source_id, similarity)
+            for opp_id, src_id, ((market_id, source_id), similarity) in zip(opp_ids, src_ids, pairs.items())
+        ]
+
+        session.execute(Relationship.__table__.insert(), [
+            {'id': opp_id, 'listing_id': market_id, 'type': cls.__name__, 'extra': {}}
+            for opp_id, src_id, market_id, source_id, similarity in rows
+        ])
+        session.execute(cls.__table__.insert(), [
+            {'id': opp_id} for opp_id, *_ in rows
+        ])
+        session.execute(RelationshipSource.__table__.insert(), [
+            {
+                'id': src_id,
+                'relationship_id': opp_id,
+                'listing_id': source_id,
+                'units': 1,
+                'type': OpportunitySource.__name__,
+                'extra': {}
+            }
+            for opp_id, src_id, market_id, source_id, similarity in rows
+        ])
+        session.execute(OpportunitySource.__table__.insert(), [
+            {'id': src_id, 'similarity': similarity}
+            for opp_id, src_id, market_id, source_id, similarity in rows
+        ])
+
+        OpportunityScore.refresh(opp_ids, session=session)
+        return opp_ids
+
     @hybrid_property
     def cost(self):
         try:
@@ -152,6 +246,202 @@ class OpportunitySource(RelationshipSource):
 ########################################################################################################################
 
 
+class OpportunityScore(db.Model):
+    """Materialized cost, revenue, selling fees, profit and ROI for an Opportunity. Rows are refreshed automatically
+    when the details of a source or market listing change, when sources are added, changed or removed, and when an
+    opportunity's market listing changes; call refresh() with no arguments after changing vendor averages."""
+    id = db.Column(db.Integer, db.ForeignKey('opportunity.id', ondelete='CASCADE'), primary_key=True)
+    cost = db.Column(CURRENCY)
+    revenue = db.Column(CURRENCY)
+    selling_fees = db.Column(CURRENCY)
+    profit = db.Column(CURRENCY)
+    roi = db.Column(db.Float)
+    updated = db.Column(db.DateTime, default=lambda: datetime.utcnow(), onupdate=lambda: datetime.utcnow())
+
+    opportunity = db.relationship('Opportunity', back_populates='score')
+
+    __table_args__ = (
+        db.Index('ix_opportunity_score_roi', roi.desc().nullslast()),
+        db.Index('ix_opportunity_score_profit', profit.desc().nullslast()),
+    )
+
+    @classmethod
+    def __declare_last__(cls):
+        db.event.listen(flask_sqlalchemy.SignallingSession, 'after_flush', cls._maybe_refresh)
+
+    @staticmethod
+    def _maybe_refresh(session, context):
+        """Refresh scores for any opportunities affected by the flush."""
+        def listing_changed(o):
+            if isinstance(o, Listing):
+                insp = db.inspect(o)
+                return insp.attrs['quantity'].history.has_changes() or insp.attrs['extra'].history.has_changes()
+            return False
+
+        def market_changed(o):
+            return isinstance(o, Opportunity) and db.inspect(o).attrs['listing_id'].history.has_changes()
+
+        changed = session.new | session.dirty
+
+        listing_ids = set(o.listing_id for o in changed | session.deleted if isinstance(o, ListingDetails)) \
+                      | set(o.id for o in session.dirty if listing_changed(o))
+
+        opp_ids = set(o.id for o in session.new if isinstance(o, Opportunity)) \
+                  | set(o.id for o in session.dirty if market_changed(o)) \
+                  | set(o.relationship_id for o in changed | session.deleted if isinstance(o, OpportunitySource))
+
+        # Deleted opportunities take their scores with them
+        opp_ids -= set(o.id for o in session.deleted if isinstance(o, Opportunity))
+
+        listing_ids.discard(None)
+        opp_ids.discard(None)
+
+        if listing_ids:
+            opp_ids.update(id for id, in session.query(Opportunity.id).filter(
+                db.or_(
+                    Opportunity.listing_id.in_(listing_ids),
+                    Opportunity.id.in_(
+                        db.select([RelationshipSource.relationship_id]).where(
+                            RelationshipSource.listing_id.in_(listing_ids)
+                        )
+                    )
+                )
+            ))
+
+        if opp_ids:
+            OpportunityScore.refresh(opp_ids, session=session)
+
+    @classmethod
+    def refresh(cls, opportunity_ids=None, session=None):
+        """Recompute the scores for the given opportunities (or all opportunities) with a single statement."""
+        session = session or db.session
+        opportunity_ids = list(opportunity_ids) if opportunity_ids is not None else None
+        if opportunity_ids is not None and not opportunity_ids:
+            return
+
+        relationship, opportunity = Relationship.__table__, Opportunity.__table__
+        opps = db.select([opportunity.c.id, relationship.c.listing_id]).where(opportunity.c.id == relationship.c.id)
+        sources = db.select([
+            RelationshipSource.relationship_id,
+            RelationshipSource.listing_id,
+            RelationshipSource.units
+        ])
+
+        if opportunity_ids is not None:
+            opps = opps.where(opportunity.c.id.in_(opportunity_ids))
+            sources = sources.where(RelationshipSource.relationship_id.in_(opportunity_ids))
+        else:
+            sources = sources.where(RelationshipSource.relationship_id.in_(db.select([opportunity.c.id])))
+
+        opps, sources = opps.alias('opps'), sources.alias('sources')
+
+        # The most recent price for every listing involved
+        latest = db.select([
+            ListingDetails.listing_id,
+            ListingDetails.price
+        ]).distinct(
+            ListingDetails.listing_id
+        ).order_by(
+            ListingDetails.listing_id,
+            ListingDetails.timestamp.desc()
+        )
+
+        if opportunity_ids is not None:
+            latest = latest.where(ListingDetails.listing_id.in_(
+                db.union(
+                    db.select([relationship.c.listing_id]).where(relationship.c.id.in_(opportunity_ids)),
+                    db.select([RelationshipSource.listing_id]).where(
+                        RelationshipSource.relationship_id.in_(opportunity_ids)
+                    )
+                )
+            ))
+
+        latest = latest.alias('latest')
+
+        # Estimated cost of one unit of the market listing, summed over all of its sources. Mirrors
+        # Listing.estimated_unit_cost and Opportunity.cost.
+        src = Listing.__table__.alias('src')
+        vendor = Vendor.__table__
+        estimated_cost = db.cast(latest.c.price * (1 + vendor.c.avg_shipping + vendor.c.avg_tax), CURRENCY)
+        unit_cost = estimated_cost / src.c.quantity
+        costs = db.select([
+            sources.c.relationship_id.label('id'),
+            db.func.sum(unit_cost * sources.c.units).label('unit_cost'),
+            db.func.every(unit_cost != None).label('complete')
+        ]).select_from(
+            sources.join(
+                src, src.c.id == sources.c.listing_id
+            ).join(
+                vendor, vendor.c.id == src.c.vendor_id
+            ).outerjoin(
+                latest, latest.c.listing_id == src.c.id
+            )
+        ).group_by(
+            sources.c.relationship_id
+        ).alias('costs')
+
+        # Selling fees come from the market listing, or are estimated from its vendor's average fee rate. Mirrors
+        # Opportunity.profit.
+        market = Listing.__table__.alias('market')
+        seller = Entity.__table__.alias('seller')
+        cost = db.case([(costs.c.complete, db.cast(costs.c.unit_cost * market.c.quantity, CURRENCY))], else_=None)
+        revenue = latest.c.price
+        selling_fees = db.func.coalesce(
+            db.cast(market.c.extra['selling_fees'].astext, CURRENCY),
+            db.cast(revenue * db.cast(seller.c.extra['avg_selling_fees'].astext, db.Float), CURRENCY)
+        )
+        profit = db.cast(revenue - selling_fees - cost, CURRENCY)
+        roi = db.cast(profit / db.func.nullif(cost, 0), db.Float)
+
+        scores = db.select([
+            opps.c.id,
+            db.literal(cls.__name__),
+            db.literal_column("'{}'::jsonb"),
+            cost,
+            revenue,
+            selling_fees,
+            profit,
+            roi,
+            db.func.now()
+        ]).select_from(
+            opps.join(
+                market, market.c.id == opps.c.listing_id
+            ).join(
+                seller, seller.c.id == market.c.vendor_id
+            ).outerjoin(
+                latest, latest.c.listing_id == market.c.id
+            ).outerjoin(
+                costs, costs.c.id == opps.c.id
+            )
+        )
+
+        table = cls.__table__
+        stmt = insert(table).from_select(
+            ['id', 'type', 'extra', 'cost', 'revenue', 'selling_fees', 'profit', 'roi', 'updated'],
+            scores
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={col: getattr(stmt.excluded, col) for col in
+                  ('cost', 'revenue', 'selling_fees', 'profit', 'roi', 'updated')}
+        )
+
+        session.execute(stmt)
+
+    @classmethod
+    def top(cls, n=100, by='roi'):
+        """Return a query for the top :n: opportunities, ordered by ROI or profit."""
+        column = getattr(cls, by)
+        return Opportunity.query.join(
+            cls, cls.id == Opportunity.id
+        ).order_by(
+            column.desc().nullslast()
+        ).limit(n)
+
+
+########################################################################################################################
+
+
 # class InventoryConversion(Relationship):
 #     """Information needed to convert one or more sku's into another. Used when creating multipacks, combo packs,
 #     or when repackaging a SKU."""
@@ -6,6 +6,13 @@ import core
 ########################################################################################################################
 
 
+class SearchError(Exception):
+    """Raised when one of the searches in a multi-search request fails."""
+
+
+########################################################################################################################
+
+
 class ColanderSearch:
     """Provides text-search functionality."""
 
@@ -95,8 +102,8 @@ class ColanderSearch:
         index = self._index(model_or_type)
         self.es.indices.delete(index=index, ignore=400)
 
-    def _search(self, query, model_types=None, min_score=None, page=1, per_page=10):
-        indexes = '_all' #','.join(set([self._index(mt) for mt in model_types]))
+    def _search_body(self, query, model_types=None, min_score=None, page=1, per_page=10):
+        """Build the request body for a search."""
         query_filter = query.pop('filter', [])
         if model_types:
             body = {
@@ -120,7 +127,10 @@ class ColanderSearch:
         body['size'] = per_page
         body['_source'] = ['__model_type__']
 
-        results = self.es.search(index=indexes, doc_type='doc', body=body)
+        return body
+
+    def _format_hits(self, results):
+        """Convert the results of a search into a list of hits and a total."""
         total = results['hits']['total']
         max_score = results['hits']['max_score']
         hits = [
@@ -134,6 +144,30 @@ class ColanderSearch:
 
         return hits, total
 
+    def _search(self, query, model_types=None, min_score=None, page=1, per_page=10):
+        indexes = '_all' #','.join(set([self._index(mt) for mt in model_types]))
+        body = self._search_body(query, model_types=model_types, min_score=min_score, page=page, per_page=per_page)
+        results = self.es.search(index=indexes, doc_type='doc', body=body)
+        return self._format_hits(results)
+
+    def _msearch(self, queries, **kwargs):
+        """Run several searches in a single request. Returns a list of (hits, total) tuples, in the same order
+        as :queries:. Raises SearchError if any of the searches failed."""
+        if not queries:
+            return []
+
+        body = []
+        for query in queries:
+            body.append({'index': '_all', 'type': 'doc'})
+            body.append(self._search_body(query, **kwargs))
+
+        responses = self.es.msearch(body=body)['responses']
+        errors = [(idx, r['error']) for idx, r in enumerate(responses) if 'error' in r]
+        if errors:
+            raise SearchError(f'{len(errors)} of {len(responses)} searches failed: {errors[:3]}')
+
+        return [self._format_hits(r) for r in responses]
+
     def search(self, query, **kwargs):
         """Get a list of models that match the query."""
         query = {
@@ -157,8 +191,9 @@ class ColanderSearch:
 
         return self._search(query, model_types=model_types, **kwargs)
 
-    def find_matching_listings(self, listing, **kwargs):
-        """Find listings for the same type of product."""
+    def _matching_listings_query(self, listing):
+        """Build a query that finds listings for the same type of product. Returns None if the listing doesn't
+        contain enough information to match."""
         brand_match = {
             'multi_match': {
                 'query': listing.brand,
@@ -193,14 +228,33 @@ class ColanderSearch:
             must = [title_match]
             should = []
         else:
-            return []
+            return None
 
-        query = {k: v for k, v in {
+        return {k: v for k, v in {
             'must': must,
             'should': should,
             'must_not': [{'ids': {'values': [listing.id]}}],
         }.items() if v}
 
+    def find_matching_listings(self, listing, **kwargs):
+        """Find listings for the same type of product."""
+        query = self._matching_listings_query(listing)
+        if query is None:
+            return []
+
         model_types = kwargs.pop('model_types', type(listing).all_subclasses())
 
         return self._search(query, model_types=model_types, **kwargs)
+
+    def find_matching_listings_bulk(self, listings, **kwargs):
+        """Find matching listings for many listings in a single request. Returns a dictionary mapping listing
+        IDs to (hits, total) tuples. Listings without enough information to match are omitted."""
+        queries = [(listing, self._matching_listings_query(listing)) for listing in listings]
+        queries = [(listing, query) for listing, query in queries if query is not None]
+        if not queries:
+            return {}
+
+        model_types = kwargs.pop('model_types', type(queries[0][0]).all_subclasses())
+        results = self._msearch([query for listing, query in queries], model_types=model_types, **kwargs)
+
+        return {listing.id: result for (listing, query), result in zip(queries, results)}
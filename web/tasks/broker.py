@@ -1,16 +1,35 @@
+import redis
 import dramatiq
 from dramatiq.brokers.redis import RedisBroker
 from dramatiq.results.backends import RedisBackend as RedisResultsBackend
 from dramatiq.rate_limits.backends import RedisBackend as RedisRateLimiterBackend
 from dramatiq.results import Results
 
-from urllib.parse import urlsplit
 from config import Config
 
 
 ########################################################################################################################
 
 
+def _build_pool(config_class):
+    """Return a connection pool for the Redis server in :config_class:. When every connection is in use, callers
+    wait up to REDIS_POOL_TIMEOUT seconds for one to be released instead of failing immediately."""
+    return redis.BlockingConnectionPool.from_url(
+        config_class.REDIS_URL,
+        max_connections=config_class.REDIS_MAX_CONNECTIONS,
+        timeout=config_class.REDIS_POOL_TIMEOUT
+    )
+
+
+def _pool_settings(config_class):
+    return config_class.REDIS_URL, config_class.REDIS_MAX_CONNECTIONS, config_class.REDIS_POOL_TIMEOUT
+
+
+# A single client and connection pool shared by the broker, the backends, TaskContext and the actors. Other modules
+# import redis_client itself, so setup_dramatiq() changes its pool in place instead of replacing it.
+redis_pool = _build_pool(Config)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
 broker = None
 results_backend = None
 rate_limiter_backend = None
@@ -20,26 +39,17 @@ rate_limiter_backend = None
 
 
 def setup_dramatiq(config_class=Config):
-    global broker, results_backend, rate_limiter_backend
-    o = urlsplit(config_class.REDIS_URL)
-
-    results_backend = RedisResultsBackend(
-        host=o.hostname,
-        port=o.port,
-        db=o.path.split('/')[-1] or None,
-        password=o.password
-    )
+    global broker, results_backend, rate_limiter_backend, redis_pool
 
-    rate_limiter_backend = RedisRateLimiterBackend(
-        host=o.hostname,
-        port=o.port,
-        db=o.path.split('/')[-1] or None,
-        password=o.password
-    )
+    if _pool_settings(config_class) != _pool_settings(Config):
+        redis_pool.disconnect()
+        redis_pool = _build_pool(config_class)
+        redis_client.connection_pool = redis_pool
+
+    results_backend = RedisResultsBackend(client=redis_client)
+    rate_limiter_backend = RedisRateLimiterBackend(client=redis_client)
 
-    broker = RedisBroker(url=config_class.REDIS_URL)
+    broker = RedisBroker(client=redis_client)
     broker.add_middleware(Results(backend=results_backend))
 
     dramatiq.set_broker(broker)
-
-
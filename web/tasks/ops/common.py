@@ -1,16 +1,16 @@
 import json
-import redis
 import dramatiq
 import sqlalchemy
 import requests
 import uuid
 import time
 import enum
+import zlib
 
 import marshmallow as mm
 
-from config import Config
 from core import app, db, search
+from tasks.broker import redis_client
 
 
 ########################################################################################################################
@@ -18,6 +18,9 @@ from core import app, db, search
 
 ISO_8601 = '%Y-%m-%dT%H:%M:%S'
 
+# Returned from perform() by actors that will complete their message later, from another worker.
+DEFERRED = object()
+
 
 ########################################################################################################################
 # The following is copied-and-modifief from the Dramatiq source code
@@ -136,10 +139,193 @@ class GenericActor(metaclass=generic_actor):
 ########################################################################################################################
 
 
+# Lua scripts used by TaskContext. Each context keeps a list of its ancestors, and a 'tree' hash of counters that
+# cover the context and all of its descendants. Every script that changes a counter also updates the tree hashes of
+# all the context's ancestors, so that reading the progress of a whole tree takes a single command.
+#
+# The scripts only touch the keys they are passed in KEYS. The ancestors of a context never change once it has been
+# linked, so TaskContext reads the list once and passes the ancestors' keys in along with the context's own. Scripts
+# that touch several contexts need all of their keys on the same server, so they don't work with Redis Cluster.
+
+
+# Adds :amount: to :field: in the tree hashes at KEYS[first], KEYS[first + 1], ... KEYS[last]
+_ROLL_UP = """
+local function roll_up(first, last, field, amount)
+    for i = first, last do
+        redis.call('HINCRBY', KEYS[i], field, amount)
+    end
+end
+"""
+
+# KEYS = {child ancestors, parent children, child tree, parent tree, parent's ancestors' trees...}
+# ARGV = {parent ID, child ID, timestamp, parent's ancestor IDs...}
+_LINK_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+
+local tree = redis.call('HGETALL', KEYS[3])
+for k = 4, #KEYS do
+    for i = 1, #tree, 2 do
+        redis.call('HINCRBY', KEYS[k], tree[i], tree[i + 1])
+    end
+end
+
+return redis.call('ZADD', KEYS[2], 'NX', ARGV[3], ARGV[2])
+"""
+
+# KEYS = {messages, pending, bodies, tree, ancestors' trees...}
+# ARGV = {timestamp, queue ('1' or '0'), message ID, body, message ID, body, ...}
+_BIND_SCRIPT = _ROLL_UP + """
+local added = 0
+for i = 3, #ARGV, 2 do
+    local new = redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[i])
+    if new == 1 then
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+        if ARGV[2] == '1' then
+            redis.call('RPUSH', KEYS[2], ARGV[i])
+        end
+    end
+    added = added + new
+end
+
+if added > 0 then
+    roll_up(4, #KEYS, 'total', added)
+end
+
+return added
+"""
+
+_POP = """
+local function pop(pending_key, sent_key, errors_key, bodies_key, timestamp)
+    while true do
+        local msg_id = redis.call('LPOP', pending_key)
+        if not msg_id then
+            return false
+        end
+
+        if redis.call('HEXISTS', errors_key, msg_id) == 0
+            and redis.call('ZADD', sent_key, 'NX', timestamp, msg_id) == 1 then
+            return redis.call('HGET', bodies_key, msg_id)
+        end
+    end
+end
+"""
+
+# KEYS = {pending, sent, errors, bodies}
+# ARGV = {timestamp}
+_POP_SCRIPT = _POP + """
+return pop(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1])
+"""
+
+# KEYS = {sent, pending}
+# ARGV = {message ID}
+_REQUEUE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Sets the status of a chunk of contexts. When the new status is 'running', the next pending message of each context
+# is popped and returned, along with the ID of its context, so that it can be sent. If :propagate: is set, the IDs of
+# the contexts' children are returned too, so that the caller can set their status next.
+# KEYS = {status, children, pending, sent, errors, bodies, tree} for each context
+# ARGV = {status, propagate ('1' or '0'), running status, complete status, timestamp, context ID, context ID, ...}
+_STATUS_SCRIPT = _POP + """
+local popped, children = {}, {}
+
+for n = 6, #ARGV do
+    local k = (n - 6) * 7
+    redis.call('SET', KEYS[k + 1], ARGV[1])
+
+    if ARGV[2] == '1' then
+        for _, child_id in ipairs(redis.call('ZRANGE', KEYS[k + 2], 0, -1)) do
+            table.insert(children, child_id)
+        end
+    end
+
+    if ARGV[1] == ARGV[3] then
+        local msg = pop(KEYS[k + 3], KEYS[k + 4], KEYS[k + 5], KEYS[k + 6], ARGV[5])
+        if msg then
+            table.insert(popped, ARGV[n])
+            table.insert(popped, msg)
+        else
+            local progress = redis.call('HMGET', KEYS[k + 7], 'completed', 'total')
+            if tonumber(progress[1] or 0) == tonumber(progress[2] or 0) then
+                redis.call('SET', KEYS[k + 1], ARGV[4])
+            end
+        end
+    end
+end
+
+return {popped, children}
+"""
+
+# KEYS = {completed, tree, ancestors' trees...}
+# ARGV = {timestamp, message ID, message ID, ...}
+_COMPLETE_SCRIPT = _ROLL_UP + """
+local added = 0
+for i = 2, #ARGV do
+    added = added + redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[i])
+end
+
+if added > 0 then
+    roll_up(2, #KEYS, 'completed', added)
+end
+
+return added
+"""
+
+# KEYS = {errors, tree_errors, ancestors' tree_errors..., tree, ancestors' trees...}
+# ARGV = {message ID, error, number of contexts (the context and its ancestors)}
+_ERROR_SCRIPT = _ROLL_UP + """
+local n = tonumber(ARGV[3])
+local added = redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+
+for i = 2, n + 1 do
+    redis.call('HSET', KEYS[i], ARGV[1], ARGV[2])
+end
+
+if added > 0 then
+    roll_up(n + 2, #KEYS, 'errors', 1)
+end
+
+return added
+"""
+
+# KEYS = {counts, global actor counts, tree, ancestors' trees...}
+# ARGV = {actor name}
+_COUNT_SCRIPT = _ROLL_UP + """
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+roll_up(3, #KEYS, 'count:' .. ARGV[1], 1)
+"""
+
+
 class TaskContext:
     """Holds context information for a task or group of tasks."""
-    redis = redis.from_url(Config.REDIS_URL)
+    redis = redis_client
     default_expire = 60
+    compress_threshold = 512
+    tree_chunk_size = 100  # Contexts per command when walking a tree
+    members = ('data', 'messages', 'bodies', 'pending', 'sent', 'completed', 'children', 'errors', 'counts', 'status',
+               'ancestors', 'tree', 'tree_errors')
+
+    _scripts = {}
+    _script_sources = {
+        'link': _LINK_SCRIPT,
+        'bind': _BIND_SCRIPT,
+        'pop': _POP_SCRIPT,
+        'requeue': _REQUEUE_SCRIPT,
+        'status': _STATUS_SCRIPT,
+        'complete': _COMPLETE_SCRIPT,
+        'error': _ERROR_SCRIPT,
+        'count': _COUNT_SCRIPT
+    }
 
     class Status(enum.Enum):
         """Status codes for TaskContext."""
@@ -152,8 +338,14 @@ class TaskContext:
 
     # Magic methods
 
-    def __init__(self, *messages, id=None, data=None, status=None):
+    def __init__(self, *messages, id=None, data=None, status=None, parent=None):
         self._id = id or self._build_id()
+        self._data = None  # Cached context data, loaded on first access
+        self._ancestors = None if id else []  # Cached ancestor IDs; they don't change once the context is linked
+
+        if parent is not None:
+            self._link(parent)
+
         self.bind(*messages)
 
         if data is not None:
@@ -164,15 +356,27 @@ class TaskContext:
 
     def __getitem__(self, item):
         """Access an item in the context data."""
-        return self.data[item]
+        if self._data is not None:
+            return self._data[item]
+
+        value = self.redis.hget(self._key_for('data'), item)
+        if value is None:
+            raise KeyError(item)
+
+        return json.loads(value)
 
     def __setitem__(self, key, value):
-        data = self.data
-        data[key] = value
-        self.data = data
+        """Set a single item in the context data, without touching the other items."""
+        self.redis.hset(self._key_for('data'), key, json.dumps(value))
+
+        if self._data is not None:
+            self._data[key] = value
 
     def __contains__(self, item):
-        return item in self.data
+        if self._data is not None:
+            return item in self._data
+
+        return bool(self.redis.hexists(self._key_for('data'), item))
 
     # Private methods
 
@@ -180,6 +384,10 @@ class TaskContext:
         """Build a key based on a data member's name."""
         return f'{self._id}_{member}'
 
+    def _decode_data(self, data):
+        """Decodes the context data hash returned from Redis."""
+        return {k.decode(): json.loads(v) for k, v in data.items()}
+
     def _decode_dicts(self, *dicts):
         """Decodes a mapping returned from Redis. If multiple dicts are provided, a tuple is returned."""
         r = tuple(
@@ -192,6 +400,22 @@ class TaskContext:
         else:
             return r
 
+    def _encode_message(self, msg):
+        """Serialize a message for storage. Large messages are compressed."""
+        data = json.dumps(dict(msg.asdict()), separators=(',', ':')).encode()
+        if len(data) > self.compress_threshold:
+            return b'z' + zlib.compress(data)
+        return b'j' + data
+
+    def _decode_message(self, data):
+        """Deserialize a message created by _encode_message()."""
+        if data[:1] == b'z':
+            data = zlib.decompress(data[1:])
+        else:
+            data = data[1:]
+
+        return dramatiq.Message(**json.loads(data.decode()))
+
     def _decode_lists(self, *lists):
         """Decodes a list of items returned from Redis. If multiple lists are provided, a tuple is returned."""
         r = tuple(
@@ -208,6 +432,73 @@ class TaskContext:
         """Creates an ID for a context."""
         return str(uuid.uuid4()) + '_ctx'
 
+    def _run_script(self, name, keys=(), args=()):
+        """Run one of the context's Lua scripts."""
+        script = self._scripts.get(name)
+        if script is None:
+            script = TaskContext._scripts[name] = self.redis.register_script(self._script_sources[name])
+
+        return script(keys=keys, args=args)
+
+    def _link(self, parent):
+        """Make this context a child of :parent:, and add its counters to all of its new ancestors."""
+        ancestors = [parent.id, *parent.ancestors]
+        self._run_script(
+            'link',
+            keys=(self._key_for('ancestors'), parent._key_for('children'), self._key_for('tree'),
+                  *(f'{ctx_id}_tree' for ctx_id in ancestors)),
+            args=(parent.id, self._id, time.time(), *ancestors[1:])
+        )
+        self._ancestors = ancestors
+
+    def _keys_up(self, member):
+        """Return the keys of :member: for this context and each of its ancestors."""
+        return [self._key_for(member), *(f'{ctx_id}_{member}' for ctx_id in self.ancestors)]
+
+    def _tree(self):
+        """Return the counters for this context and all of its descendants."""
+        key = self._key_for('tree')
+        data = self.redis.hgetall(key)
+        return {k.decode(): int(v) for k, v in data.items()}
+
+    def fetch(self, *members):
+        """Read several members of the context in a single round trip. Returns a dictionary of decoded values."""
+        readers = {
+            'data': lambda pipe: pipe.hgetall(self._key_for('data')),
+            'status': lambda pipe: pipe.get(self._key_for('status')),
+            'sent': lambda pipe: pipe.zrange(self._key_for('sent'), 0, -1),
+            'completed': lambda pipe: pipe.zrange(self._key_for('completed'), 0, -1),
+            'children': lambda pipe: pipe.zrange(self._key_for('children'), 0, -1),
+            'errors': lambda pipe: pipe.hgetall(self._key_for('tree_errors')),
+            'tree': lambda pipe: pipe.hgetall(self._key_for('tree')),
+            'ancestors': lambda pipe: pipe.lrange(self._key_for('ancestors'), 0, -1)
+        }
+
+        pipe = self.redis.pipeline()
+        for member in members:
+            readers[member](pipe)
+
+        fetched = {}
+        for member, value in zip(members, pipe.execute()):
+            if member == 'data':
+                value = self._decode_data(value)
+                self._data = value.copy()
+            elif member == 'status':
+                value = self.Status(int(value)) if value is not None else self.Status.default
+            elif member == 'errors':
+                value = self._decode_dicts(value)
+            elif member == 'tree':
+                value = {k.decode(): int(v) for k, v in value.items()}
+            elif member == 'ancestors':
+                value = self._decode_lists(value)
+                self._ancestors = value
+            else:
+                value = self._decode_lists(value)
+
+            fetched[member] = value
+
+        return fetched
+
     # Redis properties
 
     @property
@@ -215,55 +506,93 @@ class TaskContext:
         """Returns the ID of the context. This property is read-only."""
         return self._id
 
+    @property
+    def ancestors(self):
+        """The IDs of this context's parent, grandparent, etc. They are read once, and cached."""
+        if self._ancestors is None:
+            key = self._key_for('ancestors')
+            self._ancestors = self._decode_lists(self.redis.lrange(key, 0, -1))
+
+        return list(self._ancestors)
+
     @property
     def data(self):
-        """The context's data dictionary."""
-        key = self._key_for('data')
-        data = self.redis.get(key)
+        """The context's data dictionary. Values are stored in a Redis hash, one field per key, and cached after
+        the first read."""
+        if self._data is None:
+            key = self._key_for('data')
+            self._data = self._decode_data(self.redis.hgetall(key))
 
-        if data:
-            return json.loads(data)
-        else:
-            return dict()
+        return self._data.copy()
 
     @data.setter
     def data(self, new):
         key = self._key_for('data')
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
 
         if new:
-            data = json.dumps(new)
-            self.redis.set(key, data)
-        else:
-            self.redis.delete(key)
+            pipe.hmset(key, {k: json.dumps(v) for k, v in new.items()})
+
+        pipe.execute()
+        self._data = dict(new) if new else {}
 
     @property
-    def messages(self):
-        """The messages that this context will execute."""
+    def message_ids(self):
+        """The IDs of the messages that this context will execute."""
         key = self._key_for('messages')
         data = self.redis.zrange(key, 0, -1)
-        return [dramatiq.Message(**json.loads(msg)) for msg in data]
+        return self._decode_lists(data)
+
+    @property
+    def messages(self):
+        """The messages that this context will execute."""
+        return self.get_messages(*self.message_ids)
+
+    def get_messages(self, *message_ids):
+        """Load and decode the messages with the given IDs."""
+        if not message_ids:
+            return []
 
-    def bind(self, *messages):
+        key = self._key_for('bodies')
+        data = self.redis.hmget(key, *message_ids)
+        return [self._decode_message(body) for body in data if body is not None]
+
+    def bind(self, *messages, queue=True):
         """Adds the message to this context's actions and returns a copy of the Dramatiq message,
-        with context parameters added."""
+        with context parameters added. If :queue: is False, the messages count towards the context's progress
+        but are never sent by the context."""
         if not messages:
             return
 
-        key = self._key_for('messages')
         add_messages = []
 
         for msg in messages:
             kwargs = msg.kwargs.copy()
             kwargs.update(_ctx=self._id, _msg_id=msg.message_id)
             new_msg = msg.copy(kwargs=kwargs)
-            new_msg = json.dumps(dict(new_msg.asdict()))
-            add_messages.append(time.time())
-            add_messages.append(new_msg)
+            add_messages.extend((msg.message_id, self._encode_message(new_msg)))
 
-        self.redis.execute_command('ZADD', key, 'NX', *add_messages)
+        self._run_script(
+            'bind',
+            keys=(self._key_for('messages'), self._key_for('pending'), self._key_for('bodies'),
+                  *self._keys_up('tree')),
+            args=(time.time(), '1' if queue else '0', *add_messages)
+        )
         self.persist()
         return self
 
+    def track(self, *messages):
+        """Bind messages that are executed outside of the broker, like spiders. They count towards the context's
+        progress, but are never sent."""
+        self.bind(*messages, queue=False)
+
+        key = self._key_for('sent')
+        pipe = self.redis.pipeline()
+        for msg in messages:
+            pipe.execute_command('ZADD', key, 'NX', time.time(), msg.message_id)
+        pipe.execute()
+
     @property
     def sent(self):
         """Messages already sent to the broker."""
@@ -279,27 +608,28 @@ class TaskContext:
         self.bind(*messages)
 
         if self.status != self.Status.running:
-            return
-
-        # Get the current state of messages and sent
-        sent_key = self._key_for('sent')
-        messages, sent, errors = self.messages, self.sent, self.errors
-
-        for msg in messages:
+            return False
 
-            if msg.message_id not in sent\
-                and msg.message_id not in errors\
-                    and self.redis.execute_command('ZADD', sent_key, 'NX', time.time(), msg.message_id):
+        # Pop the next unsent message off the pending queue and mark it as sent
+        msg = self._run_script(
+            'pop',
+            keys=(self._key_for('pending'), self._key_for('sent'), self._key_for('errors'), self._key_for('bodies')),
+            args=(time.time(),)
+        )
 
-                broker = dramatiq.get_broker()
-                broker.enqueue(msg)
-                self.count_message(msg)
-                return
+        if msg:
+            msg = self._decode_message(msg)
+            broker = dramatiq.get_broker()
+            broker.enqueue(msg)
+            self.count_message(msg)
+            return True
 
         completed, total = self.progress()
         if completed == total:
             self.status = self.Status.complete
 
+        return False
+
     @property
     def completed(self):
         """Messages that completed successfully."""
@@ -309,13 +639,15 @@ class TaskContext:
 
     def complete(self, *message_ids):
         """Add messages to the completed list."""
-        key = self._key_for('completed')
-        pipe = self.redis.pipeline()
-
-        for msg_id in message_ids:
-            pipe.execute_command('ZADD', key, 'NX', time.time(), msg_id)
+        message_ids = [msg_id for msg_id in message_ids if msg_id is not None]
+        if not message_ids:
+            return
 
-        pipe.execute()
+        self._run_script(
+            'complete',
+            keys=(self._key_for('completed'), *self._keys_up('tree')),
+            args=(time.time(), *message_ids)
+        )
 
     @property
     def children(self):
@@ -328,61 +660,46 @@ class TaskContext:
         """Create a child context and bind it to this context."""
         status = self.status
         child_status = status if status in (self.Status.running, self.Status.paused, self.Status.cancelled) else None
-        child = TaskContext(*messages, data=data, status=child_status)
-
-        key = self._key_for('children')
-        self.redis.zadd(key, child.id, time.time())
+        child = TaskContext(*messages, data=data, status=child_status, parent=self)
         self.persist()
         return child
 
     @property
     def errors(self):
-        """A mapping of message IDs to error codes."""
-        key = self._key_for('errors')
+        """A mapping of message IDs to error codes, for this context and all of its descendants."""
+        key = self._key_for('tree_errors')
         data = self.redis.hgetall(key)
-        errors = self._decode_dicts(data)
-
-        for child_id in self.children:
-            child = TaskContext(id=child_id)
-            errors.update(**child.errors)
-
-        return errors
+        return self._decode_dicts(data)
 
     def log_error(self, msg_id, err):
         """Logs an error."""
-        key = self._key_for('errors')
-        self.redis.hset(key, msg_id, err)
+        tree_errors = self._keys_up('tree_errors')
+        self._run_script(
+            'error',
+            keys=(self._key_for('errors'), *tree_errors, *self._keys_up('tree')),
+            args=(msg_id, err, len(tree_errors))
+        )
 
     @property
     def counts(self):
         """How many times a given actor has been executed by this context, or one of its children."""
-        key = self._key_for('counts')
-        data = self.redis.hgetall(key)
-        counts = {k.decode(): int(v) for k, v in data.items()}
-        for child_id in self.children:
-            child_counts = TaskContext(id=child_id).counts
-
-            for actor, count in child_counts.items():
-                counts[actor] = counts.get(actor, 0) + count
+        return self._counts_from_tree(self._tree())
 
-        return counts
+    def _counts_from_tree(self, tree):
+        return {k[len('count:'):]: v for k, v in tree.items() if k.startswith('count:')}
 
     def count_message(self, msg):
-        key = self._key_for('counts')
-        self.redis.hincrby(key, msg.actor_name, 1)
-        self.redis.hincrby('actor_counts', msg.actor_name, 1)
+        self._run_script(
+            'count',
+            keys=(self._key_for('counts'), 'actor_counts', *self._keys_up('tree')),
+            args=(msg.actor_name,)
+        )
 
     def progress(self):
-        completed = len(self.completed)
-        total = len(self.messages)
-
-        for child_id in self.children:
-            child = TaskContext(id=child_id)
-            child_completed, child_total = child.progress()
-            completed += child_completed
-            total += child_total
-
-        return completed, total
+        """Returns a (completed, total) tuple for this context and all of its descendants."""
+        key = self._key_for('tree')
+        completed, total = self.redis.hmget(key, 'completed', 'total')
+        return int(completed or 0), int(total or 0)
 
     @property
     def status(self):
@@ -393,22 +710,48 @@ class TaskContext:
 
     @status.setter
     def status(self, status):
-        """Recursively set the status of this context and its children."""
+        """Set the status of this context and its children; if the new status is 'running', the next message of
+        each context is sent. The tree is updated a level at a time, in chunks of tree_chunk_size contexts, so that
+        large trees don't block Redis. A parent's status is always set before its children are read, so children
+        created while the tree is being updated inherit the new status."""
         if isinstance(status, int):
             status = self.Status(status)
         elif isinstance(status, str):
             status = self.Status[status]
 
-        key = self._key_for('status')
-        self.redis.set(key, status.value)
-
-        if status in (self.Status.running, self.Status.paused, self.Status.cancelled):
-            for child_id in self.children:
-                child = TaskContext(id=child_id)
-                child.status = status
-
-        if status == self.Status.running:
-            self.send()
+        propagate = status in (self.Status.running, self.Status.paused, self.Status.cancelled)
+        members = ('status', 'children', 'pending', 'sent', 'errors', 'bodies', 'tree')
+        broker = dramatiq.get_broker()
+        level = [self._id]
+
+        while level:
+            children = []
+
+            for start in range(0, len(level), self.tree_chunk_size):
+                chunk = level[start:start + self.tree_chunk_size]
+                popped, chunk_children = self._run_script(
+                    'status',
+                    keys=[f'{ctx_id}_{member}' for ctx_id in chunk for member in members],
+                    args=(status.value, '1' if propagate else '0', self.Status.running.value,
+                          self.Status.complete.value, time.time(), *chunk)
+                )
+                children.extend(self._decode_lists(chunk_children))
+
+                for ctx_id, body in zip(popped[::2], popped[1::2]):
+                    msg = self._decode_message(body)
+                    broker.enqueue(msg)
+                    TaskContext(id=ctx_id.decode()).count_message(msg)
+
+            level = children
+
+    def requeue(self, msg_id):
+        """Return a sent message to the front of the pending queue, so that it is sent again when the context
+        is resumed."""
+        self._run_script(
+            'requeue',
+            keys=(self._key_for('sent'), self._key_for('pending')),
+            args=(msg_id,)
+        )
 
     def copy(self):
         return self.data.copy()
@@ -417,39 +760,27 @@ class TaskContext:
         """Return a dictionary representation of the context object."""
 
         pipe = self.redis.pipeline()
-        pipe.get(self._key_for('data'))
+        pipe.hgetall(self._key_for('data'))
         pipe.zrange(self._key_for('messages'), 0, -1)
         pipe.zrange(self._key_for('sent'), 0, -1)
         pipe.zrange(self._key_for('completed'), 0, -1)
         pipe.zrange(self._key_for('children'), 0, -1)
-        pipe.hgetall(self._key_for('errors'))
-        pipe.hgetall(self._key_for('counts'))
+        pipe.hgetall(self._key_for('tree_errors'))
+        pipe.hgetall(self._key_for('tree'))
         pipe.get(self._key_for('status'))
-        data, messages, sent, completed, children, errors, counts, status = pipe.execute()
+        data, messages, sent, completed, children, errors, tree, status = pipe.execute()
 
-        data = json.loads(data) if data else {}
-        messages = [json.loads(msg) for msg in messages]
+        data = self._decode_data(data)
+        messages = self._decode_lists(messages)
         sent = self._decode_lists(sent)
         completed = self._decode_lists(completed)
         children = self._decode_lists(children)
         errors = self._decode_dicts(errors)
-        counts = {k.decode(): int(v) for k, v in counts.items()}
+        tree = {k.decode(): int(v) for k, v in tree.items()}
+        counts = self._counts_from_tree(tree)
         status = self.Status(int(status)) if status is not None else self.Status.default
 
-        total_completed, total_messages = len(completed), len(messages)
-
-        for child_id in children:
-            child = TaskContext(id=child_id)
-
-            errors.update(child.errors)
-
-            child_completed, child_total = child.progress()
-            total_completed += child_completed
-            total_messages += child_total
-
-            child_counts = child.counts
-            for actor, count in child_counts.items():
-                counts[actor] = counts.get(actor, 0) + count
+        total_completed, total_messages = tree.get('completed', 0), tree.get('total', 0)
 
         return {
             'id': self.id,
@@ -465,34 +796,35 @@ class TaskContext:
         }
 
     def expire(self, seconds=None):
-        """Set all keys on this context (and its children) to expire. If :seconds: is None, keys are
-        deleted immediately."""
-
-        for child_id in self.children:
-            child = TaskContext(id=child_id)
-            child.expire(seconds)
-
+        """Set all keys on this context (and its children) to expire. If :seconds: is None, the default
+        expiration is used. The tree is walked a level at a time, with one pipeline per tree_chunk_size contexts,
+        so that large trees don't block Redis."""
         seconds = self.default_expire if seconds is None else seconds
-        members = ('data', 'messages', 'sent', 'completed', 'children', 'errors', 'counts', 'status')
-        keys = [self._key_for(member) for member in members]
-        pipe = self.redis.pipeline()
-        for key in keys:
-            pipe.expire(key, seconds)
-        pipe.execute()
+        level = [self._id]
 
-    def persist(self):
-        """Clear the expiration on all keys."""
+        while level:
+            children = []
 
-        for child_id in self.children:
-            child = TaskContext(id=child_id)
-            child.persist()
+            for start in range(0, len(level), self.tree_chunk_size):
+                pipe = self.redis.pipeline(transaction=False)
+                for ctx_id in level[start:start + self.tree_chunk_size]:
+                    pipe.zrange(f'{ctx_id}_children', 0, -1)
+                    for member in self.members:
+                        pipe.expire(f'{ctx_id}_{member}', seconds)
 
-        members = ('data', 'messages', 'sent', 'completed', 'children', 'errors', 'counts', 'status')
-        keys = [self._key_for(member) for member in members]
-        pipe = self.redis.pipeline()
+                results = pipe.execute()
+                for ids in results[::len(self.members) + 1]:
+                    children.extend(self._decode_lists(ids))
+
+            level = children
 
-        for key in keys:
-            pipe.persist(key)
+    def persist(self):
+        """Clear the expiration on this context and its ancestors. Descendants are left alone, since they haven't
+        changed."""
+        pipe = self.redis.pipeline(transaction=False)
+        for ctx_id in (self._id, *self.ancestors):
+            for member in self.members:
+                pipe.persist(f'{ctx_id}_{member}')
 
         pipe.execute()
 
@@ -536,14 +868,29 @@ class ColanderActor(GenericActor):
             context = TaskContext(message, data=_ctx)
             self.context = context
             self.message_id = message.message_id
+            self.bound = False
         else:
             context = TaskContext(id=_ctx)
             self.context = context
             self.message_id = _msg_id
+            self.bound = True
+
+        # Read everything we need from the context in one round trip
+        fetched = context.fetch('data', 'status', 'ancestors')
+
+        # Don't run messages from paused or cancelled contexts. Messages from paused contexts are sent
+        # again when the context is resumed.
+        if _msg_id is not None:
+            status = fetched['status']
+            if status == TaskContext.Status.paused:
+                context.requeue(_msg_id)
+                return
+            elif status == TaskContext.Status.cancelled:
+                return
 
         # Update the keyword arguments using values from the context
         fields = list(self.Schema._declared_fields)  # Use _declared_fields because it preserves declaration order
-        ctx_data = context.data
+        ctx_data = fetched['data']
         kwargs = {field: ctx_data[field] for field in fields if field in ctx_data}
 
         # Override with actual keyword args if they we provided
@@ -565,6 +912,9 @@ class ColanderActor(GenericActor):
                 context.log_error(_msg_id, str(e))
                 raise e
             else:
+                if result is DEFERRED:
+                    return None
+
                 context.complete(_msg_id)
                 context.send()
                 return result
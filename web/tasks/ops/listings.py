@@ -1,10 +1,11 @@
+import time
 from urllib.parse import urlparse
 
 import marshmallow as mm
 import marshmallow.fields as mmf
 
 from core import filter_with_json
-from models import Listing, Vendor
+from models import Listing, Vendor, Opportunity
 
 from .common import db, OpsActor, search
 
@@ -110,40 +111,71 @@ class UpdateListings(OpsActor):
 ########################################################################################################################
 
 
-# @ops_actor
-# def find_opportunities(listing_ids):
-#     """Find opportunities for a given listing."""
-#     if listing_ids:
-#         listings = Listing.query.filter(Listing.id.in_(listing_ids)).all()
-#     else:
-#         listings = Listing.query.all()
-#
-#     for listing in listings:
-#         listing_type = type(listing)
-#
-#         # Search the database for matches
-#         search_type = Listing
-#         hits, total = search.find_matching_listings(listing, model_types=[search_type], per_page=100)
-#         ids = [h['id'] for h in hits if h['n_score'] >= 0.35]
-#         matched_listings = Listing.query.filter(Listing.id.in_(ids)).all()
-#
-#         # Create opportunities for each match
-#         opps = []
-#         for match in matched_listings:
-#             if isinstance(listing, MarketListing):
-#                 opp = Opportunity(listing=listing)
-#                 src = OpportunitySource(listing=match)
-#             elif isinstance(match, MarketListing):
-#                 opp = Opportunity(listing=match)
-#                 src = OpportunitySource(listing=listing)
-#             else:
-#                 continue
-#
-#             opp.sources.append(src)
-#             opps.append(opp)
-#
-#         if opps:
-#             db.session.add_all(opps)
-#             db.session.commit()
-#
-#     return listing_ids
+class FindOpportunities(OpsActor):
+    """Find opportunities for all listings in the given query. Listings from the given markets are matched against
+    listings from other vendors, and vice versa."""
+    public = True
+
+    class Schema(mm.Schema):
+        """Parameter schema for FindOpportunities."""
+        query = mmf.Dict(missing=dict, title='Listing query')
+        market_ids = mmf.List(mmf.Int(), required=True, title='Market vendor IDs')
+        min_score = mmf.Float(missing=0.35, title='Minimum similarity')
+        chunk_size = mmf.Int(missing=100, title='Listings per chunk')
+
+    def perform(self, query=None, market_ids=None, min_score=None, chunk_size=None):
+        listings = filter_with_json(Listing.query, query).order_by(None)
+        market_ids = set(market_ids)
+        total = listings.count()
+        processed, created, last_id = 0, 0, 0
+        started = time.time()
+
+        while True:
+            # Stream the listings using keyset pagination, so that memory use doesn't depend on the query size
+            chunk = listings.filter(Listing.id > last_id).order_by(Listing.id).limit(chunk_size).all()
+            if not chunk:
+                break
+
+            # A failed search raises before the cursor or the progress move past this chunk
+            candidates = self.find_candidates(chunk, market_ids, min_score)
+            created += len(Opportunity.add_candidates(candidates))
+            db.session.commit()
+
+            last_id = chunk[-1].id
+            processed += len(chunk)
+            elapsed = time.time() - started
+            self.context['opportunities'] = {
+                'progress': [processed, total],
+                'created': created,
+                'listings_per_sec': round(processed / elapsed, 2) if elapsed else None
+            }
+
+        return created
+
+    def find_candidates(self, listings, market_ids, min_score):
+        """Return (market listing ID, source listing ID, similarity) tuples for a chunk of listings."""
+        results = search.find_matching_listings_bulk(listings, model_types=[Listing], per_page=100)
+        scores = {
+            listing_id: {int(h['id']): h['n_score'] for h in hits if (h['n_score'] or 0) >= min_score}
+            for listing_id, (hits, total) in results.items()
+        }
+
+        # Look up the vendors of all the matches at once
+        match_ids = set(id for matches in scores.values() for id in matches)
+        vendors = dict(
+            db.session.query(Listing.id, Listing.vendor_id).filter(Listing.id.in_(match_ids))
+        ) if match_ids else {}
+
+        candidates = []
+        for listing in listings:
+            is_market = listing.vendor_id in market_ids
+
+            for match_id, score in scores.get(listing.id, {}).items():
+                match_is_market = vendors.get(match_id) in market_ids
+
+                if is_market and not match_is_market and match_id in vendors:
+                    candidates.append((listing.id, match_id, score))
+                elif match_is_market and not is_market:
+                    candidates.append((match_id, listing.id, score))
+
+        return candidates
@@ -12,5 +12,5 @@ setup_dramatiq()
 
 
 from tasks.ops.utils import DebugContext, ExpireContext
-from tasks.ops.listings import ImportListing, ImportMatchingListings
+from tasks.ops.listings import ImportListing, ImportMatchingListings, FindOpportunities
 from tasks.ops.vendors import ImportInventory
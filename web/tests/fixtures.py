@@ -1,9 +1,11 @@
 import pytest
 
-from app import create_app, Config
-from app import db as _db
-from models.entities import Vendor, Market, Customer
-from models.listings import Listing, ListingDetails, MarketListing, MarketListingDetails, InventoryDetails
+from config import Config
+from core import app as _app
+from core import db as _db
+from models.entities import Vendor, Customer
+from models.listings import Listing, ListingDetails
+from models.orders import InventoryDetails
 
 
 ########################################################################################################################
@@ -20,7 +22,8 @@ class TestingConfig(Config):
 @pytest.fixture(scope='session')
 def app(request):
     """Session-wide test Flask app."""
-    app = create_app(TestingConfig)
+    app = _app
+    app.config.from_object(TestingConfig)
 
     # Establish an app context before running tests
     ctx = app.app_context()
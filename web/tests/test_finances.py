@@ -0,0 +1,104 @@
+import pytest
+
+from datetime import datetime
+
+from .fixtures import app, db, session, vendors
+from models import mixins
+from models.finances import FinancialAccount, FinancialEvent, OrderItemEvent
+
+
+########################################################################################################################
+
+
+@pytest.fixture(scope='function')
+def account(session, vendors):
+    account = FinancialAccount(owner_id=vendors[0].id, name='Amazon')
+
+    session.add(account)
+    session.commit()
+    return account
+
+
+def sale_doc(net):
+    return {
+        'match_key': 'order_item_id',
+        'date': datetime(2018, 1, 1),
+        'net': net,
+        'description': 'Sale - MSKU1',
+        'extra': {'order_item_id': 'OI1', 'msku': 'MSKU1', 'amazon_order_id': 'AO1'}
+    }
+
+
+def refund_doc(net):
+    return {
+        'match_key': 'adjustment_id',
+        'date': datetime(2018, 1, 2),
+        'net': net,
+        'description': 'Refund - MSKU1',
+        'extra': {'order_item_id': 'OI1', 'adjustment_id': 'ADJ1', 'msku': 'MSKU1', 'amazon_order_id': 'AO1'}
+    }
+
+
+def events_by_description(session):
+    session.expire_all()
+    return {e.description: e for e in session.query(OrderItemEvent)}
+
+
+########################################################################################################################
+
+
+def test_order_item_event_upsert_many_inserts(session, vendors, account):
+    new = OrderItemEvent.upsert_many([sale_doc(10), refund_doc(-10)], account.id, vendors[1].id)
+    session.commit()
+
+    assert new == 2
+    events = events_by_description(session)
+    assert float(events['Sale - MSKU1'].net) == 10
+    assert float(events['Refund - MSKU1'].net) == -10
+    assert events['Sale - MSKU1'].account_id == account.id
+    assert events['Sale - MSKU1'].originator_id == vendors[1].id
+
+
+def test_order_item_event_upsert_many_sale_and_refund_reimported(session, vendors, account):
+    OrderItemEvent.upsert_many([sale_doc(10), refund_doc(-10)], account.id, vendors[1].id)
+    session.commit()
+
+    new = OrderItemEvent.upsert_many([sale_doc(11), refund_doc(-9)], account.id, vendors[1].id)
+    session.commit()
+
+    assert new == 0
+    assert session.query(FinancialEvent).count() == 2
+
+    events = events_by_description(session)
+    sale, refund = events['Sale - MSKU1'], events['Refund - MSKU1']
+    assert float(sale.net) == 11
+    assert 'adjustment_id' not in sale.extra
+    assert float(refund.net) == -9
+    assert refund.extra['adjustment_id'] == 'ADJ1'
+
+
+def test_order_item_event_upsert_many_refund_before_sale(session, vendors, account):
+    OrderItemEvent.upsert_many([refund_doc(-10)], account.id, vendors[1].id)
+    session.commit()
+
+    new = OrderItemEvent.upsert_many([sale_doc(10)], account.id, vendors[1].id)
+    session.commit()
+
+    assert new == 1
+    events = events_by_description(session)
+    assert float(events['Refund - MSKU1'].net) == -10
+    assert float(events['Sale - MSKU1'].net) == 10
+
+
+def test_order_item_event_upsert_many_indexes(session, vendors, account, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(mixins.search, 'add_to_index', indexed.append)
+
+    OrderItemEvent.upsert_many([sale_doc(10), refund_doc(-10)], account.id, vendors[1].id)
+    session.commit()
+    assert sorted(e.description for e in indexed) == ['Refund - MSKU1', 'Sale - MSKU1']
+
+    del indexed[:]
+    OrderItemEvent.upsert_many([sale_doc(11)], account.id, vendors[1].id)
+    session.commit()
+    assert [(e.description, float(e.net)) for e in indexed] == [('Sale - MSKU1', 11)]
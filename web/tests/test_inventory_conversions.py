@@ -0,0 +1,125 @@
+import pytest
+
+from .fixtures import app, db, session, vendors
+from models.listings import Listing
+from models.orders import InventoryConversion, InvConversionSource
+
+
+########################################################################################################################
+
+
+@pytest.fixture(scope='function')
+def source_listings(session, vendors):
+    source_listings = (
+        Listing(vendor_id=vendors[0].id, sku='S1', quantity=2),
+        Listing(vendor_id=vendors[0].id, sku='S2', quantity=3),
+        Listing(vendor_id=vendors[0].id, sku='D1', quantity=1)
+    )
+
+    session.add_all(source_listings)
+    session.commit()
+    return source_listings
+
+
+@pytest.fixture(scope='function')
+def inventories(session, source_listings):
+    # New listings come with an inventory for their vendor
+    return tuple(listing.inventory for listing in source_listings)
+
+
+@pytest.fixture(scope='function')
+def conversion(session, inventories):
+    conversion = InventoryConversion(dest_id=inventories[2].id)
+    conversion.sources = [
+        InvConversionSource(inv_id=inventories[0].id, units=1),
+        InvConversionSource(inv_id=inventories[1].id, units=1)
+    ]
+
+    session.add(conversion)
+    session.commit()
+    return conversion
+
+
+########################################################################################################################
+
+
+def test_conversion_batch_params_stored(conversion):
+    assert conversion.units_per_dest == 2
+    assert conversion.total_units_per_batch == 6
+    assert conversion.batch_size == 3
+    assert [s.min_units for s in conversion.sources] == [2, 3]
+    assert [s.units_per_batch for s in conversion.sources] == [3, 3]
+
+
+def test_conversion_batch_params_follow_listing_quantity(session, source_listings, conversion):
+    source_listings[0].quantity = 4
+    session.flush()
+
+    assert conversion.total_units_per_batch == 12
+    assert conversion.batch_size == 6
+    assert [s.min_units for s in conversion.sources] == [4, 3]
+    assert [s.units_per_batch for s in conversion.sources] == [6, 6]
+
+
+def test_conversion_batch_params_follow_source_units(session, conversion):
+    conversion.sources[1].units = 2
+    session.flush()
+
+    assert conversion.units_per_dest == 3
+    assert conversion.total_units_per_batch == 6
+    assert conversion.batch_size == 2
+    assert [s.units_per_batch for s in conversion.sources] == [2, 4]
+
+
+def test_conversion_properties_dont_store_params(session, inventories):
+    conversion = InventoryConversion(dest_id=inventories[2].id)
+    conversion.sources = [
+        InvConversionSource(inv_id=inventories[0].id, units=1),
+        InvConversionSource(inv_id=inventories[1].id, units=1)
+    ]
+
+    assert conversion.source_units_per_batch == (3, 3)
+    assert conversion.min_source_units == (2, 3)
+    assert conversion.batch_size is None
+    assert [s.units_per_batch for s in conversion.sources] == [None, None]
+
+
+def test_conversion_plan(session, inventories, conversion):
+    inventories[0].fulfillable = 12
+    inventories[1].fulfillable = 7
+    session.commit()
+
+    plan = InventoryConversion.plan({conversion.id: None})[conversion.id]
+    assert plan.max_batches == 2
+    assert plan.batches == 2
+    assert plan.feasible
+    assert plan.produced == 6
+    assert plan.required == ((inventories[0].id, 6), (inventories[1].id, 6))
+
+    plan = InventoryConversion.plan({conversion.id: 3})[conversion.id]
+    assert plan.batches == 3
+    assert not plan.feasible
+
+
+def test_conversion_plan_after_quantity_change(session, source_listings, inventories, conversion):
+    inventories[0].fulfillable = 12
+    inventories[1].fulfillable = 12
+    source_listings[0].quantity = 4
+    session.commit()
+
+    plan = InventoryConversion.plan({conversion.id: None})[conversion.id]
+    assert plan.max_batches == 2
+    assert plan.produced == 12
+    assert plan.required == ((inventories[0].id, 12), (inventories[1].id, 12))
+
+
+def test_conversion_refresh_after_bulk_update(session, source_listings, conversion):
+    # The listing stays loaded in the session with its old quantity
+    assert source_listings[0].quantity == 2
+
+    Listing.query.filter(Listing.id == source_listings[0].id).update({'quantity': 4}, synchronize_session=False)
+    InventoryConversion.refresh_batch_params([source_listings[0].id])
+    session.commit()
+
+    assert conversion.batch_size == 6
+    assert [s.min_units for s in conversion.sources] == [4, 3]
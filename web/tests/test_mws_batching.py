@@ -0,0 +1,136 @@
+import json
+import time
+import uuid
+import pytest
+
+from tasks.broker import redis_client
+from ext.amazon.tasks import common
+
+
+########################################################################################################################
+
+
+LEADER_MS = 60000
+
+
+@pytest.fixture(scope='function')
+def keys():
+    key = f'TestBatch_{uuid.uuid4().hex}_batch'
+    keys = (key + '_queue', key + '_leader', key + '_processing', key + '_members')
+
+    yield keys
+    redis_client.delete(*keys)
+
+
+@pytest.fixture(scope='module')
+def scripts():
+    return {
+        name: redis_client.register_script(getattr(common, f'_BATCH_{name.upper()}_SCRIPT'))
+        for name in ('enqueue', 'drain', 'ack', 'fail', 'release')
+    }
+
+
+def request(msg_id):
+    return json.dumps({'ctx': 'ctx', 'msg_id': msg_id, 'kwargs': {}})
+
+
+def enqueue(scripts, keys, msg_id, leader_ms=LEADER_MS):
+    return scripts['enqueue'](keys=keys, args=(request(msg_id), msg_id, leader_ms))
+
+
+def drain(scripts, keys, size=20):
+    return [json.loads(item)['msg_id'] for item in scripts['drain'](keys=(keys[0], keys[2]), args=(size,))]
+
+
+def queued(keys):
+    return [json.loads(item)['msg_id'] for item in redis_client.lrange(keys[0], 0, -1)]
+
+
+########################################################################################################################
+
+
+def test_batch_leader_and_followers(scripts, keys):
+    assert enqueue(scripts, keys, 'a') == 1
+    assert enqueue(scripts, keys, 'b') == 0
+    assert enqueue(scripts, keys, 'c') == 0
+    assert enqueue(scripts, keys, 'a') == 2
+
+    assert drain(scripts, keys) == ['a', 'b', 'c']
+    scripts['ack'](keys=(keys[2], keys[3]), args=('a', 'b', 'c'))
+
+    assert scripts['release'](keys=keys[:2], args=(LEADER_MS,)) == 0
+    assert not redis_client.exists(keys[1], keys[2], keys[3])
+
+
+def test_batch_request_queued_once(scripts, keys):
+    enqueue(scripts, keys, 'a')
+    enqueue(scripts, keys, 'b')
+    enqueue(scripts, keys, 'b')
+
+    assert queued(keys) == ['a', 'b']
+
+
+def test_batch_leader_dies_and_is_redelivered(scripts, keys):
+    enqueue(scripts, keys, 'a')
+    enqueue(scripts, keys, 'b')
+    enqueue(scripts, keys, 'a')
+    assert drain(scripts, keys) == ['a', 'b']
+
+    # The leader dies without acknowledging the batch. When its message is delivered again, the batch is put back.
+    assert enqueue(scripts, keys, 'a') == 2
+    assert queued(keys) == ['a', 'b']
+    assert drain(scripts, keys) == ['a', 'b']
+
+
+def test_batch_leader_dies_and_leadership_expires(scripts, keys):
+    enqueue(scripts, keys, 'a', leader_ms=50)
+    enqueue(scripts, keys, 'b')
+    enqueue(scripts, keys, 'a')
+    assert drain(scripts, keys) == ['a', 'b']
+
+    # The leader dies and is never delivered again. The next request takes over, and drains the old batch too.
+    time.sleep(0.1)
+    assert enqueue(scripts, keys, 'c') == 1
+    assert enqueue(scripts, keys, 'c') == 2
+    assert drain(scripts, keys) == ['a', 'b', 'c']
+
+
+def test_batch_leader_fails(scripts, keys):
+    enqueue(scripts, keys, 'a')
+    enqueue(scripts, keys, 'b')
+    enqueue(scripts, keys, 'c')
+    enqueue(scripts, keys, 'a')
+    assert drain(scripts, keys, size=2) == ['a', 'b']
+
+    # The leader fails for good. The next request in line becomes the leader, and can drain the whole queue.
+    successor = scripts['fail'](keys=keys, args=('a', LEADER_MS, '0'))
+    assert json.loads(successor)['msg_id'] == 'b'
+    assert redis_client.get(keys[1]) == b'b'
+    assert not redis_client.sismember(keys[3], 'a')
+
+    assert enqueue(scripts, keys, 'b') == 2
+    assert drain(scripts, keys) == ['b', 'c']
+    scripts['ack'](keys=(keys[2], keys[3]), args=('b', 'c'))
+    assert scripts['release'](keys=keys[:2], args=(LEADER_MS,)) == 0
+
+
+def test_batch_leader_fails_alone(scripts, keys):
+    enqueue(scripts, keys, 'a')
+    enqueue(scripts, keys, 'a')
+    drain(scripts, keys)
+
+    assert scripts['fail'](keys=keys, args=('a', LEADER_MS, '0')) is None
+    assert not redis_client.exists(keys[0], keys[1], keys[2])
+
+
+def test_batch_leader_throttled(scripts, keys):
+    enqueue(scripts, keys, 'a')
+    enqueue(scripts, keys, 'b')
+    enqueue(scripts, keys, 'a')
+    drain(scripts, keys)
+
+    # A throttled leader keeps the batch and the leadership
+    assert scripts['fail'](keys=keys, args=('a', LEADER_MS, '1')) is None
+    assert redis_client.get(keys[1]) == b'a'
+    assert enqueue(scripts, keys, 'a') == 2
+    assert drain(scripts, keys) == ['a', 'b']
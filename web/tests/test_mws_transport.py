@@ -0,0 +1,170 @@
+import pytest
+
+from ext.amazon.tasks import transport
+from ext.amazon.tasks.transport import CassetteStore, CassetteNotFound, ReplayTransport, RecordTransport, \
+    StubQuotas, StubServer, cassette_key, request_params, make_response, get_transport
+from ext.amazon.tasks.throttle import limits_for
+
+
+########################################################################################################################
+
+
+URL = 'https://mws.amazonservices.com/Orders/2013-09-01'
+
+
+@pytest.fixture(scope='function')
+def store(tmpdir):
+    return CassetteStore(str(tmpdir))
+
+
+def params(**kwargs):
+    return {'Action': 'ListOrders', 'Signature': 'abc', 'Timestamp': '2018-01-01T00:00:00Z', 'SellerId': 'S1',
+            **kwargs}
+
+
+########################################################################################################################
+
+
+def test_request_params():
+    collected = request_params(URL + '?Action=ListOrders&A=1', params={'B': '2'}, data=b'C=3&D=4')
+    assert collected == {'Action': 'ListOrders', 'A': '1', 'B': '2', 'C': '3', 'D': '4'}
+
+
+def test_cassette_key_ignores_volatile_params():
+    key = cassette_key(URL, params(CreatedAfter='2018-01-01'))
+
+    assert key.startswith('ListOrders/')
+    assert key == cassette_key(URL + '/', {**params(CreatedAfter='2018-01-01'), 'Signature': 'xyz',
+                                           'Timestamp': '2018-01-02T00:00:00Z', 'SellerId': 'S2'})
+    assert key != cassette_key(URL, params(CreatedAfter='2018-01-02'))
+    assert key != cassette_key('https://mws.amazonservices.com/Products/2011-10-01', params(CreatedAfter='2018-01-01'))
+
+
+def test_cassette_key_operation():
+    assert cassette_key(URL, {'Operation': 'ItemLookup'}).startswith('ItemLookup/')
+
+
+########################################################################################################################
+
+
+def test_store_save_and_load(store):
+    key = cassette_key(URL, params(A='1'))
+    store.save(key, params(A='1'), 200, b'<body/>')
+
+    assert store.load(key) == (200, b'<body/>')
+    assert store.keys_for('ListOrders') == [key]
+    assert store.keys_for('ListOrderItems') == []
+
+
+def test_store_find_without_fallback(store):
+    store.save(cassette_key(URL, params(A='1')), params(A='1'), 200, b'<body/>')
+
+    with pytest.raises(CassetteNotFound):
+        store.find(cassette_key(URL, params(A='2')))
+
+
+def test_store_find_fallback_is_deterministic(store):
+    for n in range(5):
+        store.save(cassette_key(URL, params(A=str(n))), params(A=str(n)), 200, f'<body n="{n}"/>'.encode())
+
+    bodies = set()
+    for n in range(5, 25):
+        key = cassette_key(URL, params(A=str(n)))
+        found = store.find(key, any_for_action=True)
+
+        assert all(store.find(key, any_for_action=True) == found for _ in range(3))
+        bodies.add(found[1])
+
+    assert len(bodies) > 1
+
+
+def test_store_find_fallback_removes_next_token(store):
+    store.save(cassette_key(URL, params(A='1')), params(A='1'), 200,
+               b'<ListOrdersResult><NextToken>\ntoken\n</NextToken><Orders/></ListOrdersResult>')
+
+    key = cassette_key(URL, {**params(), 'Action': 'ListOrdersByNextToken', 'NextToken': 'other'})
+    assert store.find(key, any_for_action=True) == (200, b'<ListOrdersResult><Orders/></ListOrdersResult>')
+
+    with pytest.raises(CassetteNotFound):
+        store.find(cassette_key(URL, {'Action': 'ListOrderItems'}), any_for_action=True)
+
+
+########################################################################################################################
+
+
+def test_record_and_replay(store, monkeypatch):
+    def request(method, url, **kwargs):
+        assert kwargs['stream']
+        return make_response(url, 200, b'<recorded/>')
+
+    monkeypatch.setattr(transport.requests, 'request', request)
+    RecordTransport(store)('POST', URL, data=params(A='1'))
+
+    # The signature and timestamp change, but the request is answered from the recording
+    response = ReplayTransport(store)('POST', URL, data={**params(A='1'), 'Signature': 'new', 'Timestamp': 'now'})
+    assert response.status_code == 200
+    assert response.content == b'<recorded/>'
+
+    with pytest.raises(CassetteNotFound):
+        ReplayTransport(store)('POST', URL, data=params(A='2'))
+
+    assert ReplayTransport(store, any_for_action=True)('POST', URL, data=params(A='2')).content == b'<recorded/>'
+
+
+def test_record_skips_throttled_responses(store, monkeypatch):
+    monkeypatch.setattr(transport.requests, 'request', lambda method, url, **kwargs: make_response(url, 503, b''))
+
+    assert RecordTransport(store)('POST', URL, data=params()).status_code == 503
+    assert store.keys_for('ListOrders') == []
+
+
+def test_get_transport_replay_fallback(tmpdir):
+    config = {'MWS_TRANSPORT': 'replay', 'MWS_CASSETTE_DIR': str(tmpdir)}
+    assert not get_transport(config).any_for_action
+    assert get_transport({**config, 'MWS_REPLAY_FALLBACK': True}).any_for_action
+
+    with pytest.raises(ValueError):
+        get_transport({'MWS_TRANSPORT': 'nope'})
+
+
+########################################################################################################################
+
+
+def test_stub_quotas(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(transport.time, 'monotonic', lambda: now[0])
+
+    limits = limits_for('ListOrders')
+    quotas = StubQuotas()
+
+    assert all(quotas.allow('ListOrders') for _ in range(int(limits['quota_max'])))
+    assert not quotas.allow('ListOrders')
+    assert not quotas.allow('ListOrdersByNextToken')
+
+    # One request is restored every restore_rate seconds
+    now[0] += limits['restore_rate']
+    assert quotas.allow('ListOrdersByNextToken')
+    assert not quotas.allow('ListOrders')
+
+
+def test_stub_server_respond(store):
+    store.save(cassette_key(URL, params(A='1')), params(A='1'), 200, b'<recorded/>')
+    path = '/Orders/2013-09-01'
+
+    server = StubServer(('localhost', 0), store, enforce_quotas=False)
+    fallback = StubServer(('localhost', 0), store, enforce_quotas=False, fallback=True)
+    try:
+        assert server.respond(path, params(A='1')) == (200, b'<recorded/>')
+        assert server.respond(path, params(A='2')) == (400, transport.NOT_FOUND_BODY)
+        assert fallback.respond(path, params(A='2')) == (200, b'<recorded/>')
+    finally:
+        server.server_close()
+        fallback.server_close()
+
+
+def test_stub_server_throttles(store):
+    server = StubServer(('localhost', 0), store, enforce_quotas=False, throttle_rate=1)
+    try:
+        assert server.respond('/Orders/2013-09-01', params()) == (503, transport.THROTTLED_BODY)
+    finally:
+        server.server_close()
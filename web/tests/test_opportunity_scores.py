@@ -0,0 +1,134 @@
+import pytest
+from decimal import Decimal
+
+from .fixtures import app, db, session, vendors
+from models.listings import Listing, ListingDetails
+from models.relationships import Opportunity, OpportunitySource, OpportunityScore
+
+
+########################################################################################################################
+
+
+@pytest.fixture(scope='function')
+def score_listings(session, vendors):
+    score_listings = (
+        Listing(vendor_id=vendors[0].id, sku='SRC1', quantity=1),
+        Listing(vendor_id=vendors[2].id, sku='MKT1', quantity=1, extra={'selling_fees': 5}),
+        Listing(vendor_id=vendors[2].id, sku='MKT2', quantity=1, extra={'selling_fees': 5}),
+        Listing(vendor_id=vendors[2].id, sku='MKT3', quantity=1)
+    )
+
+    session.add_all(score_listings)
+    session.commit()
+
+    session.add_all([
+        ListingDetails(listing_id=score_listings[0].id, price=10),
+        ListingDetails(listing_id=score_listings[1].id, price=30),
+        ListingDetails(listing_id=score_listings[2].id, price=50),
+        ListingDetails(listing_id=score_listings[3].id, price=30)
+    ])
+    session.commit()
+    return score_listings
+
+
+@pytest.fixture(scope='function')
+def opportunity(session, score_listings):
+    opportunity = Opportunity(listing_id=score_listings[1].id)
+    opportunity.sources = [OpportunitySource(listing_id=score_listings[0].id, units=1)]
+
+    session.add(opportunity)
+    session.commit()
+    return opportunity
+
+
+def score_for(session, opportunity):
+    session.expire_all()
+    return session.query(OpportunityScore).filter_by(id=opportunity.id).one()
+
+
+########################################################################################################################
+
+
+def test_opportunity_score_created(session, opportunity):
+    score = score_for(session, opportunity)
+
+    assert float(score.cost) == pytest.approx(12)
+    assert float(score.revenue) == pytest.approx(30)
+    assert float(score.selling_fees) == pytest.approx(5)
+    assert float(score.profit) == pytest.approx(13)
+    assert score.roi == pytest.approx(13 / 12)
+
+
+def test_opportunity_score_vendor_fee_fallback(session, vendors, score_listings):
+    vendors[2].extra = {'avg_selling_fees': 0.1}
+    opportunity = Opportunity(listing_id=score_listings[3].id)
+    opportunity.sources = [OpportunitySource(listing_id=score_listings[0].id, units=1)]
+    session.add(opportunity)
+    session.commit()
+
+    score = score_for(session, opportunity)
+    assert float(score.selling_fees) == pytest.approx(3)
+    assert float(score.profit) == pytest.approx(15)
+
+
+def test_opportunity_score_exact_amounts(session, vendors, score_listings):
+    source = Listing(vendor_id=vendors[0].id, sku='SRC2', quantity=3)
+    session.add(source)
+    session.commit()
+    session.add(ListingDetails(listing_id=source.id, price=Decimal('9.99')))
+
+    opportunity = Opportunity(listing_id=score_listings[1].id)
+    opportunity.sources = [OpportunitySource(listing_id=source.id, units=2)]
+    session.add(opportunity)
+    session.commit()
+
+    score = score_for(session, opportunity)
+    assert score.cost == Decimal('7.9920')
+    assert score.profit == Decimal('17.0080')
+
+
+def test_opportunity_score_source_deleted(session, opportunity):
+    session.delete(opportunity.sources[0])
+    session.commit()
+
+    score = score_for(session, opportunity)
+    assert score.cost is None
+    assert score.profit is None
+    assert score.roi is None
+
+
+def test_opportunity_score_market_listing_changed(session, score_listings, opportunity):
+    opportunity.listing_id = score_listings[2].id
+    session.commit()
+
+    score = score_for(session, opportunity)
+    assert float(score.revenue) == pytest.approx(50)
+    assert float(score.profit) == pytest.approx(33)
+
+
+def test_opportunity_score_top(session, score_listings, opportunity):
+    other = Opportunity(listing_id=score_listings[2].id)
+    other.sources = [OpportunitySource(listing_id=score_listings[0].id, units=1)]
+    session.add(other)
+    session.commit()
+
+    assert [o.id for o in OpportunityScore.top(by='profit')] == [other.id, opportunity.id]
+
+    session.delete(other.sources[0])
+    session.commit()
+
+    assert [o.id for o in OpportunityScore.top(by='profit')] == [opportunity.id, other.id]
+
+
+def test_add_candidates_skips_existing_pairs(session, score_listings, opportunity):
+    market, source = score_listings[1].id, score_listings[0].id
+
+    new_ids = Opportunity.add_candidates([(market, source, .5), (score_listings[2].id, source, .7)])
+    assert len(new_ids) == 1
+
+    assert Opportunity.add_candidates([(market, source, .9), (score_listings[2].id, source, .8)]) == []
+    session.commit()
+
+    assert session.query(Opportunity).count() == 2
+    assert session.query(OpportunitySource).filter_by(relationship_id=opportunity.id).one().similarity == .9
+    assert session.query(OpportunityScore).filter_by(id=new_ids[0]).one().profit is not None
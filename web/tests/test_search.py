@@ -0,0 +1,40 @@
+import pytest
+
+from search.search import ColanderSearch, SearchError
+
+
+########################################################################################################################
+
+
+class StubES:
+    def __init__(self, responses):
+        self.responses = responses
+
+    def msearch(self, body):
+        return {'responses': self.responses}
+
+
+def hits(*ids):
+    return {'hits': {'total': len(ids), 'max_score': 2.0, 'hits': [
+        {'_id': str(id), '_score': 1.0, '_source': {'__model_type__': 'Listing'}} for id in ids
+    ]}}
+
+
+########################################################################################################################
+
+
+def test_msearch_results_in_query_order():
+    search = ColanderSearch()
+    search.es = StubES([hits(1, 2), hits()])
+
+    results = search._msearch([{'must': []}, {'must': []}])
+    assert [total for hits_, total in results] == [2, 0]
+    assert [h['id'] for h in results[0][0]] == ['1', '2']
+
+
+def test_msearch_raises_on_failed_search():
+    search = ColanderSearch()
+    search.es = StubES([hits(1), {'error': {'type': 'search_phase_execution_exception'}, 'status': 500}])
+
+    with pytest.raises(SearchError):
+        search._msearch([{'must': []}, {'must': []}])
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from .fixtures import app, db, session, vendors
+from models.extensions import SyncState
+
+
+########################################################################################################################
+
+
+def test_cursor_for_unsynced_feed(session, vendors):
+    assert SyncState.cursor_for(vendors[0].id, 'orders') is None
+    assert SyncState.cursor_for(vendors[0].id, 'orders', overlap=timedelta(minutes=10)) is None
+
+
+def test_advance_creates_cursor(session, vendors):
+    synced_at = datetime(2018, 1, 1, 12)
+    SyncState.advance(vendors[0].id, 'orders', synced_at)
+    session.commit()
+
+    assert SyncState.cursor_for(vendors[0].id, 'orders') == synced_at
+    assert SyncState.cursor_for(vendors[0].id, 'orders', overlap=timedelta(minutes=10)) == datetime(2018, 1, 1, 11, 50)
+
+
+def test_advance_moves_forward(session, vendors):
+    SyncState.advance(vendors[0].id, 'orders', datetime(2018, 1, 1))
+    SyncState.advance(vendors[0].id, 'orders', datetime(2018, 1, 2))
+    session.commit()
+
+    assert SyncState.cursor_for(vendors[0].id, 'orders') == datetime(2018, 1, 2)
+    assert session.query(SyncState).count() == 1
+
+
+def test_advance_never_moves_back(session, vendors):
+    SyncState.advance(vendors[0].id, 'orders', datetime(2018, 1, 2))
+    SyncState.advance(vendors[0].id, 'orders', datetime(2018, 1, 1))
+    session.commit()
+
+    assert SyncState.cursor_for(vendors[0].id, 'orders') == datetime(2018, 1, 2)
+
+
+def test_advance_by_vendor_and_feed(session, vendors):
+    SyncState.advance(vendors[0].id, 'orders', datetime(2018, 1, 1))
+    SyncState.advance(vendors[0].id, 'financials', datetime(2018, 1, 2))
+    SyncState.advance(vendors[1].id, 'orders', datetime(2018, 1, 3))
+    session.commit()
+
+    assert SyncState.cursor_for(vendors[0].id, 'orders') == datetime(2018, 1, 1)
+    assert SyncState.cursor_for(vendors[0].id, 'financials') == datetime(2018, 1, 2)
+    assert SyncState.cursor_for(vendors[1].id, 'orders') == datetime(2018, 1, 3)
+    assert SyncState.cursor_for(vendors[1].id, 'financials') is None
+
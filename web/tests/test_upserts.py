@@ -0,0 +1,260 @@
+import pytest
+
+from datetime import datetime
+
+from .fixtures import app, db, session, vendors, listings
+from models import mixins
+from models.entities import Entity, Customer, Vendor
+from models.listings import Listing
+from models.orders import Order, OrderItem, Shipment, Inventory, InventoryDetails
+
+
+########################################################################################################################
+
+
+@pytest.fixture(scope='function')
+def indexed(monkeypatch):
+    indexed = []
+    monkeypatch.setattr(mixins.search, 'add_to_index', indexed.append)
+    return indexed
+
+
+def indexed_ids(indexed, model):
+    return sorted(obj.id for obj in indexed if isinstance(obj, model))
+
+
+########################################################################################################################
+
+
+def test_customer_upsert_many_inserts(session):
+    ids = Customer.upsert_many([
+        {'name': 'Buyer One', 'email': 'one@example.com', 'city': 'Springfield', 'state': 'OR', 'zip': '97477',
+         'extra': {'address': {'lines': ['1 Main St']}}},
+        {'name': 'Buyer Two'}
+    ])
+    session.commit()
+
+    one = session.query(Customer).filter_by(id=ids['Buyer One']).one()
+    assert (one.name, one.email, one.city, one.state, one.zip) == \
+        ('Buyer One', 'one@example.com', 'Springfield', 'OR', '97477')
+    assert one.extra == {'address': {'lines': ['1 Main St']}}
+    assert session.query(Customer).filter_by(id=ids['Buyer Two']).one().name == 'Buyer Two'
+
+
+def test_customer_upsert_many_updates(session):
+    first = Customer.upsert_many([{'name': 'Buyer One', 'city': 'Springfield', 'extra': {'a': 1}}])
+    second = Customer.upsert_many([{'name': 'Buyer One', 'email': 'one@example.com', 'extra': {'b': 2}}])
+    session.commit()
+    session.expire_all()
+
+    assert first == second
+    assert session.query(Customer).count() == 1
+
+    customer = session.query(Customer).one()
+    assert customer.city == 'Springfield'
+    assert customer.email == 'one@example.com'
+    assert customer.extra == {'a': 1, 'b': 2}
+
+
+def test_customer_upsert_many_indexes(session, vendors, indexed):
+    first = Customer.upsert_many([{'name': 'Buyer One'}])
+    session.commit()
+    assert indexed_ids(indexed, Customer) == [first['Buyer One']]
+
+    del indexed[:]
+    second = Customer.upsert_many([{'name': 'Buyer One', 'city': 'Springfield'}, {'name': 'Buyer Two'},
+                                   {'name': vendors[0].name}])
+    session.commit()
+
+    assert indexed_ids(indexed, Customer) == sorted([second['Buyer One'], second['Buyer Two']])
+    assert [obj.city for obj in indexed if obj.id == second['Buyer One']] == ['Springfield']
+    assert indexed_ids(indexed, Vendor) == []
+
+
+def test_customer_upsert_many_name_of_other_entity(session, vendors):
+    ids = Customer.upsert_many([{'name': vendors[0].name, 'city': 'Springfield', 'extra': {'a': 1}}])
+    session.commit()
+    session.expire_all()
+
+    assert ids == {vendors[0].name: vendors[0].id}
+    assert session.query(Customer).count() == 0
+    assert session.query(Entity).filter_by(id=vendors[0].id).one().extra == {}
+
+
+########################################################################################################################
+
+
+def test_order_upsert_many(session, vendors):
+    date = datetime(2018, 1, 1)
+    ids = Order.upsert_many(vendors[0].id, [
+        {'order_number': 'O1', 'date': date, 'dest_id': vendors[1].id, 'extra': {'status': 'Pending', 'a': 1}},
+        {'order_number': 'O2'}
+    ])
+    session.commit()
+
+    new_ids = Order.upsert_many(vendors[0].id, [
+        {'order_number': 'O1', 'extra': {'status': 'Shipped'}},
+        {'order_number': 'O3', 'dest_id': vendors[2].id}
+    ])
+    session.commit()
+    session.expire_all()
+
+    assert new_ids['O1'] == ids['O1']
+    assert len({ids['O1'], ids['O2'], new_ids['O3']}) == 3
+    assert session.query(Order).count() == 3
+
+    order = session.query(Order).filter_by(id=ids['O1']).one()
+    assert order.date == date
+    assert order.dest_id == vendors[1].id
+    assert order.extra == {'status': 'Shipped', 'a': 1}
+    assert session.query(Order).filter_by(id=new_ids['O3']).one().source_id == vendors[0].id
+
+
+def test_order_upsert_many_indexes(session, vendors, indexed):
+    ids = Order.upsert_many(vendors[0].id, [{'order_number': 'O1'}, {'order_number': 'O2'}])
+    session.commit()
+    assert indexed_ids(indexed, Order) == sorted(ids.values())
+
+    del indexed[:]
+    Order.upsert_many(vendors[0].id, [{'order_number': 'O1', 'extra': {'status': 'Shipped'}}])
+    session.commit()
+    assert indexed_ids(indexed, Order) == [ids['O1']]
+    assert indexed[-1].extra == {'status': 'Shipped'}
+
+
+def test_order_upsert_many_by_source(session, vendors):
+    one = Order.upsert_many(vendors[0].id, [{'order_number': 'O1'}])
+    two = Order.upsert_many(vendors[1].id, [{'order_number': 'O1'}])
+
+    assert one['O1'] != two['O1']
+
+
+########################################################################################################################
+
+
+@pytest.fixture(scope='function')
+def order(session, vendors):
+    order = Order(source_id=vendors[0].id, dest_id=vendors[1].id, order_number='O1')
+
+    session.add(order)
+    session.commit()
+    return order
+
+
+def test_order_item_upsert_many_by_extra_key(session, order, listings):
+    inv_id = listings[0].inventory.id
+    ids, new = OrderItem.upsert_many(order.id, [
+        {'quantity': 2, 'source_id': inv_id, 'extra': {'order_item_id': 'OI1', 'a': 1}},
+        {'extra': {'order_item_id': 'OI2'}}
+    ], key='order_item_id')
+    session.commit()
+
+    assert sorted(new) == ['OI1', 'OI2']
+
+    again, new = OrderItem.upsert_many(order.id, [
+        {'received': 2, 'extra': {'order_item_id': 'OI1', 'b': 2}}
+    ], key='order_item_id')
+    session.commit()
+    session.expire_all()
+
+    assert new == []
+    assert again == {'OI1': ids['OI1']}
+
+    item = session.query(OrderItem).filter_by(id=ids['OI1']).one()
+    assert (item.quantity, item.received, item.source_id) == (2, 2, inv_id)
+    assert item.extra == {'order_item_id': 'OI1', 'a': 1, 'b': 2}
+
+    defaults = session.query(OrderItem).filter_by(id=ids['OI2']).one()
+    assert (defaults.quantity, defaults.received) == (1, 0)
+
+
+def test_order_item_upsert_many_by_columns(session, order, listings):
+    inv_ids = [listing.inventory.id for listing in listings[:2]]
+    ids, new = OrderItem.upsert_many(order.id, [
+        {'source_id': inv_ids[0], 'quantity': 1},
+        {'source_id': inv_ids[1], 'quantity': 2}
+    ], key=('source_id',))
+
+    again, new_again = OrderItem.upsert_many(order.id, [{'source_id': inv_ids[1], 'quantity': 5}], key=('source_id',))
+    session.commit()
+    session.expire_all()
+
+    assert sorted(new) == [(inv_ids[0],), (inv_ids[1],)]
+    assert new_again == []
+    assert again[(inv_ids[1],)] == ids[(inv_ids[1],)]
+    assert session.query(OrderItem).filter_by(id=ids[(inv_ids[1],)]).one().quantity == 5
+
+
+def test_shipment_assign_items(session, vendors, order, listings):
+    other = Order(source_id=vendors[0].id, dest_id=vendors[1].id, order_number='O2')
+    session.add(other)
+    session.commit()
+
+    inv_id = listings[0].inventory.id
+    ids, _ = OrderItem.upsert_many(order.id, [{'source_id': inv_id}], key=('source_id',))
+    other_ids, _ = OrderItem.upsert_many(other.id, [{'source_id': inv_id}], key=('source_id',))
+
+    # Items imported before the shipment are assigned along with it
+    shipment = Shipment(order_id=order.id, tracking_number='T1')
+    session.add_all([shipment, Shipment(order_id=other.id, tracking_number='T2'),
+                     Shipment(order_id=other.id, tracking_number='T3')])
+    session.flush()
+    Shipment.assign_items([order.id, other.id])
+
+    # Items imported after the shipment are assigned too
+    later, _ = OrderItem.upsert_many(order.id, [{'source_id': listings[1].inventory.id}], key=('source_id',))
+    Shipment.assign_items([order.id])
+    session.commit()
+    session.expire_all()
+
+    assert session.query(OrderItem).filter_by(id=ids[(inv_id,)]).one().shipment_id == shipment.id
+    assert session.query(OrderItem).filter_by(id=later[(listings[1].inventory.id,)]).one().shipment_id == shipment.id
+    assert session.query(OrderItem).filter_by(id=other_ids[(inv_id,)]).one().shipment_id is None
+
+
+########################################################################################################################
+
+
+def test_listing_ensure_skus(session, vendors, listings):
+    ids = Listing.ensure_skus(vendors[0].id, [listings[0].sku, 'NEW1', 'NEW1'])
+    session.commit()
+
+    assert ids[listings[0].sku] == listings[0].id
+    assert session.query(Listing).filter_by(vendor_id=vendors[0].id).count() == 2
+
+    new = session.query(Listing).filter_by(id=ids['NEW1']).one()
+    assert new.quantity == 1
+    assert session.query(Inventory).filter_by(owner_id=vendors[0].id, listing_id=new.id).count() == 1
+    assert Listing.ensure_skus(vendors[0].id, ['NEW1']) == {'NEW1': new.id}
+
+
+def test_listing_ensure_skus_indexes(session, vendors, listings, indexed):
+    ids = Listing.ensure_skus(vendors[0].id, [listings[0].sku, 'NEW1'])
+    session.commit()
+
+    assert indexed_ids(indexed, Listing) == [ids['NEW1']]
+
+
+def test_inventory_ensure_many(session, vendors, listings):
+    existing = listings[0].inventory
+    pairs = [(vendors[0].id, listings[0].id), (vendors[1].id, listings[0].id)]
+
+    ids = Inventory.ensure_many(pairs)
+    assert ids[pairs[0]] == existing.id
+    assert Inventory.ensure_many(pairs) == ids
+    assert session.query(Inventory).filter_by(listing_id=listings[0].id).count() == 2
+
+
+def test_inventory_adjust_fulfillable(session, listings):
+    stocked, empty = listings[0].inventory, listings[1].inventory
+    stocked.details.append(InventoryDetails(fulfillable=5, reserved=2, unsellable=1, price=3))
+    session.commit()
+
+    Inventory.adjust_fulfillable({stocked.id: 3, empty.id: 4, listings[2].inventory.id: 0})
+    session.commit()
+    session.expire_all()
+
+    assert len(stocked.details) == 2
+    assert (stocked.fulfillable, stocked.reserved, stocked.unsellable, float(stocked.price)) == (8, 2, 1, 3)
+    assert (empty.fulfillable, empty.reserved) == (4, 0)
+    assert listings[2].inventory.details == []